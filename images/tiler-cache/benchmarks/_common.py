@@ -0,0 +1,44 @@
+"""Helpers shared by the benchmark scripts: generated expire files and timing."""
+import random
+import statistics
+import time
+
+# (name, tiles, clusters, share of tiles in filled areas)
+PROFILES = [
+    ("minutely", 60, 3, 0.2),
+    ("hourly", 2000, 40, 0.4),
+    ("large", 50000, 200, 0.6),
+    ("mass-import", 500000, 20, 0.9),
+]
+
+
+def expire_tiles(rng: random.Random, n: int, clusters: int, area_share: float, zoom: int = 14):
+    """Distinct z/x/y lines: random walks (edited ways) plus filled rectangles (edited areas)."""
+    size = 1 << zoom
+    tiles = set()
+    per_cluster = max(1, n // clusters)
+    while len(tiles) < n:
+        cx, cy = rng.randrange(size), rng.randrange(size)
+        target = min(n, len(tiles) + per_cluster)
+        if rng.random() < area_share:
+            side = max(1, int((target - len(tiles)) ** 0.5))
+            x0, y0 = min(cx, size - side), min(cy, size - side)
+            for x in range(x0, x0 + side):
+                for y in range(y0, y0 + side):
+                    tiles.add((x, y))
+        x, y = cx, cy
+        while len(tiles) < target:
+            x = min(size - 1, max(0, x + rng.choice((-1, 0, 0, 1))))
+            y = min(size - 1, max(0, y + rng.choice((-1, 0, 0, 1))))
+            tiles.add((x, y))
+    return [f"{zoom}/{x}/{y}" for x, y in list(tiles)[:n]]
+
+
+def timed(fn, repeat: int):
+    """Run fn repeat times. Returns (last result, median ms, max ms)."""
+    samples, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(samples), max(samples)
@@ -0,0 +1,113 @@
+"""Audit the over-invalidation of the BANs generated for expire files.
+
+For each expire file, builds the BANs tiler-cache would send and runs them
+against a cache inventory (utils.ban_audit): per zoom, cached tiles evicted
+that really changed, evicted but unchanged, and changed but missed. The
+inventory is one or more files of cached tile URLs / z/x/y lines or
+varnishncsa access logs, or a synthetic cache around the edit and across
+the world. Re-run with other --zooms, --planner or --mode settings to
+compare them.
+
+    cd images/tiler-cache
+    python -m benchmarks.ban_audit expire/1234.tiles --inventory varnish-objects.txt
+    python -m benchmarks.ban_audit --generate hourly --synthetic 20000 --zooms 10,11,12,13,14,15,16
+    python -m benchmarks.ban_audit --generate hourly --planner --json /tmp/audit.json
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+
+
+def _print_report(name: str, report: dict, show_bans: int):
+    print(
+        f"{name}: {report['expire_tiles']} expire tiles -> {report['units']} units, {len(report['bans'])} BANs "
+        f"({report['mode']}) on {report['inventory']} cached tiles"
+    )
+    print(f"{'zoom':>5} {'target':>6} {'changed':>12} {'cached':>8} {'needed':>8} {'over':>8} {'missed':>7} {'evicted/needed':>15}")
+    for z, r in report["zooms"].items():
+        ratio = "-" if r["over_ratio"] is None else f"{r['over_ratio']:.2f}"
+        print(
+            f"{z:>5} {'yes' if r['targeted'] else 'no':>6} {r['changed']:>12} {r['cached']:>8} "
+            f"{r['needed']:>8} {r['over']:>8} {r['missed']:>7} {ratio:>15}"
+        )
+    ratio = "-" if report["over_ratio"] is None else f"{report['over_ratio']:.2f}"
+    print(f"{'total':>5} {'':>6} {'':>12} {report['inventory']:>8} {report['needed']:>8} {report['over']:>8} "
+          f"{report['missed']:>7} {ratio:>15}")
+    worst = sorted(report["bans"], key=lambda b: b["unchanged"], reverse=True)[:show_bans]
+    for b in worst:
+        print(f"  BAN {b['ban']}: {b['patterns']} patterns, {b['bytes']} bytes, evicts {b['evicted']} ({b['unchanged']} unchanged)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("expire_files", nargs="*", help="imposm expire files (local paths or URLs)")
+    parser.add_argument("--generate", default=None, help="generate expire files of these benchmarks._common profiles")
+    parser.add_argument("--inventory", nargs="*", default=None, help="cached-tile listings or varnishncsa logs")
+    parser.add_argument("--synthetic", type=int, default=10000, help="synthetic cached tiles per zoom (no --inventory)")
+    parser.add_argument("--local-share", type=float, default=0.5, help="share of synthetic tiles near the edit")
+    parser.add_argument("--zooms", default=None, help="zoom levels (default ZOOM_LEVELS_TO_DELETE)")
+    parser.add_argument("--mode", choices=("url", "obj", "xkey"), default=None, help="VARNISH_BAN_MODE")
+    parser.add_argument("--planner", action="store_true", help="enable VARNISH_BAN_PLANNER")
+    parser.add_argument("--regex-max-bytes", type=int, default=None, help="VARNISH_BAN_REGEX_MAX_BYTES")
+    parser.add_argument("--bans", type=int, default=5, help="BANs listed per file, most unchanged evictions first")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", default=None, help="write the reports to this file")
+    args = parser.parse_args()
+
+    # The purger reads its settings at import
+    if args.mode:
+        os.environ["VARNISH_BAN_MODE"] = args.mode
+    if args.planner:
+        os.environ["VARNISH_BAN_PLANNER"] = "true"
+    if args.regex_max_bytes:
+        os.environ["VARNISH_BAN_REGEX_MAX_BYTES"] = str(args.regex_max_bytes)
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="ban-audit-metrics-"))
+    import logging
+
+    from benchmarks._common import PROFILES, expire_tiles
+    from config import Config
+    from utils import ban_audit
+    from utils.utils import iter_expire_file_lines
+
+    logging.getLogger("default_logger").setLevel(logging.WARNING)
+    zoom_levels = [int(z) for z in args.zooms.split(",")] if args.zooms else Config.ZOOM_LEVELS_TO_DELETE
+
+    cases = [(os.path.basename(p), [ln.strip() for ln in iter_expire_file_lines(p) if ln.strip()]) for p in args.expire_files]
+    if args.generate:
+        rng = random.Random(args.seed)
+        wanted = set(args.generate.split(","))
+        cases += [
+            (name, expire_tiles(rng, n, clusters, area_share))
+            for name, n, clusters, area_share in PROFILES
+            if name in wanted
+        ]
+    if not cases:
+        parser.error("give expire files or --generate")
+
+    inventory = None
+    if args.inventory:
+        lines = []
+        for path in args.inventory:
+            with open(path, errors="replace") as f:
+                lines.extend(f)
+        inventory = ban_audit.parse_inventory(lines)
+
+    reports = {}
+    for name, tile_strings in cases:
+        cache = inventory
+        if cache is None:
+            cache = ban_audit.synthetic_inventory(tile_strings, zoom_levels, args.synthetic, args.local_share, args.seed)
+        reports[name] = ban_audit.audit(tile_strings, zoom_levels, cache)
+        _print_report(name, reports[name], args.bans)
+        print()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"zoom_levels": zoom_levels, "reports": reports}, f, indent=2)
+        print(f"saved {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark the changed-tile index: ingest, /tiles/changed queries and compaction.
+
+Simulates minutely expire files (clustered z14 tiles) in a scratch SQLite
+file and reports ingest throughput, query latency per zoom and time
+window, and compaction time.
+
+    cd images/tiler-cache
+    python -m benchmarks.changed_tiles --files 1440 --tiles-per-file 2000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from benchmarks._common import timed
+
+
+def _expire_file(rng: random.Random, n: int, zoom: int = 14):
+    cx, cy = rng.randint(0, (1 << zoom) - 64), rng.randint(0, (1 << zoom) - 64)
+    return [f"{zoom}/{cx + rng.randint(0, 63)}/{cy + rng.randint(0, 63)}" for _ in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=1440, help="expire files, one per simulated minute")
+    parser.add_argument("--tiles-per-file", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=10000, help="page size of the queries")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="changed-tiles-bench-")
+    os.environ["CHANGED_TILES_DB"] = os.path.join(workdir, "changed.db")
+    os.environ["CHANGED_TILES_COMPACT_INTERVAL"] = str(10 ** 9)
+    from utils import changed_tiles
+
+    rng = random.Random(args.seed)
+    start_ts = time.time() - args.files * 60
+    started = time.perf_counter()
+    for i in range(args.files):
+        changed_tiles.record(_expire_file(rng, args.tiles_per_file), start_ts + i * 60)
+    ingest_s = time.perf_counter() - started
+    total = args.files * args.tiles_per_file
+    summary = changed_tiles.summary()
+    size_mb = os.path.getsize(os.environ["CHANGED_TILES_DB"]) / 1e6
+    print(f"ingest: {total} lines in {ingest_s:.2f}s ({total / ingest_s:,.0f} lines/s) "
+          f"-> {summary['tiles']} tiles, {size_mb:.1f} MB")
+
+    end_ts = start_ts + args.files * 60
+    print(f"{'window':>8} {'zoom':>5} {'rows':>7} {'p50 ms':>8} {'max ms':>8}")
+    for minutes in (10, 60, 24 * 60):
+        since = end_ts - minutes * 60
+        for zoom in (8, 12, 14):
+            rows, p50, worst = timed(lambda: changed_tiles.changed_since(since, zoom, args.limit), args.repeat)
+            print(f"{minutes:>7}m {str(zoom):>5} {len(rows):>7} {p50:>8.1f} {worst:>8.1f}")
+
+    # Page through a full day at z14 with the cursor
+    since = end_ts - 24 * 60 * 60
+    started = time.perf_counter()
+    pages, cursor, fetched = 0, None, 0
+    while True:
+        rows = changed_tiles.changed_since(since, 14, args.limit, cursor)
+        pages += 1
+        fetched += len(rows)
+        if len(rows) < args.limit:
+            break
+        cursor = rows[-1]
+    print(f"paging z14, 24h: {fetched} tiles in {pages} pages, {time.perf_counter() - started:.2f}s")
+
+    # Drop the older half
+    retention_days = args.files * 60 / 2 / 86400
+    _, compact_ms, _ = timed(lambda: changed_tiles.compact(retention_days), 1)
+    size_mb = os.path.getsize(os.environ["CHANGED_TILES_DB"]) / 1e6
+    print(f"compact: {compact_ms:.0f}ms -> {changed_tiles.summary()['tiles']} tiles, {size_mb:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Benchmark the Varnish purge pipeline: expire file -> prefixes -> BAN requests.
+
+Generates imposm-like expire files (z14 tiles along edited ways and over
+edited areas), from one minutely diff up to a mass import, or replays real
+ones with --replay. Each file is sent through ban_tile_strings and
+ban_tiles against local stub Varnish nodes that answer 200 and count the
+requests. Reports parse time, expansion time, prefix count, regex
+bytes, BAN count and peak traced memory per file, and saves the results
+as JSON so runs on different commits can be compared.
+
+    cd images/tiler-cache
+    python -m benchmarks.purge
+    python -m benchmarks.purge --mode xkey --compare benchmarks/results/<earlier>.json
+    python -m benchmarks.purge --replay expire/*.tiles --zooms 10,11,12,13,14,15,16
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks._common import PROFILES, expire_tiles, timed
+
+_RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+class _StubVarnish(BaseHTTPRequestHandler):
+    """Answers BAN/PURGE with 200 after latency seconds, counting requests."""
+
+    latency = 0.0
+    lock = threading.Lock()
+    requests = 0
+
+    def _invalidate(self):
+        with self.lock:
+            _StubVarnish.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_BAN = do_PURGE = _invalidate
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_stubs(nodes: int):
+    servers = []
+    for _ in range(nodes):
+        srv = ThreadingHTTPServer(("127.0.0.1", 0), _StubVarnish)
+        srv.daemon_threads = True
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+        servers.append(srv)
+    return servers
+
+
+def _write_expire_file(directory: str, name: str, lines):
+    path = os.path.join(directory, f"{name}.tiles")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _run_case(name: str, path: str, zoom_levels, repeat: int) -> dict:
+    import mercantile
+
+    from utils import varnish_purger as vp
+    from utils.utils import iter_expire_file_lines
+
+    def parse():
+        return [line.strip() for line in iter_expire_file_lines(path) if line.strip()]
+
+    tile_strings, parse_ms, _ = timed(parse, repeat)
+    (prefixes, invalid), expand_ms, _ = timed(lambda: vp.expand_invalidations(tile_strings, zoom_levels), repeat)
+    bans, build_ms, _ = timed(lambda: vp.build_invalidations(prefixes), repeat)
+
+    # Peak memory of one pass without the HTTP side, traced separately so it does not slow the timings
+    tracemalloc.start()
+    vp.build_invalidations(vp.expand_invalidations(parse(), zoom_levels)[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    def send(fn, *args):
+        stats = vp.BanStats()
+        before = _StubVarnish.requests
+        started = time.perf_counter()
+        ok = fn(*args, stats=stats)
+        elapsed = (time.perf_counter() - started) * 1000
+        return ok, round(elapsed, 2), stats.summary(), _StubVarnish.requests - before
+
+    ok, strings_ms, strings_stats, strings_requests = send(vp.ban_tile_strings, tile_strings, zoom_levels)
+    tiles = [mercantile.Tile(int(x), int(y), int(z)) for z, x, y in (s.split("/")[:3] for s in tile_strings)]
+    tiles_ok, tiles_ms, tiles_stats, tiles_requests = send(vp.ban_tiles, tiles)
+
+    return {
+        "case": name,
+        "tiles": len(tile_strings),
+        "invalid": len(invalid),
+        "parse_ms": round(parse_ms, 2),
+        "expand_ms": round(expand_ms, 2),
+        "build_bans_ms": round(build_ms, 2),
+        "prefixes": len(prefixes),
+        "bans": len(bans),
+        "regex_bytes": sum(len(regex) for regex, _ in bans),
+        "peak_mem_mb": round(peak / 1e6, 2),
+        "ban_tile_strings": {
+            "ok": ok,
+            "ms": strings_ms,
+            "requests": strings_requests,
+            "latency_p95_ms": strings_stats["latency_p95_ms"],
+        },
+        "ban_tiles": {
+            "ok": tiles_ok,
+            "ms": tiles_ms,
+            "bans": tiles_stats["chunks"],
+            "regex_bytes": tiles_stats["regex_bytes"],
+            "requests": tiles_requests,
+        },
+    }
+
+
+def _print_table(results, previous=None):
+    prev = {r["case"]: r for r in (previous or {}).get("cases", [])}
+    cols = ["tiles", "parse_ms", "expand_ms", "build_bans_ms", "prefixes", "bans", "regex_bytes", "peak_mem_mb"]
+    print(f"{'case':<14}" + "".join(f"{c:>14}" for c in cols) + f"{'strings ms':>12}{'tiles ms':>10}{'tiles bans':>12}")
+    for r in results:
+        row = f"{r['case']:<14}" + "".join(f"{r[c]:>14}" for c in cols)
+        print(row + f"{r['ban_tile_strings']['ms']:>12}{r['ban_tiles']['ms']:>10}{r['ban_tiles']['bans']:>12}")
+        old = prev.get(r["case"])
+        if old:
+            ratios = "".join(
+                f"{(f'x{r[c] / old[c]:.2f}' if old.get(c) else '-'):>14}" for c in cols
+            )
+            print(f"{'  vs prev':<14}" + ratios)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replay", nargs="*", default=None, help="expire files (local paths or URLs) instead of generated ones")
+    parser.add_argument("--profiles", default=",".join(p[0] for p in PROFILES), help="generated profiles to run")
+    parser.add_argument("--zooms", default=None, help="zoom levels (default ZOOM_LEVELS_TO_DELETE)")
+    parser.add_argument("--mode", choices=("url", "obj", "xkey"), default=None, help="VARNISH_BAN_MODE")
+    parser.add_argument("--planner", action="store_true", help="enable VARNISH_BAN_PLANNER")
+    parser.add_argument("--regex-max-bytes", type=int, default=None, help="VARNISH_BAN_REGEX_MAX_BYTES")
+    parser.add_argument("--nodes", type=int, default=1, help="stub Varnish nodes each BAN is sent to")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="stub Varnish response time")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help=f"result file (default {_RESULTS_DIR}/<commit>-<time>.json)")
+    parser.add_argument("--compare", default=None, help="earlier result file to print ratios against")
+    args = parser.parse_args()
+
+    _StubVarnish.latency = args.latency_ms / 1000
+    servers = _start_stubs(args.nodes)
+    # The purger reads its settings at import
+    os.environ["VARNISH_URL"] = ",".join(f"http://127.0.0.1:{s.server_address[1]}" for s in servers)
+    os.environ["VARNISH_DISCOVERY_HOST"] = ""
+    if args.mode:
+        os.environ["VARNISH_BAN_MODE"] = args.mode
+    if args.planner:
+        os.environ["VARNISH_BAN_PLANNER"] = "true"
+    if args.regex_max_bytes:
+        os.environ["VARNISH_BAN_REGEX_MAX_BYTES"] = str(args.regex_max_bytes)
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="purge-bench-metrics-"))
+    import logging
+
+    from config import Config
+    from utils import varnish_purger as vp
+
+    logging.getLogger("default_logger").setLevel(logging.WARNING)
+    zoom_levels = [int(z) for z in args.zooms.split(",")] if args.zooms else Config.ZOOM_LEVELS_TO_DELETE
+
+    workdir = tempfile.mkdtemp(prefix="purge-bench-")
+    if args.replay:
+        cases = [(os.path.basename(p), p) for p in args.replay]
+    else:
+        rng = random.Random(args.seed)
+        wanted = set(args.profiles.split(","))
+        cases = [
+            (name, _write_expire_file(workdir, name, expire_tiles(rng, n, clusters, area_share)))
+            for name, n, clusters, area_share in PROFILES
+            if name in wanted
+        ]
+
+    results = []
+    for name, path in cases:
+        results.append(_run_case(name, path, zoom_levels, args.repeat))
+        print(f"done: {name}", flush=True)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    _print_table(results, previous)
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "mode": vp.VARNISH_BAN_MODE,
+            "planner": vp.VARNISH_BAN_PLANNER,
+            "regex_max_bytes": vp.VARNISH_BAN_REGEX_MAX_BYTES,
+            "zoom_levels": zoom_levels,
+            "nodes": args.nodes,
+            "latency_ms": args.latency_ms,
+            "seed": args.seed,
+        },
+        "cases": results,
+    }
+    output = args.output or os.path.join(_RESULTS_DIR, f"{commit}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {output}")
+
+
+if __name__ == "__main__":
+    main()
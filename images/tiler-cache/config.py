@@ -6,12 +6,27 @@ class Config:
     ENVIRONMENT = os.getenv("ENVIRONMENT", "development")
     SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL", "default-queue-url")
     AWS_REGION_NAME = os.getenv("AWS_REGION_NAME", "us-east-1")
+    # Messages per receive (SQS max is 10), long-poll wait and in-flight visibility timeout
+    SQS_BATCH_SIZE = min(10, int(os.getenv("SQS_BATCH_SIZE", 10)))
+    SQS_WAIT_TIME_SECONDS = min(20, int(os.getenv("SQS_WAIT_TIME_SECONDS", 20)))
+    SQS_VISIBILITY_TIMEOUT = int(os.getenv("SQS_VISIBILITY_TIMEOUT", 120))
 
     # Zoom levels to invalidate in Varnish
     ZOOM_LEVELS_TO_DELETE = list(
         map(int, os.getenv("ZOOM_LEVELS_TO_DELETE", "10,11,12,13,14,15,16,17,18,19,20").split(","))
     )
 
+    # /clean-cache default: "bbox" or "geometry" (tiles around the edited elements,
+    # opt-in: up to CHANGESET_MAX_API_REQUESTS OSM API calls per changeset)
+    CLEAN_CACHE_MODE = os.getenv("CLEAN_CACHE_MODE", "bbox").lower()
+    # Bbox cleanups over this many tiles are coarsened to parent tiles + prefix BANs
+    CLEAN_CACHE_MAX_TILES = int(os.getenv("CLEAN_CACHE_MAX_TILES", 20000))
+    # /clean-cache stage timeouts (seconds): changeset fetch, geometry resolution
+    # (falls back to the bbox) and BAN confirmation
+    CLEAN_CACHE_FETCH_TIMEOUT = float(os.getenv("CLEAN_CACHE_FETCH_TIMEOUT", 30))
+    CLEAN_CACHE_GEOMETRY_TIMEOUT = float(os.getenv("CLEAN_CACHE_GEOMETRY_TIMEOUT", 60))
+    CLEAN_CACHE_BAN_TIMEOUT = float(os.getenv("CLEAN_CACHE_BAN_TIMEOUT", 60))
+
     # PostgreSQL Database Settings
     POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
     POSTGRES_PORT = int(os.getenv("POSTGRES_PORT", 5432))
@@ -21,3 +36,14 @@ class Config:
 
     # Delayed cleanup toggle (scheduled BAN retries via SQS)
     ENABLE_DELAYED_CLEANUP = os.getenv("ENABLE_DELAYED_CLEANUP", "true").lower() == "true"
+
+    # Cleanup worker pool: concurrent cleanups and queued jobs before SQS polling pauses
+    CLEANUP_WORKERS = int(os.getenv("CLEANUP_WORKERS", 4))
+    CLEANUP_QUEUE_SIZE = int(os.getenv("CLEANUP_QUEUE_SIZE", 50))
+
+    # Coalescing window: expire files of the same cleanup type arriving within
+    # this many seconds (or until COALESCE_MAX_FILES) share one deduplicated BAN set
+    COALESCE_WINDOW_SECONDS = float(os.getenv("COALESCE_WINDOW_SECONDS", 30))
+    COALESCE_MAX_FILES = int(os.getenv("COALESCE_MAX_FILES", 20))
+    # Prefixes remembered from immediate passes so delayed passes can skip re-banned ones
+    COALESCE_LEDGER_MAX_PREFIXES = int(os.getenv("COALESCE_LEDGER_MAX_PREFIXES", 500000))
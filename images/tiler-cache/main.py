@@ -2,50 +2,64 @@
 
 import os
 import sys
+import asyncio
+import datetime
 import threading
-import requests
 import xml.etree.ElementTree as ET
-import mercantile
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse
+import httpx
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, Field
 from config import Config
+from utils import metrics
 from utils.utils import get_logger
-from utils.varnish_purger import ban_tiles
+from utils.varnish_purger import VARNISH_BAN_MODE, AsyncPrefixBanStream, BanStats, close_async_client
+from utils.bbox_tiles import ban_bbox
+from utils.changeset_geometry import (
+    CHANGESET_COVER_ZOOM,
+    GeometryUnavailable,
+    choose_cover_zoom,
+    fetch_changeset_geometry,
+    iter_cover_tiles,
+)
+from utils.popularity import POPULARITY_LOG, POPULARITY_SNAPSHOT, get_shared_tracker
+from utils import bulk_cleanup, changed_tiles, osm_api
 
 app = FastAPI()
 logger = get_logger()
 
 
-def fetch_changeset(changeset_id: int, api_base_url: str = "https://www.openhistoricalmap.org") -> dict:
+async def fetch_changeset(changeset_id: int, api_base_url: str = "https://www.openhistoricalmap.org") -> dict:
     """Fetches the changeset from the API and extracts the bbox."""
     try:
-        response = requests.get(f"{api_base_url}/api/0.6/changeset/{changeset_id}", timeout=30)
-        response.raise_for_status()
-        cs = ET.fromstring(response.content).find('changeset')
-        if cs is None:
-            raise HTTPException(status_code=404, detail=f"Changeset {changeset_id} not found")
-        bbox = {
-            'min_lon': float(cs.get('min_lon')),
-            'min_lat': float(cs.get('min_lat')),
-            'max_lon': float(cs.get('max_lon')),
-            'max_lat': float(cs.get('max_lat'))
-        }
-        if None in bbox.values():
-            raise HTTPException(status_code=400, detail=f"Changeset {changeset_id} does not have a valid bbox")
-        return bbox
-    except requests.RequestException as e:
+        bbox = await osm_api.fetch_changeset_bbox(changeset_id, api_base_url)
+    except osm_api.ChangesetNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Error fetching changeset: {str(e)}")
     except (ET.ParseError, ValueError) as e:
         raise HTTPException(status_code=500, detail=f"Error parsing changeset: {str(e)}")
+    if bbox is None:
+        raise HTTPException(status_code=400, detail=f"Changeset {changeset_id} does not have a valid bbox")
+    return bbox
 
 
-def get_tiles_in_bbox(bbox: dict, zoom_levels: List[int]) -> List[mercantile.Tile]:
-    """Calculates all tiles that intersect with the bbox for the specified zoom levels."""
-    tiles = []
-    for zoom in zoom_levels:
-        tiles.extend(mercantile.tiles(bbox['min_lon'], bbox['min_lat'], bbox['max_lon'], bbox['max_lat'], zooms=zoom))
-    return tiles
+async def run_until_disconnect(request: Request, coro, poll: float = 0.5):
+    """Await coro, cancelling it (and the BANs it has in flight) if the client goes away first."""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                logger.warning(f"Client disconnected; cancelled {request.url.path}?{request.url.query}")
+                raise HTTPException(status_code=499, detail="Client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
 
 
 def terminate_process_after_delay(delay=1):
@@ -95,32 +109,185 @@ def health():
     return response_data
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus metrics of the SQS processor and this API (SQS, expire files, cleanup queue, BANs per node)."""
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+
+@app.get("/popularity")
+def popularity(
+    limit: int = Query(100, ge=1, le=5000, description="Number of hottest tiles to return"),
+    zoom: Optional[int] = Query(None, ge=0, le=22, description="Only tiles of this zoom"),
+    tile: Optional[str] = Query(None, description="Also return the estimate for one tile (z/x/y)")
+):
+    """Hottest tiles from the Varnish access log, with decayed hit counts.
+
+    Served from the snapshot the SQS processor (the only log reader) writes.
+    """
+    if not POPULARITY_LOG:
+        raise HTTPException(status_code=404, detail="Popularity tracking is disabled (POPULARITY_LOG not set)")
+    tracker = get_shared_tracker()
+    if tracker is None:
+        raise HTTPException(status_code=503, detail=f"No popularity snapshot yet ({POPULARITY_SNAPSHOT})")
+    response = {
+        "summary": tracker.summary(),
+        "top": [{"tile": key, "hits": hits} for key, hits in tracker.top(limit, zoom)],
+    }
+    if tile:
+        response["tile"] = {"tile": tile, "hits": round(tracker.estimate(tile), 3)}
+    return response
+
+
+def parse_since(since: str) -> float:
+    """Accept a Unix timestamp or an ISO 8601 datetime (UTC if no offset)."""
+    try:
+        return float(since)
+    except ValueError:
+        pass
+    try:
+        dt = datetime.datetime.fromisoformat(since.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid since: {since}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt.timestamp()
+
+
+@app.get("/tiles/changed")
+def tiles_changed(
+    since: str = Query(..., description="Unix timestamp or ISO 8601 datetime"),
+    zoom: Optional[int] = Query(None, ge=0, le=22, description="Zoom of the tiles returned (default: the expire zoom)"),
+    limit: int = Query(10000, ge=1, le=100000, description="Max tiles per page"),
+    cursor: Optional[str] = Query(None, description="next_cursor of the previous page")
+):
+    """Tiles invalidated since a point in time, oldest change first, paginated."""
+    after = None
+    if cursor:
+        try:
+            z, x, y, t = cursor.split(":")
+            after = (int(z), int(x), int(y), float(t))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid cursor: {cursor}")
+    since_ts = parse_since(since)
+    zoom = changed_tiles.CHANGED_TILES_MAX_ZOOM if zoom is None else min(zoom, changed_tiles.CHANGED_TILES_MAX_ZOOM)
+    rows = changed_tiles.changed_since(since_ts, zoom, limit, after)
+    next_cursor = ":".join(str(v) for v in rows[-1]) if len(rows) == limit else None
+    return {
+        "since": since_ts,
+        "zoom": zoom,
+        "count": len(rows),
+        "tiles": [{"z": z, "x": x, "y": y, "changed_at": t} for z, x, y, t in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+def parse_zoom_levels(zoom_levels: Optional[str]) -> List[int]:
+    """Comma-separated zooms (max 20), or ZOOM_LEVELS_TO_DELETE when empty."""
+    if zoom_levels:
+        try:
+            zoom_list = [int(z.strip()) for z in zoom_levels.split(',')]
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid zoom_levels: {zoom_levels}")
+        if min(zoom_list) < 0:
+            raise HTTPException(status_code=400, detail="Zoom level cannot be negative")
+        if max(zoom_list) > 20:
+            raise HTTPException(status_code=400, detail="Zoom level cannot exceed 20")
+        return [z for z in zoom_list if z <= 20]
+    return [z for z in Config.ZOOM_LEVELS_TO_DELETE if z <= 20]
+
+
+def check_soft(soft: Optional[bool]) -> None:
+    """Refuse soft=true outside xkey mode, where bans can only be hard."""
+    if soft and VARNISH_BAN_MODE != "xkey":
+        raise HTTPException(
+            status_code=400, detail=f"soft=true needs VARNISH_BAN_MODE=xkey (current: {VARNISH_BAN_MODE})"
+        )
+
+
 @app.get("/clean-cache")
-def clean_cache_by_changeset(
+async def clean_cache_by_changeset(
+    request: Request,
     changeset_id: int = Query(..., description="OpenHistoricalMap changeset ID"),
     zoom_levels: Optional[str] = Query("16,17,18,19,20", description="Zoom levels separated by comma (e.g., 18,19,20)"),
-    api_base_url: str = Query("https://www.openhistoricalmap.org", description="OpenHistoricalMap API base URL")
+    api_base_url: str = Query("https://www.openhistoricalmap.org", description="OpenHistoricalMap API base URL"),
+    soft: Optional[bool] = Query(None, description="Soft purge: keep stale copies in grace while they refresh (xkey mode; default VARNISH_SOFT_PURGE)"),
+    mode: Optional[str] = Query(None, description="geometry (tiles around the edited elements, bbox fallback) or bbox (default CLEAN_CACHE_MODE)")
 ):
-    """Invalidates tiles in Varnish for the bbox of the given changeset."""
-    try:
-        if zoom_levels:
-            zoom_list = [int(z.strip()) for z in zoom_levels.split(',')]
-            if max(zoom_list) > 20:
-                raise HTTPException(status_code=400, detail="Zoom level cannot exceed 20")
-            zoom_list = [z for z in zoom_list if z <= 20]
-        else:
-            zoom_list = [z for z in Config.ZOOM_LEVELS_TO_DELETE if z <= 20]
+    """Invalidates tiles in Varnish for the given changeset.
 
-        bbox = fetch_changeset(changeset_id, api_base_url)
-        tiles = get_tiles_in_bbox(bbox, zoom_list)
+    In geometry mode only the tiles around the elements the changeset touched
+    are banned, streamed as prefix BANs; if they cannot be resolved the
+    changeset bbox is used, as in bbox mode. Each stage (changeset fetch,
+    geometry, BANs) has its own timeout, and the whole cleanup is cancelled
+    if the client disconnects.
+    """
+    mode = (mode or Config.CLEAN_CACHE_MODE).lower()
+    if mode not in ("geometry", "bbox"):
+        raise HTTPException(status_code=400, detail=f"Invalid mode: {mode}")
+    check_soft(soft)
+    zoom_list = parse_zoom_levels(zoom_levels)
+    return await run_until_disconnect(request, clean_changeset(changeset_id, zoom_list, api_base_url, soft, mode))
 
-        if not tiles:
-            return {"success": True, "tiles_count": 0}
 
+async def clean_changeset(changeset_id: int, zoom_list: List[int], api_base_url: str, soft: Optional[bool], mode: str) -> dict:
+    """The /clean-cache pipeline: geometry coverage if requested and available, else the bbox plan."""
+    try:
+        stats = BanStats()
+        fallback = None
+        if mode == "geometry":
+            try:
+                geometry = await asyncio.wait_for(
+                    fetch_changeset_geometry(changeset_id, api_base_url), Config.CLEAN_CACHE_GEOMETRY_TIMEOUT
+                )
+                # Estimates scan every geometry once per zoom; keep the event loop free
+                cover_zoom = await asyncio.to_thread(
+                    choose_cover_zoom, geometry, min(max(zoom_list), CHANGESET_COVER_ZOOM), zoom_levels=zoom_list
+                )
+            except (GeometryUnavailable, asyncio.TimeoutError) as e:
+                fallback = str(e) or f"geometry timed out after {Config.CLEAN_CACHE_GEOMETRY_TIMEOUT:g}s"
+                logger.warning(f"[changeset {changeset_id}] Geometry unavailable ({fallback}); using bbox")
+            else:
+                stream = AsyncPrefixBanStream(zoom_list, stats, soft=soft)
+                # Coverage and prefix expansion block; keep the event loop free
+                try:
+                    await asyncio.to_thread(stream.feed, iter_cover_tiles(geometry, cover_zoom))
+                except asyncio.CancelledError:
+                    stream.cancel()
+                    raise
+                ban_ok = await _ban_stage(stream.aclose())
+                stats.log_summary(f"[changeset {changeset_id}][geometry z{cover_zoom}]")
+                return {
+                    "success": True,
+                    "mode": "geometry",
+                    "elements": geometry.elements,
+                    "api_requests": geometry.api_requests,
+                    "cover_zoom": cover_zoom,
+                    "tiles_count": stream.lines,
+                    "varnish_ban_ok": ban_ok,
+                    "varnish_ban_stats": stats.summary(),
+                }
+
+        try:
+            bbox = await asyncio.wait_for(fetch_changeset(changeset_id, api_base_url), Config.CLEAN_CACHE_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=f"Timed out fetching changeset {changeset_id}")
+        ban_ok, plan = await _ban_stage(ban_bbox(bbox, zoom_list, stats, soft=soft))
+        if plan["strategy"] == "refused":
+            raise HTTPException(
+                status_code=413,
+                detail=f"Changeset {changeset_id} bbox needs {plan['keys']} xkey purges "
+                f"(CLEAN_CACHE_MAX_TILES={plan['max_tiles']}); nothing sent, TTL is fallback",
+            )
+        stats.log_summary(f"[changeset {changeset_id}][bbox {plan['strategy']}]")
         return {
             "success": True,
-            "tiles_count": len(tiles),
-            "varnish_ban_ok": ban_tiles(tiles),
+            "mode": "bbox",
+            "fallback_reason": fallback,
+            "tiles_count": plan["estimated_tiles"],
+            "plan": plan,
+            "varnish_ban_ok": ban_ok,
+            "varnish_ban_stats": stats.summary(),
         }
 
     except HTTPException:
@@ -130,6 +297,63 @@ def clean_cache_by_changeset(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+async def _ban_stage(coro):
+    try:
+        return await asyncio.wait_for(coro, Config.CLEAN_CACHE_BAN_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=504,
+            detail=f"BANs not confirmed within {Config.CLEAN_CACHE_BAN_TIMEOUT:g}s (TTL is fallback)",
+        )
+
+
+class BulkCleanRequest(BaseModel):
+    changeset_ids: List[int] = Field(default_factory=list, description="OpenHistoricalMap changeset IDs")
+    from_id: Optional[int] = Field(None, description="First changeset ID of a range (inclusive)")
+    to_id: Optional[int] = Field(None, description="Last changeset ID of a range (inclusive)")
+    zoom_levels: Optional[str] = Field("16,17,18,19,20", description="Zoom levels separated by comma")
+    api_base_url: str = Field("https://www.openhistoricalmap.org", description="OpenHistoricalMap API base URL")
+    soft: Optional[bool] = Field(None, description="Soft purge (xkey mode; default VARNISH_SOFT_PURGE)")
+
+
+@app.post("/clean-cache/bulk", status_code=202)
+async def clean_cache_bulk(request: BulkCleanRequest):
+    """Start one deduplicated cleanup for many changesets; poll /clean-cache/bulk/{job_id} for progress."""
+    ids = set(request.changeset_ids)
+    if (request.from_id is None) != (request.to_id is None):
+        raise HTTPException(status_code=400, detail="from_id and to_id go together")
+    if request.from_id is not None:
+        if request.to_id < request.from_id:
+            raise HTTPException(status_code=400, detail="to_id must be >= from_id")
+        if request.to_id - request.from_id + 1 > bulk_cleanup.BULK_MAX_CHANGESETS:
+            raise HTTPException(status_code=400, detail=f"At most {bulk_cleanup.BULK_MAX_CHANGESETS} changesets per job")
+        ids.update(range(request.from_id, request.to_id + 1))
+    if not ids:
+        raise HTTPException(status_code=400, detail="No changesets given")
+    if len(ids) > bulk_cleanup.BULK_MAX_CHANGESETS:
+        raise HTTPException(status_code=400, detail=f"At most {bulk_cleanup.BULK_MAX_CHANGESETS} changesets per job")
+    check_soft(request.soft)
+    zoom_list = parse_zoom_levels(request.zoom_levels)
+    job = bulk_cleanup.start_job(sorted(ids), zoom_list, request.api_base_url, request.soft)
+    logger.info(f"[BULK {job.id}] Started for {len(ids)} changesets, zooms {zoom_list}")
+    return {"job_id": job.id, "changesets": len(ids), "status_url": f"/clean-cache/bulk/{job.id}"}
+
+
+@app.get("/clean-cache/bulk/{job_id}")
+def clean_cache_bulk_status(job_id: str):
+    """Progress of a bulk cleanup job."""
+    job = bulk_cleanup.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job.to_dict()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await osm_api.close_client()
+    await close_async_client()
+
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
@@ -2,19 +2,48 @@ import boto3
 import time
 import os
 import json
-import threading
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from tiler_cache_cleaner.utils.files import get_list_expired_tiles
 from config import Config
-from utils.utils import (check_tiler_db_postgres_status, get_logger, s3_path_to_url)
-from utils.varnish_purger import ban_tile_strings
+from utils.metrics import (
+    EXPIRE_FILE_PREFIXES,
+    EXPIRE_FILE_TILES,
+    INVALIDATION_LAG_SECONDS,
+    SQS_IN_FLIGHT,
+    SQS_MESSAGE_AGE_SECONDS,
+    SQS_MESSAGES,
+    SQS_RECEIVE_SECONDS,
+    timed_lines,
+)
+from utils.utils import (get_logger, iter_expire_file_lines, s3_path_to_url)
+from utils.varnish_purger import BanLedger, BanStats, PrefixBanStream
+from utils.coalescer import CleanupCoalescer
+from utils.cache_warmer import CACHE_WARM_ENABLED, CacheWarmer, WarmPlan
+from utils.popularity import get_tracker
+from utils.cleanup_pool import PRIORITY_DELAYED, PRIORITY_IMMEDIATE, CleanupWorkerPool
+from utils.sqs_inflight import InFlightMessages
+from utils.db_health import POSTGRES_DOWN_EXIT_SECONDS, POSTGRES_PROBE_INTERVAL, HealthWatcher, get_probe
+from utils import ban_audit, changed_tiles, delay_scheduler, event_dedup
 
 logger = get_logger()
 
 # Initialize SQS Client
 sqs = boto3.client("sqs", region_name=Config.AWS_REGION_NAME)
 
+# Bounded pool running the Varnish cleanups
+cleanup_pool = CleanupWorkerPool(Config.CLEANUP_WORKERS, Config.CLEANUP_QUEUE_SIZE)
+
+# Re-requests invalidated hot tiles after each cleanup, hottest first when
+# the access log is followed
+cache_warmer = CacheWarmer() if CACHE_WARM_ENABLED else None
+# Only this process reads POPULARITY_LOG (started here, before any message);
+# the API serves /popularity from the snapshots it writes
+popularity_tracker = get_tracker()
+if cache_warmer is not None and popularity_tracker is not None:
+    cache_warmer.popularity = popularity_tracker.score
+
 # Heartbeat file path for health checks
 HEARTBEAT_FILE = "/tmp/sqs_processor_heartbeat"
 HEARTBEAT_TIMEOUT_SECONDS = 60
@@ -29,54 +58,105 @@ def update_heartbeat():
         logger.warning(f"Failed to update heartbeat file: {e}")
 
 
-def check_postgres_with_retries(max_retries=3, retry_delay=5):
-    """
-    Check PostgreSQL database status with retry logic.
-
-    Args:
-        max_retries (int): Maximum number of retry attempts (default: 3)
-        retry_delay (int): Delay in seconds between retries (default: 5)
+def cleanup_varnish(s3_imposm3_exp_paths, zoom_levels, cleanup_type="immediate", event_times=None):
+    """Stream the expire files and send BAN(s) to Varnish as expanded prefixes accumulate.
 
-    Returns:
-        bool: True if PostgreSQL is available, False otherwise
+    All files share one prefix set, so a prefix present in several of them is
+    banned once. event_times holds each file's event time (default: now).
+    Immediate passes record each file's prefixes in the ban ledger under
+    that file's time; delayed passes skip a file's prefixes banned for an
+    event newer than the file's own.
+    Immediate passes also record the expire tiles in the changed-tile index.
+    Once the BANs are done the expire tiles are queued for cache warming,
+    and with BAN_AUDIT immediate passes are audited for over-invalidation.
     """
-    for attempt in range(max_retries):
-        if check_tiler_db_postgres_status():
-            return True
-        else:
-            if attempt < max_retries - 1:
-                logger.warning(f"PostgreSQL database is down. Retrying in {retry_delay} seconds... (attempt {attempt + 1}/{max_retries})")
-                time.sleep(retry_delay)
-            else:
-                logger.error("PostgreSQL database is down after all retries.")
-
-    return False
-
-
-def cleanup_varnish(s3_imposm3_exp_path, zoom_levels, cleanup_type="immediate"):
-    """Read the expire file and send BAN(s) to Varnish for the expanded tiles."""
-    file_name = os.path.basename(s3_imposm3_exp_path)
-    logger.info(f"[{cleanup_type.upper()}][varnish] {file_name} | zooms={min(zoom_levels)}-{max(zoom_levels)}")
+    label = f"[{cleanup_type.upper()}][varnish] {_describe_paths(s3_imposm3_exp_paths)}"
+    logger.info(f"{label} | zooms={min(zoom_levels)}-{max(zoom_levels)}")
+    stats = BanStats()
+    event_times = event_times or [time.time()] * len(s3_imposm3_exp_paths)
+    warm_plan = WarmPlan() if cache_warmer is not None else None
+    stream = PrefixBanStream(
+        zoom_levels,
+        stats,
+        ledger=ban_ledger if Config.ENABLE_DELAYED_CLEANUP else None,
+        delayed=cleanup_type != "immediate",
+        warm_plan=warm_plan,
+    )
+    audit = ban_audit.BatchAudit() if ban_audit.BAN_AUDIT and cleanup_type == "immediate" else None
     try:
-        expired_file_url = s3_path_to_url(s3_imposm3_exp_path)
-        chunks = get_list_expired_tiles(expired_file_url)
-        for chunk in chunks:
-            ban_tile_strings(chunk, zoom_levels)
+        for s3_imposm3_exp_path, event_time in zip(s3_imposm3_exp_paths, event_times):
+            tiles_before, prefixes_before = stream.lines, len(stream.seen)
+            lines = timed_lines(iter_expire_file_lines(s3_path_to_url(s3_imposm3_exp_path)))
+            if cleanup_type == "immediate":
+                lines = changed_tiles.tap(lines, event_time)
+            if audit is not None:
+                lines = audit.tap(lines)
+            stream.feed(lines, event_time=event_time)
+            EXPIRE_FILE_TILES.observe(stream.lines - tiles_before)
+            EXPIRE_FILE_PREFIXES.observe(len(stream.seen) - prefixes_before)
+        if not stream.close():
+            # Fails the job: the SQS message is redelivered, a delayed job retried
+            raise RuntimeError(f"Varnish BANs failed on {stats.summary()['failed']} node request(s)")
+        if cleanup_type == "immediate":
+            INVALIDATION_LAG_SECONDS.observe(time.time() - max(event_times))
+        if warm_plan is not None:
+            cache_warmer.submit(warm_plan, label)
+        if audit is not None:
+            audit.run(stream.seen, zoom_levels, label)
     except Exception as e:
-        logger.exception(f"[{cleanup_type.upper()}][varnish] Error: {file_name}")
+        logger.exception(f"{label} Error")
         raise
+    finally:
+        stats.log_summary(label)
 
 
-def execute_cleanup(s3_imposm3_exp_path, cleanup_type):
-    """Run Varnish BAN cleanup for the given expire file in a background thread."""
-    threading.Thread(
-        target=cleanup_varnish,
-        args=(s3_imposm3_exp_path, Config.ZOOM_LEVELS_TO_DELETE, cleanup_type),
-    ).start()
+def _describe_paths(s3_paths):
+    names = [os.path.basename(p) for p in s3_paths]
+    return names[0] if len(names) == 1 else f"{names[0]} .. {names[-1]} ({len(names)} files)"
+
+
+def execute_cleanup(s3_imposm3_exp_paths, cleanup_type, event_times=None):
+    """Queue a Varnish BAN cleanup for the given expire files on the worker pool.
+
+    Immediate cleanups run before delayed ones. Blocks while the queue is full.
+    Returns the job's Future.
+    """
+    priority = PRIORITY_IMMEDIATE if cleanup_type == "immediate" else PRIORITY_DELAYED
+    return cleanup_pool.submit(
+        cleanup_varnish,
+        s3_imposm3_exp_paths,
+        Config.ZOOM_LEVELS_TO_DELETE,
+        cleanup_type,
+        event_times,
+        priority=priority,
+        label=f"[{cleanup_type.upper()}] {_describe_paths(s3_imposm3_exp_paths)}",
+    )
+
+
+# Merges expire files of the same cleanup type arriving within the window
+coalescer = CleanupCoalescer(execute_cleanup, Config.COALESCE_WINDOW_SECONDS, Config.COALESCE_MAX_FILES)
 
 
-# SQS max delay is 15 minutes (900 seconds)
-SQS_MAX_DELAY_SECONDS = 900
+def submit_cleanup(s3_imposm3_exp_path, cleanup_type, event_time=None):
+    """Add an expire file to the coalescing window of its cleanup type. Returns a Future."""
+    event_time = time.time() if event_time is None else event_time
+    return coalescer.add(cleanup_type, s3_imposm3_exp_path, event_time)
+
+
+def finish_event(future, object_key, etag, s3_imposm3_exp_path, event_time):
+    """After the immediate cleanup: mark the event done and schedule its delayed passes on success.
+
+    On failure the claim is released and the message stays on the queue, so
+    the redelivery runs the event again, delayed passes included.
+    """
+    if future.cancelled() or future.exception() is not None:
+        logger.warning(f"[DEDUP] Cleanup of {object_key} failed; releasing its claim")
+        event_dedup.release(object_key, etag)
+        return
+    event_dedup.complete(object_key, etag)
+    if Config.ENABLE_DELAYED_CLEANUP:
+        schedule_delayed_cleanups(s3_imposm3_exp_path, event_time)
+
 
 # Delayed cleanup configurations: (action_name, delay_seconds)
 # To add a new delay, just add a tuple here
@@ -88,148 +168,177 @@ DELAYED_CLEANUPS = [
     # ("delayed_cleanup_24hour", 86400),  # 24 hour
 ]
 
+# Prefixes banned by immediate passes, kept until the last delayed pass is due
+ban_ledger = BanLedger(
+    max_age=max(delay for _, delay in DELAYED_CLEANUPS) + 2 * Config.COALESCE_WINDOW_SECONDS,
+    max_size=Config.COALESCE_LEDGER_MAX_PREFIXES,
+)
+
 
-def process_delayed_cleanup(body, sent_time, action_name, required_delay_seconds):
+def schedule_delayed_cleanups(s3_imposm3_exp_path, event_time=None):
     """
-    Process a delayed cleanup message if enough time has elapsed.
+    Schedule all delayed cleanups in the local delay scheduler.
+
+    Args:
+        s3_imposm3_exp_path (str): S3 path to the imposm3 expiration file
+        event_time (float): Unix time the delays count from (default: now)
+    """
+    event_time = time.time() if event_time is None else event_time
+
+    for action_name, delay_seconds in DELAYED_CLEANUPS:
+        cleanup_type = action_name.replace("delayed_cleanup_", "delayed_")
+        delay_scheduler.schedule(s3_imposm3_exp_path, cleanup_type, event_time, delay_seconds)
+
+    scheduled_names = [name for name, _ in DELAYED_CLEANUPS]
+    logger.info(f"[SCHEDULED] {os.path.basename(s3_imposm3_exp_path)} -> {', '.join(scheduled_names)}")
+
+
+def adopt_delayed_message(body, sent_time, action_name, delay_seconds):
+    """
+    Move a delayed cleanup message sent by an older version into the local scheduler.
 
     Args:
         body (dict): Parsed message body
         sent_time (datetime): When the message was originally sent
         action_name (str): The action name (e.g., "delayed_cleanup_15min")
-        required_delay_seconds (int): Required delay before processing
-
-    Returns:
-        bool: True if cleanup was executed, False if skipped (not enough time elapsed)
+        delay_seconds (int): Delay counted from the original event
     """
-    now = datetime.datetime.utcnow()
-
     # Use timestamp from message body if available, otherwise use sent_time
-    message_timestamp = body.get("timestamp")
-    if message_timestamp:
-        message_time = datetime.datetime.utcfromtimestamp(message_timestamp)
-        elapsed_seconds = (now - message_time).total_seconds()
-    else:
-        elapsed_seconds = (now - sent_time).total_seconds()
-
-    if elapsed_seconds < required_delay_seconds:
-        logger.info(f"[{action_name}] Skipping: {int(elapsed_seconds)}s/{required_delay_seconds}s elapsed")
-        return False
-
-    s3_imposm3_exp_path = body["s3_path"]
+    event_time = body.get("timestamp") or sent_time.replace(tzinfo=datetime.timezone.utc).timestamp()
     cleanup_type = action_name.replace("delayed_cleanup_", "delayed_")
-    execute_cleanup(s3_imposm3_exp_path, cleanup_type)
-    return True
+    delay_scheduler.schedule(body["s3_path"], cleanup_type, event_time, delay_seconds)
+    logger.info(f"[{action_name}] Moved to local scheduler: {os.path.basename(body['s3_path'])}")
 
 
-def schedule_delayed_cleanups(s3_imposm3_exp_path):
-    """
-    Schedule all delayed cleanup messages.
+def handle_message(message, inflight):
+    """Process one SQS message and decide when it is deleted.
 
-    Args:
-        s3_imposm3_exp_path (str): S3 path to the imposm3 expiration file
+    S3 events are deleted once their immediate cleanup job succeeds and
+    left to be redelivered when it fails;
+    repeats of an event already claimed in the dedup store, and anything
+    else, including delayed cleanup messages from older versions (moved
+    into the local scheduler), are deleted right away.
     """
-    current_timestamp = int(datetime.datetime.utcnow().timestamp())
-
-    for action_name, delay_seconds in DELAYED_CLEANUPS:
-        message_body = {
-            "action": action_name,
-            "s3_path": s3_imposm3_exp_path,
-            "timestamp": current_timestamp
-        }
-
-        sqs.send_message(
-            QueueUrl=Config.SQS_QUEUE_URL,
-            MessageBody=json.dumps(message_body),
-            DelaySeconds=min(delay_seconds, SQS_MAX_DELAY_SECONDS)
-        )
+    sent_timestamp_ms = int(message["Attributes"]["SentTimestamp"])
+    sent_time = datetime.datetime.utcfromtimestamp(sent_timestamp_ms / 1000)
+    SQS_MESSAGE_AGE_SECONDS.observe(max(0.0, time.time() - sent_timestamp_ms / 1000))
+    msg_id_short = message['MessageId'][:8]
+    logger.info(f"============= msg:{msg_id_short} | sent:{sent_time.strftime('%Y-%m-%d %H:%M')} UTC =============")
+    try:
+        # Parse the SQS message
+        body = json.loads(message["Body"])
+
+        # Delayed cleanup messages queued through SQS by older versions
+        for action_name, delay_seconds in DELAYED_CLEANUPS:
+            if body.get("action") == action_name:
+                adopt_delayed_message(body, sent_time, action_name, delay_seconds)
+                SQS_MESSAGES.labels("delayed").inc()
+                inflight.ack(message)
+                return
+
+        if "Records" in body and body["Records"][0]["eventSource"] == "aws:s3":
+            record = body["Records"][0]
+            eventTime = record["eventTime"]
+            bucket_name = record["s3"]["bucket"]["name"]
+            object_key = record["s3"]["object"]["key"]
+            s3_imposm3_exp_path = f"s3://{bucket_name}/{object_key}"
+            etag = record["s3"]["object"].get("eTag", "")
+
+            # Same object and ETag seen before: its cleanups already ran or are running
+            if not event_dedup.claim(object_key, etag):
+                logger.info(f"[DEDUP] {s3_imposm3_exp_path} already handled; skipping")
+                SQS_MESSAGES.labels("duplicate").inc()
+                inflight.ack(message)
+                return
+
+            # Immediate cleanup
+            now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            logger.info(f"[S3 FILE] {s3_imposm3_exp_path} | created:{eventTime} | cleaning:{now} UTC")
+            event_time = time.time()
+            future = submit_cleanup(s3_imposm3_exp_path, "immediate", event_time)
+            # Delayed passes are scheduled once the immediate one succeeded
+            future.add_done_callback(lambda f: finish_event(f, object_key, etag, s3_imposm3_exp_path, event_time))
+
+            SQS_MESSAGES.labels("s3_event").inc()
+            inflight.track(message, future)
+            return
+
+        # Unknown message: delete it
+        SQS_MESSAGES.labels("other").inc()
+        inflight.ack(message)
 
-    scheduled_names = [name for name, _ in DELAYED_CLEANUPS]
-    logger.info(f"[SCHEDULED] {os.path.basename(s3_imposm3_exp_path)} -> {', '.join(scheduled_names)}")
+    except Exception as e:
+        SQS_MESSAGES.labels("error").inc()
+        logger.error(f"Error processing message msg:{msg_id_short}: {e}")
 
 
 def process_sqs_messages():
-    """Unified function to process SQS messages and create jobs based on infrastructure."""
+    """Unified function to process SQS messages and create jobs based on infrastructure.
+
+    Receives batches with long polling only, handles each batch concurrently
+    and deletes finished messages with delete_message_batch.
+    """
     # Initialize heartbeat file
     update_heartbeat()
 
+    # Events a previous process did not finish run again when SQS redelivers them
+    released = event_dedup.release_processing()
+    if released:
+        logger.info(f"[DEDUP] Released {released} unfinished event(s) from a previous run")
+
+    inflight = InFlightMessages(sqs, Config.SQS_QUEUE_URL, Config.SQS_VISIBILITY_TIMEOUT)
+    threading.Thread(
+        target=delay_scheduler.run,
+        args=(submit_cleanup, Config.CLEANUP_QUEUE_SIZE),
+        name="delay-scheduler",
+        daemon=True,
+    ).start()
+    handlers = ThreadPoolExecutor(max_workers=Config.SQS_BATCH_SIZE, thread_name_prefix="sqs-msg")
+    db_watcher = HealthWatcher(get_probe()).start()
+
     while True:
         # Update heartbeat at the start of each iteration
         update_heartbeat()
 
-        logger.debug("Polling SQS...")
-        response = sqs.receive_message(
-            QueueUrl=Config.SQS_QUEUE_URL,
-            MaxNumberOfMessages=1,
-            WaitTimeSeconds=10,
-            AttributeNames=["All"],
-            MessageAttributeNames=["All"],
-        )
+        # Only consume while the tiler DB answers; the watcher probes in the background
+        if not db_watcher.healthy:
+            if db_watcher.down_for() > POSTGRES_DOWN_EXIT_SECONDS:
+                logger.error(
+                    f"PostgreSQL database down for {db_watcher.down_for():.0f}s. "
+                    "Terminating process to trigger container restart."
+                )
+                # This will stop the heartbeat updates, causing the health check to fail
+                os._exit(1)
+            logger.warning(f"[DB] PostgreSQL database is down ({db_watcher.probe.error}); pausing SQS polling")
+            inflight.flush()
+            db_watcher.wait_healthy(timeout=POSTGRES_PROBE_INTERVAL)
+            continue
 
-        messages = response.get("Messages", [])
-        if not messages:
-            time.sleep(5)
+        # Backpressure: don't take new messages while the cleanup queue is full
+        if not cleanup_pool.wait_for_capacity(timeout=20):
+            logger.warning(f"[POOL] Cleanup queue full ({cleanup_pool.depth()} jobs); pausing SQS polling")
+            inflight.flush()
             continue
 
-        for message in messages:
-            sent_timestamp_ms = int(message["Attributes"]["SentTimestamp"])
-            sent_time = datetime.datetime.utcfromtimestamp(sent_timestamp_ms / 1000)
-            msg_id_short = message['MessageId'][:8]
-            logger.info("=="*40)
-            logger.info(f"============= msg:{msg_id_short} | sent:{sent_time.strftime('%Y-%m-%d %H:%M')} UTC =============")
-            try:
-                # Check PostgreSQL status with retry logic
-                if not check_postgres_with_retries():
-                    logger.error("PostgreSQL database is down after all retries. Terminating process to trigger container restart.")
-                    # Terminate the process so the container can be restarted
-                    # This will stop the heartbeat updates, causing the health check to fail
-                    os._exit(1)
-
-                # Parse the SQS message
-                body = json.loads(message["Body"])
-
-                # Process delayed cleanup messages
-                is_delayed_message = False
-                should_skip_delete = False
-                for action_name, delay_seconds in DELAYED_CLEANUPS:
-                    if body.get("action") == action_name:
-                        is_delayed_message = True
-                        if not process_delayed_cleanup(body, sent_time, action_name, delay_seconds):
-                            should_skip_delete = True
-                        break
-
-                # Skip deleting message if it's not ready yet
-                if should_skip_delete:
-                    continue
-
-                if not is_delayed_message and "Records" in body and body["Records"][0]["eventSource"] == "aws:s3":
-                    record = body["Records"][0]
-                    eventTime = record["eventTime"]
-                    bucket_name = record["s3"]["bucket"]["name"]
-                    object_key = record["s3"]["object"]["key"]
-                    s3_imposm3_exp_path = f"s3://{bucket_name}/{object_key}"
-                    file_name = os.path.basename(object_key)
-
-                    # Immediate cleanup
-                    now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                    logger.info(f"[S3 FILE] {s3_imposm3_exp_path} | created:{eventTime} | cleaning:{now} UTC")
-                    execute_cleanup(s3_imposm3_exp_path, "immediate")
-
-                    # Send delayed cleanup messages if enabled
-                    if Config.ENABLE_DELAYED_CLEANUP:
-                        schedule_delayed_cleanups(s3_imposm3_exp_path)
-
-                # Delete the processed message
-                sqs.delete_message(
-                    QueueUrl=Config.SQS_QUEUE_URL,
-                    ReceiptHandle=message["ReceiptHandle"],
-                )
-                logger.info(f"[DONE] msg:{msg_id_short}")
+        logger.debug("Polling SQS...")
+        with SQS_RECEIVE_SECONDS.time():
+            response = sqs.receive_message(
+                QueueUrl=Config.SQS_QUEUE_URL,
+                MaxNumberOfMessages=Config.SQS_BATCH_SIZE,
+                WaitTimeSeconds=Config.SQS_WAIT_TIME_SECONDS,
+                VisibilityTimeout=Config.SQS_VISIBILITY_TIMEOUT,
+                AttributeNames=["All"],
+                MessageAttributeNames=["All"],
+            )
 
-            except Exception as e:
-                logger.error(f"Error processing message: {e}")
+        messages = response.get("Messages", [])
+        if messages:
+            logger.info("=="*40)
+            logger.info(f"[SQS] Received {len(messages)} message(s) | in flight: {inflight.in_flight()}")
+            list(handlers.map(lambda m: handle_message(m, inflight), messages))
 
-        time.sleep(10)
+        inflight.flush()
+        SQS_IN_FLIGHT.set(inflight.in_flight())
 
 
 if __name__ == "__main__":
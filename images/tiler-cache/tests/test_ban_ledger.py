@@ -0,0 +1,81 @@
+"""Ban ledger across coalesced batches: every file keeps its own event time.
+
+    cd images/tiler-cache
+    python -m pytest tests
+"""
+import os
+import tempfile
+from concurrent.futures import Future
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="tiler-cache-test-metrics-"))
+
+import pytest  # noqa: E402
+
+from utils import varnish_purger as vp  # noqa: E402
+from utils.coalescer import CleanupCoalescer  # noqa: E402
+
+ZOOMS = [14]
+# File A (older) has 14/50 of its own and shares 14/70 with file B (newer)
+FILE_A = ["14/5000/1", "14/7000/1"]
+FILE_B = ["14/7000/2"]
+T_A, T_B = 1000.0, 1060.0
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Units each stream sends instead of BANs to Varnish."""
+    units = []
+    monkeypatch.setattr(vp, "VARNISH_BAN_MODE", "url")
+    monkeypatch.setattr(vp, "VARNISH_BAN_PLANNER", False)
+    monkeypatch.setattr(vp, "build_invalidations", lambda pending: list(pending))
+    monkeypatch.setattr(vp, "_submit_bans", lambda bans, stats, soft: units.extend(bans) or [])
+    return units
+
+
+def _run(ledger, files, delayed):
+    stream = vp.PrefixBanStream(ZOOMS, ledger=ledger, delayed=delayed)
+    for lines, event_time in files:
+        stream.feed(lines, event_time=event_time)
+    assert stream.close()
+    return stream
+
+
+def test_coalescer_keeps_each_file_event_time():
+    calls = []
+
+    def run_batch(paths, cleanup_type, event_times):
+        calls.append((paths, cleanup_type, event_times))
+        future = Future()
+        future.set_result(None)
+        return future
+
+    coalescer = CleanupCoalescer(run_batch, window_seconds=60, max_files=2)
+    coalescer.add("delayed_15min", "s3://b/a.tiles", T_A)
+    coalescer.add("delayed_15min", "s3://b/b.tiles", T_B)
+    assert calls == [(["s3://b/a.tiles", "s3://b/b.tiles"], "delayed_15min", [T_A, T_B])]
+
+
+def test_files_split_across_delayed_batches_keep_their_prefixes(sent):
+    ledger = vp.BanLedger(max_age=1e12, max_size=1000)
+    _run(ledger, [(FILE_A, T_A), (FILE_B, T_B)], delayed=False)
+    assert sorted(sent) == ["14/50", "14/70"]
+
+    # A's delayed pass: 14/70 is covered by B's own delayed pass, 14/50 is A's alone
+    sent.clear()
+    a = _run(ledger, [(FILE_A, T_A)], delayed=True)
+    assert sent == ["14/50"]
+    assert a.skipped == 1
+
+    sent.clear()
+    _run(ledger, [(FILE_B, T_B)], delayed=True)
+    assert sent == ["14/70"]
+
+
+def test_delayed_batch_checks_each_file_under_its_own_time(sent):
+    ledger = vp.BanLedger(max_age=1e12, max_size=1000)
+    _run(ledger, [(FILE_A, T_A), (FILE_B, T_B)], delayed=False)
+
+    # Both files in one delayed batch: A skips 14/70, B (not newer than itself) still sends it
+    sent.clear()
+    _run(ledger, [(FILE_A, T_A), (FILE_B, T_B)], delayed=True)
+    assert sorted(sent) == ["14/50", "14/70"]
@@ -0,0 +1,296 @@
+"""Measure how much a BAN set over-invalidates against a cache inventory.
+
+The prefix rule and the planner trade precision for short regexes, so a
+BAN evicts cached tiles that did not change. Given the expire lines, the
+units sent for them and an inventory of cached tile URLs, audit() runs
+every generated BAN (regex, or xkey purge) against the inventory and
+counts, per zoom:
+
+    cached   inventory tiles at that zoom
+    needed   evicted tiles that really changed (the expire tile is their
+             ancestor, descendant or themselves)
+    over     evicted tiles that did not change
+    missed   changed tiles of a targeted zoom that no BAN evicts
+
+plus over_ratio (evicted / needed) and, per BAN, the tiles it evicts and
+how many of them were unchanged.
+
+The inventory is a file of tile URLs or z/x/y lines (e.g. a varnishncsa
+listing of cached objects) or a varnishncsa access log; synthetic_inventory()
+builds one for offline analysis. With BAN_AUDIT=true the SQS processor
+audits every immediate cleanup against BAN_AUDIT_INVENTORY (or the
+popularity tracker's hottest tiles), logs an [AUDIT] line and exports the
+counts as metrics. benchmarks/ban_audit.py runs it on expire files.
+"""
+import os
+import random
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from utils.metrics import AUDIT_TILES
+from utils.popularity import get_tracker
+from utils.tile_expansion import parse_tile_xyz, xkey_zoom
+from utils.utils import get_logger
+from utils import varnish_purger as vp
+
+logger = get_logger()
+
+BAN_AUDIT = os.getenv("BAN_AUDIT", "false").lower() == "true"
+# Cached-tile listing or access log; unset uses the popularity tracker's top tiles
+BAN_AUDIT_INVENTORY = os.getenv("BAN_AUDIT_INVENTORY", "").strip()
+BAN_AUDIT_TOP_K = int(os.getenv("BAN_AUDIT_TOP_K", "20000"))
+# Batches with more expire lines are not audited
+BAN_AUDIT_MAX_TILES = int(os.getenv("BAN_AUDIT_MAX_TILES", "200000"))
+
+# "/maps/ohm/14/8514/5843.pbf" anywhere in a line (listing, access log, full URL)
+_TILE_PATH_RE = re.compile(r"(/maps/[^/\s]+)/(\d+)/(\d+)/(\d+)(?:\.pbf)?")
+_TILE_XYZ_RE = re.compile(r"^(\d+)/(\d+)/(\d+)")
+
+# (url path, z, x, y)
+InventoryTile = Tuple[str, int, int, int]
+
+
+def parse_inventory(lines: Iterable[str]) -> List[InventoryTile]:
+    """Unique cached tiles from URL / access-log / z/x/y lines; bare z/x/y get the first tile prefix."""
+    seen: Set[str] = set()
+    tiles: List[InventoryTile] = []
+    default_prefix = vp.TILE_URL_PREFIXES[0]
+    for line in lines:
+        m = _TILE_PATH_RE.search(line)
+        if m:
+            prefix, z, x, y = m.group(1), int(m.group(2)), int(m.group(3)), int(m.group(4))
+        else:
+            m = _TILE_XYZ_RE.match(line.strip())
+            if not m:
+                continue
+            prefix, z, x, y = default_prefix, int(m.group(1)), int(m.group(2)), int(m.group(3))
+        path = f"{prefix}/{z}/{x}/{y}"
+        if path not in seen:
+            seen.add(path)
+            tiles.append((path, z, x, y))
+    return tiles
+
+
+def synthetic_inventory(
+    tile_strings: Sequence[str],
+    zoom_levels: Iterable[int],
+    per_zoom: int = 10000,
+    local_share: float = 0.5,
+    seed: int = 1,
+) -> List[InventoryTile]:
+    """A cache of per_zoom tiles per zoom: local_share near the expire tiles, the rest anywhere."""
+    rng = random.Random(seed)
+    zxy, _ = parse_tile_xyz(list(tile_strings))
+    prefixes = vp.TILE_URL_PREFIXES
+    lines = []
+    for zoom in sorted(set(zoom_levels)):
+        size = 1 << zoom
+        n = min(per_zoom, size * size)
+        n_local = int(n * local_share) if len(zxy) else 0
+        for i in range(n):
+            if i < n_local:
+                ez, ex, ey = zxy[rng.randrange(len(zxy))].tolist()
+                if zoom <= ez:
+                    x, y = ex >> (ez - zoom), ey >> (ez - zoom)
+                else:
+                    d = zoom - ez
+                    x, y = (ex << d) + rng.randrange(1 << d), (ey << d) + rng.randrange(1 << d)
+                x = min(size - 1, max(0, x + rng.randint(-16, 16)))
+                y = min(size - 1, max(0, y + rng.randint(-16, 16)))
+            else:
+                x, y = rng.randrange(size), rng.randrange(size)
+            lines.append(f"{rng.choice(prefixes)}/{zoom}/{x}/{y}")
+    return parse_inventory(lines)
+
+
+class _ChangedTiles:
+    """Membership test for 'tile z/x/y is covered by an expire tile' at any zoom."""
+
+    def __init__(self, zxy: np.ndarray):
+        self._by_zoom: Dict[int, Set[Tuple[int, int]]] = {}
+        for z, x, y in zxy.tolist():
+            self._by_zoom.setdefault(z, set()).add((x, y))
+        self._ancestors: Dict[Tuple[int, int], Set[Tuple[int, int]]] = {}
+
+    def _ancestors_at(self, ez: int, zoom: int) -> Set[Tuple[int, int]]:
+        key = (ez, zoom)
+        if key not in self._ancestors:
+            d = ez - zoom
+            self._ancestors[key] = {(x >> d, y >> d) for x, y in self._by_zoom[ez]}
+        return self._ancestors[key]
+
+    def __contains__(self, zxy: Tuple[int, int, int]) -> bool:
+        z, x, y = zxy
+        for ez, tiles in self._by_zoom.items():
+            if z >= ez:
+                if (x >> (z - ez), y >> (z - ez)) in tiles:
+                    return True
+            elif (x, y) in self._ancestors_at(ez, z):
+                return True
+        return False
+
+    def count(self, zoom: int) -> int:
+        """Tiles at zoom that changed (descendants of shallower expire zooms are not deduplicated)."""
+        ancestors: Set[Tuple[int, int]] = set()
+        descendants = 0
+        for ez, tiles in self._by_zoom.items():
+            if zoom <= ez:
+                ancestors |= self._ancestors_at(ez, zoom)
+            else:
+                descendants += len(tiles) << (2 * (zoom - ez))
+        return len(ancestors) + descendants
+
+
+def _ban_matcher(payload: str):
+    """(path, z, x, y) -> evicted? for one BAN regex, or one xkey purge in xkey mode."""
+    if vp.VARNISH_BAN_MODE == "xkey":
+        keys = set(payload.split(" "))
+
+        def evicts(path: str, z: int, x: int, y: int) -> bool:
+            layer = path.rsplit("/", 4)[-4]
+            shift = z - xkey_zoom(z)
+            return f"{layer}/{z - shift}/{x >> shift}/{y >> shift}" in keys
+
+        return evicts
+    regex = re.compile(payload)
+    return lambda path, z, x, y: regex.search(path) is not None
+
+
+def audit(
+    tile_strings: Iterable[str],
+    zoom_levels: Iterable[int],
+    inventory: Sequence[InventoryTile],
+    units: Optional[Iterable[str]] = None,
+) -> dict:
+    """Run the BANs for the expire lines (or the given units) against the inventory.
+
+    Returns {"zooms": {z: counts}, "bans": [per BAN], totals}.
+    """
+    tile_strings = list(tile_strings)
+    zoom_levels = sorted(set(zoom_levels))
+    if units is None:
+        units, _invalid = vp.expand_invalidations(tile_strings, zoom_levels)
+    bans = vp.build_invalidations(units) if units else []
+    zxy, _ = parse_tile_xyz(tile_strings)
+    changed = _ChangedTiles(zxy)
+
+    is_changed = [(z, x, y) in changed for _path, z, x, y in inventory]
+    evicted = [False] * len(inventory)
+    ban_rows = []
+    for i, (payload, n_patterns) in enumerate(bans):
+        evicts = _ban_matcher(payload)
+        hits = unchanged = 0
+        for j, (path, z, x, y) in enumerate(inventory):
+            if evicts(path, z, x, y):
+                hits += 1
+                unchanged += not is_changed[j]
+                evicted[j] = True
+        ban_rows.append({"ban": i, "patterns": n_patterns, "bytes": len(payload), "evicted": hits, "unchanged": unchanged})
+
+    zooms: Dict[int, dict] = {}
+    for j, (_path, z, _x, _y) in enumerate(inventory):
+        row = zooms.setdefault(z, {"cached": 0, "needed": 0, "over": 0, "missed": 0})
+        row["cached"] += 1
+        if evicted[j]:
+            row["needed" if is_changed[j] else "over"] += 1
+        elif is_changed[j] and z in zoom_levels:
+            row["missed"] += 1
+    for z, row in zooms.items():
+        row["targeted"] = z in zoom_levels
+        row["changed"] = changed.count(z)
+        evicted_z = row["needed"] + row["over"]
+        row["over_ratio"] = round(evicted_z / row["needed"], 2) if row["needed"] else None
+
+    needed = sum(r["needed"] for r in zooms.values())
+    over = sum(r["over"] for r in zooms.values())
+    return {
+        "mode": vp.VARNISH_BAN_MODE,
+        "expire_tiles": len(zxy),
+        "units": len(units),
+        "bans": ban_rows,
+        "inventory": len(inventory),
+        "needed": needed,
+        "over": over,
+        "missed": sum(r["missed"] for r in zooms.values()),
+        "over_ratio": round((needed + over) / needed, 2) if needed else None,
+        "zooms": dict(sorted(zooms.items())),
+    }
+
+
+def log_audit(report: dict, label: str = ""):
+    per_zoom = " ".join(
+        f"z{z}:{r['needed']}+{r['over']}" for z, r in report["zooms"].items() if r["needed"] or r["over"]
+    )
+    logger.info(
+        f"{label} [AUDIT] {len(report['bans'])} BANs on {report['inventory']} cached tiles: "
+        f"evicted {report['needed']} changed + {report['over']} unchanged "
+        f"(x{report['over_ratio']}), missed {report['missed']} | {per_zoom}"
+    )
+    if report["missed"]:
+        logger.warning(f"{label} [AUDIT] {report['missed']} changed cached tiles not covered by any BAN")
+
+
+_inventory: List[InventoryTile] = []
+_inventory_mtime: Optional[float] = None
+
+
+def runtime_inventory() -> List[InventoryTile]:
+    """BAN_AUDIT_INVENTORY, re-read when it changes, or the popularity tracker's hottest tiles."""
+    global _inventory, _inventory_mtime
+    if BAN_AUDIT_INVENTORY:
+        try:
+            mtime = os.path.getmtime(BAN_AUDIT_INVENTORY)
+        except OSError as e:
+            logger.warning(f"[AUDIT] Inventory {BAN_AUDIT_INVENTORY} not readable: {e}")
+            return _inventory
+        if mtime != _inventory_mtime:
+            with open(BAN_AUDIT_INVENTORY, errors="replace") as f:
+                _inventory = parse_inventory(f)
+            _inventory_mtime = mtime
+            logger.info(f"[AUDIT] Loaded {len(_inventory)} cached tiles from {BAN_AUDIT_INVENTORY}")
+        return _inventory
+    tracker = get_tracker()
+    if tracker is None:
+        return []
+    return parse_inventory(key for key, _count in tracker.top(BAN_AUDIT_TOP_K))
+
+
+class BatchAudit:
+    """Collects the expire lines of one cleanup and audits its prefixes once the BANs are sent."""
+
+    def __init__(self, max_tiles: int = BAN_AUDIT_MAX_TILES):
+        self.max_tiles = max_tiles
+        self.lines: List[str] = []
+        self.overflow = False
+
+    def tap(self, lines: Iterable[str]) -> Iterable[str]:
+        """Yield lines unchanged while keeping up to max_tiles of them."""
+        for line in lines:
+            if not self.overflow:
+                if len(self.lines) < self.max_tiles:
+                    self.lines.append(line.strip())
+                else:
+                    self.overflow = True
+                    self.lines = []
+            yield line
+
+    def run(self, units: Iterable[str], zoom_levels: Iterable[int], label: str = ""):
+        if self.overflow or not self.lines:
+            return None
+        inventory = runtime_inventory()
+        if not inventory:
+            return None
+        # Diagnostics only: never fail the cleanup
+        try:
+            report = audit(self.lines, zoom_levels, inventory, units=set(units))
+        except Exception:
+            logger.exception(f"{label} [AUDIT] failed")
+            return None
+        log_audit(report, label)
+        for z, r in report["zooms"].items():
+            for kind in ("needed", "over", "missed"):
+                if r[kind]:
+                    AUDIT_TILES.labels(str(z), kind).inc(r[kind])
+        return report
@@ -0,0 +1,209 @@
+"""Per-zoom granularity planner for regex BANs.
+
+The fixed prefix rule (utils.tile_expansion) trades precision for short
+regexes the same way at every zoom: a prefix pattern z/p[0-9]*/... matches
+every x whose decimal form starts with p, which at z20 can mean hundreds
+of thousands of columns for a single edit. For each target zoom the
+planner weighs three granularities:
+
+    exact   z/x/y            the changed tiles only
+    column  z/x/[0-9]+       every row of the changed x columns
+    prefix  z/p[0-9]*/[0-9]+ the x_prefix rule
+
+Each option is scored as evicted + TILES_PER_PATTERN * patterns, where
+"evicted" is the number of tile addresses the patterns match (an upper
+bound of what Varnish drops) and TILES_PER_PATTERN is what one extra
+pattern on the ban list is worth in re-rendered tiles. The cheapest option
+per zoom is taken, then zooms are coarsened one step at a time (the step
+that adds the fewest evicted tiles per pattern saved first) until the
+plan fits max_patterns.
+
+Planned units are strings: "z/x/y" (exact), "z/x/" (column) and "z/p"
+(prefix), so they can be deduplicated and recorded like plain prefixes.
+"""
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+from utils.tile_expansion import _expand_ranges, _truncated_x_ranges, parse_tile_xyz
+from utils.utils import get_logger
+
+logger = get_logger()
+
+GRANULARITIES = ("exact", "column", "prefix")
+
+
+class _Option:
+    __slots__ = ("granularity", "patterns", "evicted", "build")
+
+    def __init__(self, granularity: str, patterns: int, evicted: int, build):
+        self.granularity = granularity
+        self.patterns = patterns
+        self.evicted = evicted
+        self.build = build  # () -> Set[str], only called for the chosen option
+
+    def cost(self, tiles_per_pattern: float) -> float:
+        return self.evicted + tiles_per_pattern * self.patterns
+
+
+def prefix_match_count(prefix: int, zoom: int) -> int:
+    """Number of x in [0, 2**zoom) whose decimal form starts with prefix."""
+    size = 1 << zoom
+    if prefix == 0:
+        return 1
+    total, scale = 0, 1
+    while prefix * scale < size:
+        total += min((prefix + 1) * scale, size) - prefix * scale
+        scale *= 10
+    return total
+
+
+def _absorbed(prefixes: List[int]) -> List[int]:
+    """Drop prefixes that extend a shorter one in the list (it already matches them)."""
+    kept: List[int] = []
+    present = set(prefixes)
+    for p in prefixes:
+        q, covered = p // 10, False
+        while q > 0:
+            if q in present:
+                covered = True
+                break
+            q //= 10
+        if not covered:
+            kept.append(p)
+    return kept
+
+
+def _zoom_options(zxy: np.ndarray, zoom: int) -> Tuple[int, List[_Option]]:
+    """Return (changed tiles at zoom, options finest first)."""
+    z, x, y = zxy[:, 0], zxy[:, 1], zxy[:, 2]
+    up = z >= zoom
+    # Ancestors of deeper expire tiles
+    ax, ay = x[up] >> (z[up] - zoom), y[up] >> (z[up] - zoom)
+    anc = np.unique(np.stack([ax, ay], axis=1), axis=0) if up.any() else np.empty((0, 2), dtype=np.int64)
+    # Descendant blocks of shallower expire tiles
+    down = zxy[~up]
+    shift = zoom - down[:, 0]
+    n_desc = int((np.int64(1) << (2 * shift)).sum()) if down.size else 0
+    changed = len(anc) + n_desc
+
+    col_lo = np.concatenate([anc[:, 0], down[:, 1] << shift])
+    col_hi = np.concatenate([anc[:, 0], ((down[:, 1] + 1) << shift) - 1])
+    columns = np.unique(_expand_ranges(col_lo, col_hi))
+    prefixes = np.unique(_truncated_x_ranges(col_lo, col_hi)).tolist()
+    kept = _absorbed(prefixes)
+    rows = 1 << zoom
+
+    def build_exact() -> Set[str]:
+        units = {f"{zoom}/{a}/{b}" for a, b in anc.tolist()}
+        for ez, ex, ey in down.tolist():
+            d = zoom - ez
+            offsets = range(1 << d)
+            units.update(f"{zoom}/{(ex << d) + i}/{(ey << d) + j}" for i in offsets for j in offsets)
+        return units
+
+    options = [
+        _Option("exact", changed, changed, build_exact),
+        _Option("column", len(columns), len(columns) * rows, lambda: {f"{zoom}/{c}/" for c in columns.tolist()}),
+        _Option(
+            "prefix",
+            len(kept),
+            sum(prefix_match_count(p, zoom) for p in kept) * rows,
+            lambda: {f"{zoom}/{p}" for p in prefixes},
+        ),
+    ]
+    return changed, options
+
+
+def plan_invalidation(
+    tile_strings: Iterable[str],
+    zoom_levels: Iterable[int],
+    max_patterns: int,
+    tiles_per_pattern: float,
+) -> Tuple[Set[str], List[str], dict]:
+    """Choose a granularity per zoom for the given expire lines.
+
+    Returns (units, invalid_lines, report); report has per-zoom choices and
+    the changed / estimated evicted tile totals.
+    """
+    zxy, invalid = parse_tile_xyz(tile_strings)
+    units, report = plan_invalidation_xyz(zxy, zoom_levels, max_patterns, tiles_per_pattern)
+    return units, invalid, report
+
+
+def plan_invalidation_xyz(
+    zxy: np.ndarray,
+    zoom_levels: Iterable[int],
+    max_patterns: int,
+    tiles_per_pattern: float,
+) -> Tuple[Set[str], dict]:
+    """plan_invalidation for tiles already parsed by parse_tile_xyz; returns (units, report)."""
+    report = {"zooms": {}, "patterns": 0, "changed": 0, "evicted": 0}
+    if zxy.size == 0:
+        return set(), report
+
+    choices: Dict[int, int] = {}
+    options: Dict[int, List[_Option]] = {}
+    changed: Dict[int, int] = {}
+    for zoom in sorted(set(zoom_levels)):
+        changed[zoom], options[zoom] = _zoom_options(zxy, zoom)
+        costs = [o.cost(tiles_per_pattern) for o in options[zoom]]
+        choices[zoom] = costs.index(min(costs))
+
+    def total_patterns() -> int:
+        return sum(options[zoom][i].patterns for zoom, i in choices.items())
+
+    while total_patterns() > max_patterns:
+        best = None
+        for zoom, i in choices.items():
+            for j in range(i + 1, len(options[zoom])):
+                saved = options[zoom][i].patterns - options[zoom][j].patterns
+                if saved <= 0:
+                    continue
+                ratio = (options[zoom][j].evicted - options[zoom][i].evicted) / saved
+                if best is None or ratio < best[0]:
+                    best = (ratio, zoom, j)
+        if best is None:
+            break
+        choices[best[1]] = best[2]
+
+    units: Set[str] = set()
+    for zoom, i in choices.items():
+        option = options[zoom][i]
+        units |= option.build()
+        report["zooms"][zoom] = {
+            "granularity": option.granularity,
+            "patterns": option.patterns,
+            "changed": changed[zoom],
+            "evicted": option.evicted,
+        }
+        report["patterns"] += option.patterns
+        report["changed"] += changed[zoom]
+        report["evicted"] += option.evicted
+    return units, report
+
+
+def split_units(units: Iterable[str]) -> Dict[str, Set[str]]:
+    """Group planned units by granularity, returning regex bodies (no trailing slash)."""
+    groups: Dict[str, Set[str]] = {g: set() for g in GRANULARITIES}
+    for unit in units:
+        if unit.endswith("/"):
+            groups["column"].add(unit[:-1])
+        elif unit.count("/") == 2:
+            groups["exact"].add(unit)
+        else:
+            groups["prefix"].add(unit)
+    return groups
+
+
+def log_plan(report: dict):
+    if not report["zooms"]:
+        return
+    ratio = report["evicted"] / report["changed"] if report["changed"] else 0.0
+    per_zoom = " ".join(
+        f"z{zoom}:{r['granularity']}({r['patterns']})" for zoom, r in sorted(report["zooms"].items())
+    )
+    logger.info(
+        f"[PLAN] {report['patterns']} patterns | tiles changed={report['changed']} "
+        f"est. evicted<={report['evicted']} ({ratio:.1f}x) | {per_zoom}"
+    )
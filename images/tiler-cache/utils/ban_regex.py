@@ -0,0 +1,144 @@
+"""Trie-compressed regexes for Varnish BANs.
+
+A flat "p1|p2|...|pn" alternation repeats every shared leading character
+(zoom, leading x digits) once per pattern, and Varnish evaluates the whole
+thing against every object on the ban list. Building a trie of the
+patterns and emitting it as nested groups factors those prefixes out, e.g.
+
+    14/120|14/121|14/125|15/2  ->  1(?:4/12[015]|5/2)
+
+Chunks are cut by the byte length of the compiled regex instead of a fixed
+pattern count, so each BAN is as large as the header budget allows.
+"""
+import re
+from typing import Callable, Iterator, List, Sequence, Tuple
+
+_END = ""
+
+
+def _build_trie(patterns: Sequence[str], absorb_extensions: bool) -> dict:
+    root: dict = {}
+    for pattern in patterns:
+        node = root
+        for ch in pattern:
+            if absorb_extensions and _END in node:
+                break
+            node = node.setdefault(ch, {})
+        else:
+            node[_END] = True
+            if absorb_extensions:
+                # Anything longer is already matched by this pattern
+                for key in [k for k in node if k != _END]:
+                    del node[key]
+    return root
+
+
+def _char_class(chars: List[str]) -> str:
+    """Return a regex class for single characters, collapsing runs like 0-9."""
+    if len(chars) == 1:
+        return re.escape(chars[0])
+    chars = sorted(chars)
+    parts = []
+    i = 0
+    while i < len(chars):
+        j = i
+        while j + 1 < len(chars) and ord(chars[j + 1]) == ord(chars[j]) + 1:
+            j += 1
+        if j - i >= 2:
+            parts.append(f"{re.escape(chars[i])}-{re.escape(chars[j])}")
+        else:
+            parts.extend(re.escape(c) for c in chars[i : j + 1])
+        i = j + 1
+    return "[" + "".join(parts) + "]"
+
+
+def _emit(node: dict) -> str:
+    terminal = _END in node
+    children = sorted(k for k in node if k != _END)
+    if not children:
+        return ""
+
+    # Children with identical sub-patterns share one character class:
+    # 0[0-9]|1[0-9]|2[0-9] -> [0-2][0-9]
+    by_suffix: dict = {}
+    for ch in children:
+        by_suffix.setdefault(_emit(node[ch]), []).append(ch)
+    alts = [_char_class(chars) + suffix for suffix, chars in by_suffix.items()]
+
+    if len(alts) == 1:
+        body = alts[0]
+        if not terminal:
+            return body
+        return f"{body}?" if _is_atom(body) else f"(?:{body})?"
+    return "(?:" + "|".join(alts) + ")" + ("?" if terminal else "")
+
+
+def _is_atom(regex: str) -> bool:
+    """True if a quantifier appended to regex applies to all of it."""
+    if len(regex) == 1:
+        return True
+    if len(regex) == 2 and regex[0] == "\\":
+        return True
+    return regex.startswith("[") and regex.index("]") == len(regex) - 1
+
+
+def compile_alternation(patterns: Sequence[str], absorb_extensions: bool = False) -> str:
+    """Return a regex fragment matching exactly one of the literal patterns.
+
+    With absorb_extensions, a pattern that extends a shorter one is dropped;
+    use it when the fragment is followed by something like [0-9]* that
+    already matches the extra characters. The result is always safe to
+    concatenate with other regex text.
+    """
+    if not patterns:
+        return ""
+    return _emit(_build_trie(patterns, absorb_extensions))
+
+
+def chunk_by_regex_budget(
+    patterns: Sequence[str],
+    budget: int,
+    wrap: Callable[[str], str],
+    absorb_extensions: bool = False,
+) -> Iterator[Tuple[str, int]]:
+    """Yield (regex, n_patterns) covering the sorted patterns.
+
+    Each regex is wrap(compile_alternation(chunk)) and is at most budget
+    bytes, unless a single pattern alone exceeds it. Everything left is
+    tried first (dense tile sets usually compress into one BAN); otherwise
+    the largest fitting chunk is found by exponential then binary search,
+    so the number of compilations per chunk is logarithmic in its size.
+    """
+    patterns = sorted(patterns)
+
+    def fits(start, count):
+        regex = wrap(compile_alternation(patterns[start : start + count], absorb_extensions))
+        return len(regex.encode()) <= budget, regex
+
+    i = 0
+    while i < len(patterns):
+        remaining = len(patterns) - i
+        ok, best = fits(i, remaining)
+        if ok:
+            yield best, remaining
+            return
+        ok, best = fits(i, 1)
+        lo = 1
+        if ok:
+            hi = 2
+            while hi <= remaining:
+                ok, regex = fits(i, hi)
+                if not ok:
+                    break
+                lo, best = hi, regex
+                hi *= 2
+            hi = min(hi, remaining + 1)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                ok, regex = fits(i, mid)
+                if ok:
+                    lo, best = mid, regex
+                else:
+                    hi = mid
+        yield best, lo
+        i += lo
@@ -0,0 +1,94 @@
+"""Tiles of a lon/lat bbox: closed-form counts, lazy enumeration and an invalidation plan.
+
+Changeset bboxes can be continent-sized, so nothing here builds a list of
+tiles before the count per zoom is known. Used by /clean-cache (single and
+bulk) when a changeset is invalidated by its bbox.
+"""
+from typing import Iterator, List, Optional, Tuple
+
+import mercantile
+
+from config import Config
+from utils.tile_expansion import xkey_zoom
+from utils.utils import get_logger
+from utils.varnish_purger import VARNISH_BAN_MODE, AsyncPrefixBanStream, BanStats, ban_tiles_async
+
+logger = get_logger()
+
+MAX_MERCATOR_LAT = 85.0511287798
+
+
+def bbox_tile_ranges(bbox: dict, zoom: int) -> List[Tuple[int, int, int, int]]:
+    """(min_x, max_x, min_y, max_y) tile ranges covering the bbox at zoom; two if it crosses the antimeridian."""
+    n = 1 << zoom
+    north = min(bbox['max_lat'], MAX_MERCATOR_LAT)
+    south = max(bbox['min_lat'], -MAX_MERCATOR_LAT)
+    if bbox['min_lon'] > bbox['max_lon']:
+        spans = [(bbox['min_lon'], 180.0), (-180.0, bbox['max_lon'])]
+    else:
+        spans = [(bbox['min_lon'], bbox['max_lon'])]
+    ranges = []
+    for west, east in spans:
+        ul = mercantile.tile(west, north, zoom)
+        lr = mercantile.tile(east - mercantile.LL_EPSILON, south + mercantile.LL_EPSILON, zoom)
+        ranges.append((max(ul.x, 0), min(lr.x, n - 1), max(ul.y, 0), min(lr.y, n - 1)))
+    return ranges
+
+
+def estimate_tiles_in_bbox(bbox: dict, zoom: int) -> int:
+    """Exact number of tiles intersecting the bbox at zoom, without enumerating them."""
+    return sum((x1 - x0 + 1) * (y1 - y0 + 1) for x0, x1, y0, y1 in bbox_tile_ranges(bbox, zoom))
+
+
+def get_tiles_in_bbox(bbox: dict, zoom_levels: List[int]) -> Iterator[mercantile.Tile]:
+    """Yields all tiles that intersect with the bbox for the specified zoom levels, one column at a time."""
+    for zoom in zoom_levels:
+        for x0, x1, y0, y1 in bbox_tile_ranges(bbox, zoom):
+            for x in range(x0, x1 + 1):
+                yield from (mercantile.Tile(x, y, zoom) for y in range(y0, y1 + 1))
+
+
+def plan_bbox_invalidation(bbox: dict, zoom_levels: List[int], max_tiles: int = Config.CLEAN_CACHE_MAX_TILES) -> dict:
+    """Pick how to invalidate a bbox before enumerating any tile.
+
+    Within max_tiles every tile of every zoom is banned exactly. Over it the
+    bbox is enumerated at the deepest zoom that fits (parent tiles) and
+    expanded to the requested zooms as prefix BANs.
+
+    In xkey mode a parent tile expands to all of its descendant keys, so
+    coarsening stops at the deepest key zoom the requested zooms use and
+    the budget counts keys: the bbox's tiles at every key zoom. Over
+    max_tiles keys the strategy is "refused": nothing is sent and the
+    tiles expire with their TTL.
+    """
+    per_zoom = {z: estimate_tiles_in_bbox(bbox, z) for z in sorted(set(zoom_levels))}
+    total = sum(per_zoom.values())
+    plan = {"strategy": "exact", "estimated_tiles": total, "tiles_per_zoom": per_zoom, "max_tiles": max_tiles}
+    if total > max_tiles:
+        key_zooms = {xkey_zoom(z) for z in zoom_levels} if VARNISH_BAN_MODE == "xkey" else set()
+        min_zoom = max(key_zooms, default=0)
+        source_zoom = max(zoom_levels)
+        while source_zoom > min_zoom and estimate_tiles_in_bbox(bbox, source_zoom) > max_tiles:
+            source_zoom -= 1
+        source_tiles = estimate_tiles_in_bbox(bbox, source_zoom)
+        plan.update(strategy="prefix", source_zoom=source_zoom, source_tiles=source_tiles)
+        if key_zooms:
+            plan["keys"] = sum(estimate_tiles_in_bbox(bbox, kz) for kz in key_zooms)
+            if plan["keys"] > max_tiles:
+                plan["strategy"] = "refused"
+    return plan
+
+
+async def ban_bbox(
+    bbox: dict, zoom_levels: List[int], stats: BanStats, soft: Optional[bool] = None
+) -> Tuple[bool, dict]:
+    """Invalidate every tile of the bbox following plan_bbox_invalidation; returns (ok, plan)."""
+    plan = plan_bbox_invalidation(bbox, zoom_levels)
+    if plan["strategy"] == "refused":
+        logger.warning(f"Bbox needs {plan['keys']} xkey purges (max {plan['max_tiles']}); not sent, TTL is fallback")
+        return False, plan
+    if plan["strategy"] == "exact":
+        return await ban_tiles_async(list(get_tiles_in_bbox(bbox, zoom_levels)), stats, soft=soft), plan
+    stream = AsyncPrefixBanStream(zoom_levels, stats, soft=soft)
+    stream.feed(f"{t.z}/{t.x}/{t.y}" for t in get_tiles_in_bbox(bbox, [plan["source_zoom"]]))
+    return await stream.aclose(), plan
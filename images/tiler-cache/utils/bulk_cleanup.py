@@ -0,0 +1,161 @@
+"""Bulk changeset cleanups run as background jobs.
+
+A job takes many changeset IDs (a list and/or a range), fetches their
+bboxes concurrently through the shared OSM API client, and feeds every
+bbox into a single PrefixBanStream, so tiles shared by several changesets
+are banned once and the whole wave costs one deduplicated BAN plan.
+Closed changesets are served from the client's LRU cache, so a retried
+job does not hit the OSM API again.
+
+Each bbox is enumerated at the zoom plan_bbox_invalidation picks for it:
+the deepest requested zoom when it fits CLEAN_CACHE_MAX_TILES, a coarser
+one otherwise; in xkey mode a bbox over the key budget is refused (counted,
+not banned). Progress is kept in memory and polled through main.py.
+"""
+import asyncio
+import os
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from typing import List, Optional
+
+import httpx
+
+from utils.bbox_tiles import get_tiles_in_bbox, plan_bbox_invalidation
+from utils.osm_api import fetch_changeset_bbox
+from utils.utils import get_logger
+from utils.varnish_purger import BanStats, PrefixBanStream
+
+logger = get_logger()
+
+BULK_MAX_CHANGESETS = int(os.getenv("BULK_MAX_CHANGESETS", "5000"))
+BULK_FETCH_CONCURRENCY = int(os.getenv("BULK_FETCH_CONCURRENCY", "16"))
+# Finished jobs kept for polling
+BULK_JOBS_KEPT = int(os.getenv("BULK_JOBS_KEPT", "100"))
+# Errors listed per job (the count is always complete)
+_MAX_ERRORS = 20
+
+_jobs: "OrderedDict[str, BulkJob]" = OrderedDict()
+
+
+class BulkJob:
+    """Progress of one bulk cleanup, as returned by the polling endpoint."""
+
+    def __init__(self, changeset_ids: List[int], zoom_levels: List[int], api_base_url: str, soft: Optional[bool]):
+        self.id = uuid.uuid4().hex[:12]
+        self.changeset_ids = changeset_ids
+        self.zoom_levels = zoom_levels
+        self.api_base_url = api_base_url.rstrip("/")
+        self.soft = soft
+        self.status = "queued"
+        self.fetched = 0
+        self.empty = 0
+        self.failed = 0
+        self.errors: List[str] = []
+        self.tiles = 0
+        self.coarsened = 0
+        self.refused = 0
+        self.stats = BanStats()
+        self.stream: Optional[PrefixBanStream] = None
+        self.ban_ok: Optional[bool] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def _error(self, changeset_id: int, e: Exception):
+        self.failed += 1
+        if len(self.errors) < _MAX_ERRORS:
+            self.errors.append(f"{changeset_id}: {str(e).splitlines()[0] if str(e) else type(e).__name__}")
+
+    def to_dict(self) -> dict:
+        total = len(self.changeset_ids)
+        done = self.fetched + self.empty + self.failed
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "changesets": total,
+            "fetched": self.fetched,
+            "empty": self.empty,
+            "failed": self.failed,
+            "errors": self.errors,
+            "progress": round(done / total, 3) if total else 1.0,
+            "tiles": self.tiles,
+            "coarsened_bboxes": self.coarsened,
+            "refused_bboxes": self.refused,
+            "prefixes": len(self.stream.seen) if self.stream is not None else 0,
+            "varnish_ban_ok": self.ban_ok,
+            "varnish_ban_stats": self.stats.summary(),
+            "elapsed_s": round(end - self.created_at, 2),
+        }
+
+    def _feed(self, bbox: dict):
+        plan = plan_bbox_invalidation(bbox, self.zoom_levels)
+        if plan["strategy"] == "refused":
+            # Too many xkey purges; its tiles expire with their TTL
+            self.refused += 1
+            return
+        zoom = max(self.zoom_levels) if plan["strategy"] == "exact" else plan["source_zoom"]
+        if plan["strategy"] != "exact":
+            self.coarsened += 1
+        before = self.stream.lines
+        self.stream.feed(f"{t.z}/{t.x}/{t.y}" for t in get_tiles_in_bbox(bbox, [zoom]))
+        self.tiles += self.stream.lines - before
+
+    async def run(self):
+        label = f"[BULK {self.id}] {len(self.changeset_ids)} changesets"
+        self.status = "running"
+        self.stream = PrefixBanStream(self.zoom_levels, self.stats, soft=self.soft)
+        semaphore = asyncio.Semaphore(BULK_FETCH_CONCURRENCY)
+
+        async def fetch(changeset_id: int):
+            async with semaphore:
+                try:
+                    return changeset_id, await fetch_changeset_bbox(changeset_id, self.api_base_url), None
+                except (httpx.HTTPError, ET.ParseError, ValueError) as e:
+                    return changeset_id, None, e
+
+        try:
+            for next_result in asyncio.as_completed([fetch(c) for c in self.changeset_ids]):
+                changeset_id, bbox, error = await next_result
+                if error is not None:
+                    self._error(changeset_id, error)
+                elif bbox is None:
+                    self.empty += 1
+                else:
+                    self.fetched += 1
+                    # Enumeration and BAN submission block; keep the event loop free
+                    await asyncio.to_thread(self._feed, bbox)
+            self.status = "banning"
+            self.ban_ok = await asyncio.to_thread(self.stream.close)
+            self.status = "done"
+        except asyncio.CancelledError:
+            self.status = "cancelled"
+            raise
+        except Exception as e:
+            logger.exception(f"{label} failed")
+            self.status = "failed"
+            self.errors.append(str(e))
+        finally:
+            self.finished_at = time.time()
+            self.stats.log_summary(label)
+            logger.info(
+                f"{label} {self.status}: {self.fetched} with bbox, {self.empty} empty, {self.failed} failed "
+                f"| {self.tiles} tiles -> {len(self.stream.seen)} prefixes | {self.finished_at - self.created_at:.1f}s"
+            )
+
+
+def start_job(changeset_ids: List[int], zoom_levels: List[int], api_base_url: str, soft: Optional[bool]) -> BulkJob:
+    """Create a job and schedule it on the running event loop."""
+    job = BulkJob(changeset_ids, zoom_levels, api_base_url, soft)
+    _jobs[job.id] = job
+    finished = [j for j in _jobs.values() if j.finished_at is not None]
+    for old in finished[: max(0, len(finished) - BULK_JOBS_KEPT)]:
+        _jobs.pop(old.id, None)
+    job.task = asyncio.get_running_loop().create_task(job.run())
+    return job
+
+
+def get_job(job_id: str) -> Optional[BulkJob]:
+    return _jobs.get(job_id)
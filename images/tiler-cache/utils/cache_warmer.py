@@ -0,0 +1,227 @@
+"""Re-request invalidated tiles through Varnish right after a BAN.
+
+Without warming, the first user to open each edited tile pays the full
+Martin render. After a cleanup the expire tiles are mapped to the zooms
+worth warming (ancestors, and descendants up to a cap), ordered by
+popularity, and fetched through every Varnish node for the configured
+tile groups. Requests share one small thread pool and a global rate limit
+so warming never competes with real traffic for Martin; warm jobs queue
+behind each other and are dropped when the queue is full.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.tile_expansion import parse_tile_xyz
+from utils.utils import get_logger
+from utils.varnish_purger import get_varnish_nodes
+
+logger = get_logger()
+
+CACHE_WARM_ENABLED = os.getenv("CACHE_WARM_ENABLED", "false").lower() == "true"
+CACHE_WARM_ZOOMS = [int(z) for z in os.getenv("CACHE_WARM_ZOOMS", "12,13,14,15,16").split(",") if z.strip()]
+CACHE_WARM_GROUPS = [g.strip() for g in os.getenv("CACHE_WARM_GROUPS", "ohm,ohm_admin,ohm_other_boundaries").split(",") if g.strip()]
+# Appended to /maps/<group>/z/x/y; clients requesting ".pbf" are cached separately
+CACHE_WARM_URL_SUFFIX = os.getenv("CACHE_WARM_URL_SUFFIX", "")
+CACHE_WARM_MAX_TILES = int(os.getenv("CACHE_WARM_MAX_TILES", "500"))
+# Expire tiles kept per plan, as a multiple of CACHE_WARM_MAX_TILES
+CACHE_WARM_SOURCE_FACTOR = int(os.getenv("CACHE_WARM_SOURCE_FACTOR", "20"))
+CACHE_WARM_CONCURRENCY = max(1, int(os.getenv("CACHE_WARM_CONCURRENCY", "4")))
+CACHE_WARM_RATE = float(os.getenv("CACHE_WARM_RATE", "20"))
+CACHE_WARM_QUEUE = int(os.getenv("CACHE_WARM_QUEUE", "10"))
+CACHE_WARM_TIMEOUT = int(os.getenv("CACHE_WARM_TIMEOUT", "60"))
+
+Tile = Tuple[int, int, int]
+
+
+class RateLimiter:
+    """Spaces calls to at most `rate` per second across threads (0 = unlimited)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class WarmPlan:
+    """Collects the expire tiles of a cleanup and turns them into warm targets.
+
+    Memory stays bounded while a large expire file streams through: tiles
+    deeper than the deepest warm zoom are kept as their ancestor there
+    (with a count), which yields the same targets. Past
+    CACHE_WARM_SOURCE_FACTOR * max_tiles sources, they are folded into
+    their parents one zoom at a time (not below the shallowest warm zoom);
+    descendants of folded sources are no longer warmed, and once folding
+    cannot go further new source tiles are dropped.
+    """
+
+    def __init__(self, zooms: Iterable[int] = None, max_tiles: int = CACHE_WARM_MAX_TILES):
+        self.zooms = sorted(set(CACHE_WARM_ZOOMS if zooms is None else zooms))
+        self.max_tiles = max_tiles
+        self.max_sources = max(1, CACHE_WARM_SOURCE_FACTOR * max_tiles)
+        # Deepest zoom kept; lowered when sources are folded
+        self._source_zoom = max(self.zooms) if self.zooms else 0
+        self._folded = False
+        self._sources: Dict[Tile, int] = {}
+        # Expire tiles ignored once sources are full at the shallowest warm zoom
+        self.dropped = 0
+
+    def add(self, tile_strings: Iterable[str]):
+        self.add_xyz(parse_tile_xyz(tile_strings)[0])
+
+    def add_xyz(self, zxy: np.ndarray):
+        """Record tiles parsed by parse_tile_xyz, e.g. the batches of a PrefixBanStream."""
+        if zxy.size == 0:
+            return
+        z, x, y = zxy[:, 0], zxy[:, 1], zxy[:, 2]
+        shift = np.maximum(z - self._source_zoom, 0)
+        tiles, counts = np.unique(np.stack([z - shift, x >> shift, y >> shift], axis=1), axis=0, return_counts=True)
+        for tile, n in zip(tiles.tolist(), counts.tolist()):
+            key = self._clamp(*tile)
+            if key not in self._sources and len(self._sources) >= self.max_sources:
+                self._fold()
+                key = self._clamp(*key)
+                if key not in self._sources and len(self._sources) >= self.max_sources:
+                    self.dropped += n
+                    continue
+            self._sources[key] = self._sources.get(key, 0) + n
+
+    def _clamp(self, z: int, x: int, y: int) -> Tile:
+        """The tile's ancestor at the source zoom (lowered by folds since the batch was mapped)."""
+        if z <= self._source_zoom:
+            return z, x, y
+        s = z - self._source_zoom
+        return self._source_zoom, x >> s, y >> s
+
+    def _fold(self):
+        """Fold sources into their parents until there is room or they reach the shallowest warm zoom."""
+        floor = min(self.zooms) if self.zooms else 0
+        while len(self._sources) >= self.max_sources and self._source_zoom > floor:
+            self._source_zoom -= 1
+            folded: Dict[Tile, int] = {}
+            for (z, x, y), n in self._sources.items():
+                if z > self._source_zoom:
+                    z, x, y = z - 1, x >> 1, y >> 1
+                folded[(z, x, y)] = folded.get((z, x, y), 0) + n
+            self._sources = folded
+            self._folded = True
+
+    def targets(self, popularity: Optional[Callable[[int, int, int], float]] = None) -> List[Tile]:
+        """Tiles to warm, most popular first, capped at max_tiles.
+
+        Without a popularity function, tiles covering more expire tiles come
+        first, then lower zooms (one low-zoom tile serves a wider area).
+        """
+        weight: Dict[Tile, int] = {}
+        for (z, x, y), n in self._sources.items():
+            for tz in self.zooms:
+                if tz <= z:
+                    s = z - tz
+                    tiles = [(tz, x >> s, y >> s)]
+                else:
+                    d = tz - z
+                    if 4 ** d > self.max_tiles or (self._folded and tz > self._source_zoom):
+                        continue
+                    tiles = [
+                        (tz, (x << d) + i, (y << d) + j) for i in range(1 << d) for j in range(1 << d)
+                    ]
+                for t in tiles:
+                    weight[t] = weight.get(t, 0) + n
+        if popularity is not None:
+            key = lambda t: (-popularity(*t), -weight[t], t[0])
+        else:
+            key = lambda t: (-weight[t], t[0])
+        return sorted(weight, key=key)[: self.max_tiles]
+
+
+class CacheWarmer:
+    """Fetches warm targets through every Varnish node with bounded concurrency and rate."""
+
+    def __init__(
+        self,
+        groups: List[str] = None,
+        concurrency: int = CACHE_WARM_CONCURRENCY,
+        rate: float = CACHE_WARM_RATE,
+        max_jobs: int = CACHE_WARM_QUEUE,
+    ):
+        self.groups = CACHE_WARM_GROUPS if groups is None else groups
+        self.popularity: Optional[Callable[[int, int, int], float]] = None
+        self._limiter = RateLimiter(rate)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="cache-warm")
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=concurrency)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._jobs: "queue.Queue[Tuple[WarmPlan, str]]" = queue.Queue(maxsize=max_jobs)
+        threading.Thread(target=self._run, name="cache-warm-jobs", daemon=True).start()
+
+    def submit(self, plan: WarmPlan, label: str) -> bool:
+        """Queue a warm job; returns False (and drops it) when the queue is full."""
+        try:
+            self._jobs.put_nowait((plan, label))
+            return True
+        except queue.Full:
+            logger.warning(f"[WARM] {label} skipped: {self._jobs.qsize()} warm jobs already queued")
+            return False
+
+    def _fetch(self, url: str) -> Tuple[bool, bool]:
+        """GET one tile; returns (ok, was_miss)."""
+        self._limiter.wait()
+        try:
+            r = self._session.get(url, headers={"Accept-Encoding": "gzip"}, timeout=CACHE_WARM_TIMEOUT)
+            return r.status_code < 500, r.headers.get("X-Cache") != "HIT"
+        except Exception:
+            return False, True
+
+    def warm(self, plan: WarmPlan, label: str) -> dict:
+        """Warm a plan synchronously and return its report."""
+        started = time.monotonic()
+        tiles = plan.targets(self.popularity)
+        nodes = get_varnish_nodes()
+        urls = [
+            f"{node}/maps/{group}/{z}/{x}/{y}{CACHE_WARM_URL_SUFFIX}"
+            for z, x, y in tiles
+            for group in self.groups
+            for node in nodes
+        ]
+        results = list(self._executor.map(self._fetch, urls))
+        report = {
+            "tiles": len(tiles),
+            "requests": len(urls),
+            "ok": sum(1 for ok, _ in results if ok),
+            "rendered": sum(1 for ok, miss in results if ok and miss),
+            "elapsed_s": round(time.monotonic() - started, 2),
+            "dropped_sources": plan.dropped,
+        }
+        dropped = f" | {plan.dropped} expire tiles over the source cap" if plan.dropped else ""
+        logger.info(
+            f"[WARM] {label}: {report['tiles']} tiles x {len(self.groups)} groups x {len(nodes)} nodes "
+            f"| ok={report['ok']}/{report['requests']} rendered={report['rendered']} "
+            f"| {report['elapsed_s']}s{dropped}"
+        )
+        return report
+
+    def _run(self):
+        while True:
+            plan, label = self._jobs.get()
+            try:
+                self.warm(plan, label)
+            except Exception as e:
+                logger.error(f"[WARM] {label} failed: {e}")
@@ -0,0 +1,165 @@
+"""SQLite index of tile -> last time it was invalidated.
+
+Every expire file processed by the SQS processor is recorded here, one
+row per tile (an upsert keeps the newest time), so downstream caches and
+offline-map builders can ask which tiles changed since T instead of
+re-downloading whole regions. Ancestors of each expire tile are written
+too, at every zoom down to 0, so a query for any zoom is a range scan of
+the (z, changed_at) index paged with a keyset cursor; there is no
+aggregation at read time. Tiles deeper than the expire zoom are reported
+as their expire-zoom ancestor, which covers them.
+
+Rows older than CHANGED_TILES_RETENTION_DAYS are deleted by compact(),
+which runs at most once per CHANGED_TILES_COMPACT_INTERVAL from record().
+
+The SQS processor writes and main.py reads, each with its own
+connection (utils.sqlite_store, WAL mode).
+"""
+
+import os
+import time
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from utils.sqlite_store import SQLiteStore
+from utils.utils import get_logger
+
+logger = get_logger()
+
+_DB_PATH = os.getenv("CHANGED_TILES_DB", "/data/tiler_cache_changed_tiles.db")
+CHANGED_TILES_RETENTION_DAYS = float(os.getenv("CHANGED_TILES_RETENTION_DAYS", "30"))
+CHANGED_TILES_COMPACT_INTERVAL = int(os.getenv("CHANGED_TILES_COMPACT_INTERVAL", "3600"))
+# Zoom of the imposm expire tiles; deeper queries are answered at this zoom
+CHANGED_TILES_MAX_ZOOM = int(os.getenv("CHANGED_TILES_MAX_ZOOM", "14"))
+# Expire lines upserted per transaction
+_BATCH = 10000
+
+_last_compact = 0.0
+
+
+def _init_tables(conn):
+    """Create tables and indexes."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS tile_changes (
+            z           INTEGER NOT NULL,
+            x           INTEGER NOT NULL,
+            y           INTEGER NOT NULL,
+            changed_at  REAL    NOT NULL,
+            PRIMARY KEY (z, x, y)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_tile_changes_zoom_time
+        ON tile_changes(z, changed_at)
+    """)
+    conn.commit()
+
+
+_store = SQLiteStore(
+    _DB_PATH,
+    _init_tables,
+    # auto_vacuum only takes effect on a new database; lets compact() return freed pages
+    pragmas=("auto_vacuum=INCREMENTAL", "synchronous=NORMAL"),
+)
+
+
+def _parse(lines: Iterable[str]) -> List[Tuple[int, int, int]]:
+    tiles = []
+    for line in lines:
+        parts = line.strip().split("/")
+        if len(parts) >= 3 and parts[0].isdigit() and parts[1].isdigit() and parts[2].isdigit():
+            tiles.append((int(parts[0]), int(parts[1]), int(parts[2])))
+    return tiles
+
+
+def _with_ancestors(tiles: Iterable[Tuple[int, int, int]]) -> set:
+    out = set()
+    level = set(tiles)
+    while level:
+        out |= level
+        level = {(z - 1, x >> 1, y >> 1) for z, x, y in level if z > 0} - out
+    return out
+
+
+def record(tile_strings: Iterable[str], changed_at: float) -> int:
+    """Upsert z/x/y lines and their ancestors with changed_at (never moving a tile back in time).
+
+    Returns rows written.
+    """
+    rows = [(z, x, y, changed_at) for z, x, y in _with_ancestors(_parse(tile_strings))]
+    if not rows:
+        return 0
+    with _store.connection() as conn:
+        conn.executemany("""
+            INSERT INTO tile_changes (z, x, y, changed_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (z, x, y) DO UPDATE SET changed_at = excluded.changed_at
+            WHERE excluded.changed_at > tile_changes.changed_at
+        """, rows)
+        conn.commit()
+    if time.time() - _last_compact >= CHANGED_TILES_COMPACT_INTERVAL:
+        compact()
+    return len(rows)
+
+
+def tap(lines: Iterable[str], changed_at: float) -> Iterator[str]:
+    """Yield lines unchanged while recording them in batches, to wrap an expire-file stream."""
+    batch: List[str] = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= _BATCH:
+            record(batch, changed_at)
+            batch = []
+        yield line
+    if batch:
+        record(batch, changed_at)
+
+
+def changed_since(
+    since: float,
+    zoom: int = CHANGED_TILES_MAX_ZOOM,
+    limit: int = 10000,
+    cursor: Optional[Tuple[int, int, int, float]] = None,
+) -> List[Tuple[int, int, int, float]]:
+    """Tiles of one zoom changed at or after `since`, oldest change first, as (z, x, y, changed_at).
+
+    Zooms deeper than CHANGED_TILES_MAX_ZOOM are answered at that zoom.
+    Pass the last returned row as cursor to get the next page.
+    """
+    zoom = min(zoom, CHANGED_TILES_MAX_ZOOM)
+    _cz, cx, cy, ct = cursor if cursor is not None else (zoom, -1, -1, -1.0)
+    # The index range starts at the cursor's time, so each page costs O(limit)
+    with _store.connection() as conn:
+        return conn.execute("""
+            SELECT z, x, y, changed_at FROM tile_changes
+            WHERE z = :zoom AND changed_at >= :lower
+              AND (changed_at, x, y) > (:ct, :cx, :cy)
+            ORDER BY changed_at, x, y
+            LIMIT :limit
+        """, {"zoom": zoom, "lower": max(since, ct), "limit": limit, "ct": ct, "cx": cx, "cy": cy}).fetchall()
+
+
+def compact(retention_days: float = CHANGED_TILES_RETENTION_DAYS) -> int:
+    """Delete rows older than the retention, release free pages and checkpoint the WAL.
+
+    Returns rows deleted.
+    """
+    global _last_compact
+    _last_compact = time.time()
+    cutoff = _last_compact - retention_days * 86400
+    with _store.connection() as conn:
+        cur = conn.execute("DELETE FROM tile_changes WHERE changed_at < ?", (cutoff,))
+        conn.commit()
+        # executescript steps the pragma to completion (execute frees one page)
+        conn.executescript("PRAGMA incremental_vacuum;")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    if cur.rowcount:
+        logger.info(f"[CHANGED] Compacted: {cur.rowcount} tiles older than {retention_days:g} days removed")
+    return cur.rowcount
+
+
+def summary() -> dict:
+    """Row count and time range for the API."""
+    with _store.connection() as conn:
+        count, oldest, newest = conn.execute(
+            "SELECT COUNT(*), MIN(changed_at), MAX(changed_at) FROM tile_changes"
+        ).fetchone()
+    return {"tiles": count, "oldest": oldest, "newest": newest}
@@ -0,0 +1,325 @@
+"""Tile coverage of the geometries a changeset touched.
+
+The changeset bbox can span continents for a handful of edits. Here the
+changeset's osmChange is downloaded and every touched element is resolved
+to coordinates through the OSM API:
+
+- nodes: their new position, and the previous version's for moves/deletes;
+- ways: the current and previous node lists, located with bulk node fetches;
+- relations: their members (relation/full), previous members included.
+
+Tiles are then covered only around those geometries: the tiles crossed by
+each way (plus a buffer, since strokes and labels spill across tile edges),
+the tiles around each node and the interior of closed ways and
+multipolygon/boundary relations. Coverage is computed at one zoom (the
+deepest that fits CHANGESET_COVER_MAX_TILES) and yielded as expire-style
+"z/x/y" lines, so the prefix BAN stream expands it to the requested zooms.
+
+Anything that cannot be located (a way node deleted since, an element
+the API refuses, too many API calls) raises GeometryUnavailable and the caller falls back to
+the changeset bbox.
+"""
+import math
+import os
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import httpx
+
+from utils.osm_api import get_xml
+from utils.tile_expansion import xkey_zoom
+from utils.utils import get_logger
+from utils.varnish_purger import VARNISH_BAN_MODE
+
+logger = get_logger()
+
+# Zoom at which coverage is computed; the BAN expansion covers the other zooms
+CHANGESET_COVER_ZOOM = int(os.getenv("CHANGESET_COVER_ZOOM", "16"))
+# Buffer around geometries, as a fraction of a tile
+CHANGESET_COVER_BUFFER = float(os.getenv("CHANGESET_COVER_BUFFER", "0.0625"))
+CHANGESET_COVER_MAX_TILES = int(os.getenv("CHANGESET_COVER_MAX_TILES", "100000"))
+CHANGESET_MAX_API_REQUESTS = int(os.getenv("CHANGESET_MAX_API_REQUESTS", "50"))
+# Ids per bulk /nodes, /ways or /relations request (keeps the URL short)
+_BULK_IDS = 400
+_MAX_LAT = 85.0511287798
+_AREA_RELATIONS = {"multipolygon", "boundary"}
+
+LonLat = Tuple[float, float]
+
+
+class GeometryUnavailable(Exception):
+    """The changeset's geometries could not be resolved; use its bbox instead."""
+
+
+class ChangesetGeometry:
+    """Points, lines and areas touched by a changeset, in lon/lat."""
+
+    def __init__(self):
+        self.points: List[LonLat] = []
+        self.lines: List[List[LonLat]] = []
+        # Each area is a set of rings (or ring pieces) filled with even-odd
+        self.areas: List[List[List[LonLat]]] = []
+        self.elements = 0
+        self.api_requests = 0
+
+    def __bool__(self):
+        return bool(self.points or self.lines or self.areas)
+
+
+class _Resolver:
+    """Turns an osmChange into ChangesetGeometry with a bounded number of API calls."""
+
+    def __init__(self, api_base_url: str, max_requests: int):
+        self.api = f"{api_base_url.rstrip('/')}/api/0.6"
+        self.max_requests = max_requests
+        self.requests = 0
+        self.coords: Dict[int, LonLat] = {}
+        # (node refs, is_area) of ways to draw, area relations as lists of member ways
+        self.ways: List[Tuple[List[int], bool]] = []
+        self.area_relations: List[List[List[int]]] = []
+        self.points: List[LonLat] = []
+
+    async def _get(self, path: str) -> ET.Element:
+        if self.requests >= self.max_requests:
+            raise GeometryUnavailable(f"more than {self.max_requests} API requests needed")
+        self.requests += 1
+        try:
+            return await get_xml(f"{self.api}/{path}")
+        except (httpx.HTTPError, ET.ParseError) as e:
+            raise GeometryUnavailable(f"GET {path}: {str(e).splitlines()[0] if str(e) else type(e).__name__}")
+
+    async def _bulk(self, kind: str, ids: List[str]) -> List[ET.Element]:
+        """Fetch elements with /nodes?nodes=..., ids may carry a version ("12v3")."""
+        out = []
+        for i in range(0, len(ids), _BULK_IDS):
+            chunk = ",".join(ids[i:i + _BULK_IDS])
+            out.extend((await self._get(f"{kind}s?{kind}s={chunk}")).findall(kind))
+        return out
+
+    def _add_node(self, el: ET.Element) -> Optional[LonLat]:
+        if el.get("lat") is None or el.get("lon") is None:
+            return None
+        lonlat = (float(el.get("lon")), float(el.get("lat")))
+        self.coords.setdefault(int(el.get("id")), lonlat)
+        return lonlat
+
+    @staticmethod
+    def _refs(way: ET.Element) -> List[int]:
+        return [int(nd.get("ref")) for nd in way.findall("nd")]
+
+    def _add_way(self, refs: List[int]):
+        if refs:
+            closed = len(refs) >= 4 and refs[0] == refs[-1]
+            self.ways.append((refs, closed))
+
+    def _add_relation_members(self, rel: ET.Element, way_refs: Dict[int, List[int]]):
+        """Draw a relation from its members; areas are filled, others drawn as lines."""
+        tags = {t.get("k"): t.get("v") for t in rel.findall("tag")}
+        member_ways = [way_refs[int(m.get("ref"))] for m in rel.findall("member")
+                       if m.get("type") == "way" and int(m.get("ref")) in way_refs]
+        if tags.get("type") in _AREA_RELATIONS:
+            self.area_relations.append(member_ways)
+        else:
+            for refs in member_ways:
+                self.ways.append((refs, False))
+        for m in rel.findall("member"):
+            if m.get("type") == "node" and int(m.get("ref")) in self.coords:
+                self.points.append(self.coords[int(m.get("ref"))])
+
+    async def resolve(self, changeset_id: int) -> ChangesetGeometry:
+        osc = await self._get(f"changeset/{changeset_id}/download")
+        old_nodes, old_ways, old_relations, relations = [], [], [], []
+        elements = 0
+        for action in osc:
+            for el in action:
+                elements += 1
+                version = int(el.get("version", "1"))
+                previous = f"{el.get('id')}v{version - 1}" if action.tag != "create" and version > 1 else None
+                if el.tag == "node":
+                    lonlat = self._add_node(el)
+                    if lonlat is not None:
+                        self.points.append(lonlat)
+                    if previous:
+                        old_nodes.append(previous)
+                elif el.tag == "way":
+                    self._add_way(self._refs(el))
+                    if previous:
+                        old_ways.append(previous)
+                elif el.tag == "relation":
+                    if action.tag != "delete":
+                        relations.append(el.get("id"))
+                    if previous:
+                        old_relations.append(previous)
+
+        # Previous node positions (moved or deleted nodes)
+        for el in await self._bulk("node", old_nodes):
+            lonlat = self._add_node(el)
+            if lonlat is not None:
+                self.points.append(lonlat)
+        for el in await self._bulk("way", old_ways):
+            self._add_way(self._refs(el))
+
+        # Current relations with their members' geometry
+        for rel_id in relations:
+            full = await self._get(f"relation/{rel_id}/full")
+            for node in full.findall("node"):
+                self._add_node(node)
+            way_refs = {int(w.get("id")): self._refs(w) for w in full.findall("way")}
+            for rel in full.findall("relation"):
+                if rel.get("id") == rel_id:
+                    self._add_relation_members(rel, way_refs)
+
+        # Previous relation versions: members that may have been removed
+        old_rels = await self._bulk("relation", old_relations)
+        member_ids = sorted({m.get("ref") for rel in old_rels for m in rel.findall("member") if m.get("type") == "way"})
+        way_refs = {int(w.get("id")): self._refs(w) for w in await self._bulk("way", member_ids)}
+        for rel in old_rels:
+            self._add_relation_members(rel, way_refs)
+
+        # Locate every node the ways reference
+        needed = {ref for refs, _ in self.ways for ref in refs}
+        needed |= {ref for rel in self.area_relations for refs in rel for ref in refs}
+        missing = sorted(needed - self.coords.keys())
+        for el in await self._bulk("node", [str(ref) for ref in missing]):
+            self._add_node(el)
+        unresolved = needed - self.coords.keys()
+        if unresolved:
+            raise GeometryUnavailable(f"{len(unresolved)} node(s) without a location, e.g. {sorted(unresolved)[:3]}")
+
+        geometry = ChangesetGeometry()
+        geometry.points = self.points
+        for refs, closed in self.ways:
+            ring = [self.coords[ref] for ref in refs]
+            if closed:
+                geometry.areas.append([ring])
+            else:
+                geometry.lines.append(ring)
+        for member_ways in self.area_relations:
+            geometry.areas.append([[self.coords[ref] for ref in refs] for refs in member_ways])
+        geometry.elements = elements
+        geometry.api_requests = self.requests
+        return geometry
+
+
+async def fetch_changeset_geometry(
+    changeset_id: int,
+    api_base_url: str = "https://www.openhistoricalmap.org",
+    max_requests: int = CHANGESET_MAX_API_REQUESTS,
+) -> ChangesetGeometry:
+    """Download a changeset and locate everything it touched; raises GeometryUnavailable."""
+    geometry = await _Resolver(api_base_url, max_requests).resolve(changeset_id)
+    if not geometry:
+        raise GeometryUnavailable("no locatable elements")
+    return geometry
+
+
+def _project(lonlat: LonLat, n: int) -> Tuple[float, float]:
+    """lon/lat -> fractional tile coordinates at a zoom with n tiles per side."""
+    lon, lat = lonlat
+    lat = max(-_MAX_LAT, min(_MAX_LAT, lat))
+    fx = (lon + 180.0) / 360.0 * n
+    fy = (1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n
+    return fx, fy
+
+
+def _segment_tiles(a: Tuple[float, float], b: Tuple[float, float], buffer: float) -> Iterator[Tuple[int, int]]:
+    """Tiles within buffer of segment a-b: per column, the y range the segment spans there."""
+    (x0, y0), (x1, y1) = sorted((a, b))
+    for col in range(math.floor(x0 - buffer), math.floor(x1 + buffer) + 1):
+        lo, hi = max(x0, col - buffer), min(x1, col + 1 + buffer)
+        if x1 > x0:
+            ya = y0 + (y1 - y0) * (lo - x0) / (x1 - x0)
+            yb = y0 + (y1 - y0) * (hi - x0) / (x1 - x0)
+        else:
+            ya, yb = y0, y1
+        for row in range(math.floor(min(ya, yb) - buffer), math.floor(max(ya, yb) + buffer) + 1):
+            yield col, row
+
+
+def _fill_tiles(rings: List[List[Tuple[float, float]]]) -> Iterator[Tuple[int, int]]:
+    """Tiles whose centre is inside the rings (even-odd), scanning each tile row."""
+    edges = [(p, q) for ring in rings for p, q in zip(ring, ring[1:]) if p[1] != q[1]]
+    if not edges:
+        return
+    ys = [p[1] for ring in rings for p in ring]
+    for row in range(math.floor(min(ys)), math.floor(max(ys)) + 1):
+        yc = row + 0.5
+        xs = sorted(
+            p[0] + (yc - p[1]) * (q[0] - p[0]) / (q[1] - p[1])
+            for p, q in edges
+            if min(p[1], q[1]) <= yc < max(p[1], q[1])
+        )
+        for xa, xb in zip(xs[::2], xs[1::2]):
+            for col in range(math.ceil(xa - 0.5), math.floor(xb - 0.5) + 1):
+                yield col, row
+
+
+def estimate_cover_tiles(geometry: ChangesetGeometry, zoom: int, buffer: float = CHANGESET_COVER_BUFFER) -> int:
+    """Upper bound of the tiles covered at zoom: path lengths plus area bboxes, in tiles."""
+    n = 1 << zoom
+    width = 1 + 2 * buffer
+    total = len(geometry.points) * math.ceil(width) ** 2
+    for line in geometry.lines + [ring for area in geometry.areas for ring in area]:
+        pts = [_project(p, n) for p in line]
+        for (x0, y0), (x1, y1) in zip(pts, pts[1:]):
+            total += math.ceil((abs(x1 - x0) + abs(y1 - y0) + 2) * width)
+    for area in geometry.areas:
+        pts = [_project(p, n) for ring in area for p in ring]
+        if pts:
+            dx = max(p[0] for p in pts) - min(p[0] for p in pts)
+            dy = max(p[1] for p in pts) - min(p[1] for p in pts)
+            total += math.ceil(dx + 1) * math.ceil(dy + 1)
+    return total
+
+
+def choose_cover_zoom(
+    geometry: ChangesetGeometry,
+    max_zoom: int = CHANGESET_COVER_ZOOM,
+    max_tiles: int = CHANGESET_COVER_MAX_TILES,
+    buffer: float = CHANGESET_COVER_BUFFER,
+    zoom_levels: Optional[Iterable[int]] = None,
+) -> int:
+    """Deepest zoom <= max_zoom whose estimated coverage fits max_tiles.
+
+    In xkey mode (given the zoom_levels to purge) a cover tile expands to all
+    of its descendant keys, so the zoom stays at or above the deepest key
+    zoom <= max_zoom and the budget counts keys; raises GeometryUnavailable
+    when they do not fit.
+    """
+    key_zooms = sorted({xkey_zoom(z) for z in zoom_levels}) if zoom_levels and VARNISH_BAN_MODE == "xkey" else []
+    min_zoom = max([kz for kz in key_zooms if kz <= max_zoom], default=0)
+    zoom = max_zoom
+    while zoom > min_zoom and estimate_cover_tiles(geometry, zoom, buffer) > max_tiles:
+        zoom -= 1
+    if key_zooms:
+        tiles = estimate_cover_tiles(geometry, zoom, buffer)
+        keys = sum(
+            estimate_cover_tiles(geometry, kz, buffer) if kz <= zoom else tiles << 2 * (kz - zoom) for kz in key_zooms
+        )
+        if keys > max_tiles:
+            raise GeometryUnavailable(f"about {keys} xkey purges needed (max {max_tiles})")
+    return zoom
+
+
+def iter_cover_tiles(geometry: ChangesetGeometry, zoom: int, buffer: float = CHANGESET_COVER_BUFFER) -> Iterator[str]:
+    """Yield the distinct "z/x/y" tiles at zoom around the geometry, lines and points first."""
+    n = 1 << zoom
+    seen: Set[Tuple[int, int]] = set()
+
+    def emit(tiles):
+        for col, row in tiles:
+            if 0 <= col < n and 0 <= row < n and (col, row) not in seen:
+                seen.add((col, row))
+                yield f"{zoom}/{col}/{row}"
+
+    for point in geometry.points:
+        p = _project(point, n)
+        yield from emit(_segment_tiles(p, p, buffer))
+    for line in geometry.lines + [ring for area in geometry.areas for ring in area]:
+        pts = [_project(p, n) for p in line]
+        if len(pts) == 1:
+            pts = pts * 2
+        for a, b in zip(pts, pts[1:]):
+            yield from emit(_segment_tiles(a, b, buffer))
+    for area in geometry.areas:
+        yield from emit(_fill_tiles([[_project(p, n) for p in ring] for ring in area]))
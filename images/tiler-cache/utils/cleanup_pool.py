@@ -0,0 +1,97 @@
+"""Bounded worker pool for Varnish cleanup jobs.
+
+A fixed number of worker threads drain a bounded priority queue, so an
+import burst cannot start hundreds of concurrent cleanups against Varnish
+and S3. Immediate cleanups outrank delayed ones; within a priority jobs
+run in submission order. The SQS loop calls wait_for_capacity() before
+receiving, which slows polling while the queue is full.
+"""
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from utils.metrics import CLEANUP_QUEUE_DEPTH, CLEANUP_RUNNING, CLEANUP_SECONDS
+from utils.utils import get_logger
+
+logger = get_logger()
+
+PRIORITY_IMMEDIATE = 0
+PRIORITY_DELAYED = 1
+
+
+class _Job:
+    __slots__ = ("fn", "args", "label", "future", "enqueued_at")
+
+    def __init__(self, fn, args, label):
+        self.fn = fn
+        self.args = args
+        self.label = label
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class CleanupWorkerPool:
+    """Fixed-size thread pool fed by a bounded priority queue."""
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queue = queue.PriorityQueue(maxsize=max_queue)
+        self._seq = itertools.count()
+        self._space = threading.Condition()
+        self._running = 0
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"cleanup-{i}", daemon=True).start()
+
+    def submit(self, fn, *args, priority: int = PRIORITY_IMMEDIATE, label: str = "") -> Future:
+        """Queue fn(*args); blocks while the queue is full. Returns a Future."""
+        job = _Job(fn, args, label or getattr(fn, "__name__", "job"))
+        self._queue.put((priority, next(self._seq), job))
+        CLEANUP_QUEUE_DEPTH.set(self.depth())
+        return job.future
+
+    def depth(self) -> int:
+        """Jobs waiting in the queue (not counting the ones running)."""
+        return self._queue.qsize()
+
+    def running(self) -> int:
+        return self._running
+
+    def wait_for_capacity(self, timeout: float = None) -> bool:
+        """Block until the queue has room. Returns False on timeout."""
+        with self._space:
+            return self._space.wait_for(lambda: self._queue.qsize() < self.max_queue, timeout)
+
+    def _worker(self):
+        while True:
+            _priority, _seq, job = self._queue.get()
+            CLEANUP_QUEUE_DEPTH.set(self.depth())
+            with self._space:
+                self._space.notify_all()
+            if not job.future.set_running_or_notify_cancel():
+                self._queue.task_done()
+                continue
+            with self._space:
+                self._running += 1
+                CLEANUP_RUNNING.set(self._running)
+            started = time.monotonic()
+            wait = started - job.enqueued_at
+            CLEANUP_SECONDS.labels("wait").observe(wait)
+            try:
+                job.future.set_result(job.fn(*job.args))
+                status = "ok"
+            except Exception as e:
+                job.future.set_exception(e)
+                status = "error"
+            finally:
+                with self._space:
+                    self._running -= 1
+                    CLEANUP_RUNNING.set(self._running)
+                self._queue.task_done()
+            CLEANUP_SECONDS.labels("run").observe(time.monotonic() - started)
+            logger.info(
+                f"[POOL] {job.label} {status} | wait={wait:.1f}s run={time.monotonic() - started:.1f}s "
+                f"| queued={self.depth()} running={self._running}/{self.workers}"
+            )
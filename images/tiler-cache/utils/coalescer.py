@@ -0,0 +1,92 @@
+"""Coalescing window for cleanups of the same type.
+
+Minute replication writes one expire file per minute and consecutive files
+share most of their prefixes. Instead of one cleanup per file, files of
+the same cleanup type that arrive within window_seconds of the first one
+are handed to a single run_batch(paths, cleanup_type, event_times) call,
+which expands them into one deduplicated BAN set. event_times holds each
+file's own event time, in the order of paths: a batch's files can be
+split differently in the delayed passes, so the ban ledger needs the
+time of every file, not the newest of the batch.
+"""
+import threading
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+
+from utils.utils import get_logger
+
+logger = get_logger()
+
+
+class _Batch:
+    __slots__ = ("paths", "future", "timer")
+
+    def __init__(self):
+        self.paths: Dict[str, float] = {}  # s3_path -> event time, keeps arrival order
+        self.future = Future()
+        self.timer: Optional[threading.Timer] = None
+
+
+class CleanupCoalescer:
+    """Groups cleanup requests per type and flushes each group after a window.
+
+    run_batch must return a Future; its outcome is passed on to every
+    caller that joined the batch. A group is flushed early when it reaches
+    max_files, and right away when window_seconds <= 0.
+    """
+
+    def __init__(self, run_batch: Callable[..., Future], window_seconds: float, max_files: int):
+        self.run_batch = run_batch
+        self.window_seconds = window_seconds
+        self.max_files = max(1, max_files)
+        self._lock = threading.Lock()
+        self._open: Dict[str, _Batch] = {}
+
+    def add(self, cleanup_type: str, s3_path: str, event_time: float) -> Future:
+        """Add an expire file to the open batch of its type. Returns the batch's Future."""
+        with self._lock:
+            batch = self._open.get(cleanup_type)
+            if batch is None:
+                batch = self._open[cleanup_type] = _Batch()
+                if self.window_seconds > 0:
+                    batch.timer = threading.Timer(self.window_seconds, self.flush, args=(cleanup_type, batch))
+                    batch.timer.daemon = True
+                    batch.timer.start()
+            batch.paths[s3_path] = max(batch.paths.get(s3_path, 0.0), event_time)
+            full = self.window_seconds <= 0 or len(batch.paths) >= self.max_files
+        if full:
+            self.flush(cleanup_type, batch)
+        return batch.future
+
+    def flush(self, cleanup_type: str, batch: Optional[_Batch] = None):
+        """Close the open batch of a type (only if it is still `batch`) and run it."""
+        with self._lock:
+            current = self._open.get(cleanup_type)
+            if current is None or (batch is not None and current is not batch):
+                return
+            del self._open[cleanup_type]
+        if current.timer is not None:
+            current.timer.cancel()
+        paths = list(current.paths)
+        logger.info(f"[COALESCE] {cleanup_type}: {len(paths)} expire file(s) in one cleanup")
+        try:
+            inner = self.run_batch(paths, cleanup_type, [current.paths[p] for p in paths])
+        except Exception as e:
+            current.future.set_exception(e)
+            return
+        inner.add_done_callback(lambda f: _copy_outcome(f, current.future))
+
+    def flush_all(self):
+        with self._lock:
+            types = list(self._open)
+        for cleanup_type in types:
+            self.flush(cleanup_type)
+
+
+def _copy_outcome(source: Future, target: Future):
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -0,0 +1,152 @@
+"""Tiler DB liveness for the SQS processor.
+
+The processor only consumes messages while the tiler PostgreSQL database
+is up. Instead of opening a fresh connection for every message, a
+PostgresProbe keeps a small psycopg2 pool with a long-lived connection and
+checks it with SELECT 1 (statement_timeout bounded); a connection that
+fails is closed and the next probe opens a new one. A HealthWatcher
+thread probes every POSTGRES_PROBE_INTERVAL seconds so the polling loop
+reads a flag and never waits on connection setup.
+"""
+import os
+import threading
+import time
+from typing import Optional
+
+import psycopg2
+from psycopg2 import pool
+
+from config import Config
+from utils.utils import get_logger
+
+logger = get_logger()
+
+POSTGRES_PROBE_INTERVAL = float(os.getenv("POSTGRES_PROBE_INTERVAL", "5"))
+POSTGRES_PROBE_TIMEOUT = int(os.getenv("POSTGRES_PROBE_TIMEOUT", "5"))
+# Down for longer than this, the processor exits so the container restarts
+POSTGRES_DOWN_EXIT_SECONDS = float(os.getenv("POSTGRES_DOWN_EXIT_SECONDS", "15"))
+POSTGRES_POOL_MAX = int(os.getenv("POSTGRES_POOL_MAX", "2"))
+
+
+class PostgresProbe:
+    """SELECT 1 over a pooled connection."""
+
+    def __init__(self, timeout: int = POSTGRES_PROBE_TIMEOUT):
+        self.timeout = timeout
+        self._pool: Optional[pool.ThreadedConnectionPool] = None
+        self._lock = threading.Lock()
+        self._healthy = False
+        self.error: Optional[str] = None
+
+    def _get_pool(self) -> pool.ThreadedConnectionPool:
+        if self._pool is None:
+            # minconn=0: nothing is opened until the first probe
+            self._pool = pool.ThreadedConnectionPool(
+                0,
+                POSTGRES_POOL_MAX,
+                host=Config.POSTGRES_HOST,
+                port=Config.POSTGRES_PORT,
+                database=Config.POSTGRES_DB,
+                user=Config.POSTGRES_USER,
+                password=Config.POSTGRES_PASSWORD,
+                connect_timeout=self.timeout,
+                application_name="tiler-cache",
+                keepalives=1,
+                keepalives_idle=30,
+                keepalives_interval=10,
+                keepalives_count=3,
+                options=f"-c statement_timeout={self.timeout * 1000}",
+            )
+        return self._pool
+
+    def _select_one(self):
+        db_pool = self._get_pool()
+        conn = db_pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+        except Exception:
+            # A failed connection is dropped; the next probe opens a new one
+            db_pool.putconn(conn, close=True)
+            raise
+        db_pool.putconn(conn)
+
+    def check(self) -> bool:
+        """True if the database answers SELECT 1 now."""
+        with self._lock:
+            try:
+                self._select_one()
+                if not self._healthy:
+                    logger.info("[DB] PostgreSQL database is reachable")
+                self._healthy, self.error = True, None
+            except (psycopg2.Error, pool.PoolError) as e:
+                if self._healthy or self.error is None:
+                    logger.error(f"[DB] PostgreSQL database is not reachable: {e}")
+                self._healthy, self.error = False, str(e).strip()
+            return self._healthy
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+
+class HealthWatcher:
+    """Probes in the background; the SQS loop gates on healthy / down_for()."""
+
+    def __init__(self, probe: PostgresProbe, interval: float = POSTGRES_PROBE_INTERVAL):
+        self.probe = probe
+        self.interval = interval
+        self._up = threading.Event()
+        self._down_since: Optional[float] = None
+        self._started = False
+
+    @property
+    def healthy(self) -> bool:
+        return self._up.is_set()
+
+    def down_for(self) -> float:
+        """Seconds since the database was last seen up (0 while healthy)."""
+        since = self._down_since
+        return 0.0 if since is None else time.monotonic() - since
+
+    def _update(self):
+        if self.probe.check():
+            self._down_since = None
+            self._up.set()
+        else:
+            if self._down_since is None:
+                self._down_since = time.monotonic()
+            self._up.clear()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self._update()
+
+    def start(self) -> "HealthWatcher":
+        """Probe once synchronously, then keep probing in a daemon thread."""
+        if not self._started:
+            self._started = True
+            self._update()
+            threading.Thread(target=self._run, name="db-health", daemon=True).start()
+        return self
+
+    def wait_healthy(self, timeout: float) -> bool:
+        return self._up.wait(timeout)
+
+
+_probe: Optional[PostgresProbe] = None
+_probe_lock = threading.Lock()
+
+
+def get_probe() -> PostgresProbe:
+    """Process-wide probe."""
+    global _probe
+    with _probe_lock:
+        if _probe is None:
+            _probe = PostgresProbe()
+    return _probe
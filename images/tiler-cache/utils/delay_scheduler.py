@@ -0,0 +1,194 @@
+"""SQLite-backed scheduler for delayed Varnish cleanups.
+
+SQS caps DelaySeconds at 15 minutes, so 1h/3h retries used to be received
+over and over until they were due. Delayed cleanups are now stored locally
+with their due time and fired by a single runner thread that sleeps until
+the earliest one is due (or until an earlier job is scheduled). Jobs live
+in SQLite, so pending ones survive restarts; a job that was running when
+the process died is picked up again on the next start. A job whose cleanup
+fails is retried with exponential backoff (DELAY_RETRY_BACKOFF, doubled per
+attempt) up to DELAY_RETRY_MAX times, then dropped with an error.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from utils.sqlite_store import SQLiteStore
+from utils.utils import get_logger
+
+logger = get_logger()
+
+_DB_PATH = os.getenv("DELAY_SCHEDULER_DB", "/data/tiler_cache_delays.db")
+DELAY_RETRY_MAX = int(os.getenv("DELAY_RETRY_MAX", 5))
+DELAY_RETRY_BACKOFF = float(os.getenv("DELAY_RETRY_BACKOFF", 60))
+_wakeup = threading.Event()
+
+
+def _init_tables(conn):
+    """Create tables and indexes."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS delayed_cleanups (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            s3_path       TEXT    NOT NULL,
+            cleanup_type  TEXT    NOT NULL,
+            event_time    REAL    NOT NULL,
+            due_at        REAL    NOT NULL,
+            status        TEXT    NOT NULL DEFAULT 'pending',
+            attempts      INTEGER NOT NULL DEFAULT 0,
+            UNIQUE(s3_path, cleanup_type)
+        )
+    """)
+    # Databases created before retries were tracked
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(delayed_cleanups)")}
+    if "attempts" not in columns:
+        conn.execute("ALTER TABLE delayed_cleanups ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_delayed_cleanups_due
+        ON delayed_cleanups(status, due_at)
+    """)
+    conn.commit()
+
+
+_store = SQLiteStore(_DB_PATH, _init_tables, row_factory=sqlite3.Row)
+
+
+def schedule(s3_path: str, cleanup_type: str, event_time: float, delay_seconds: int) -> bool:
+    """Schedule a cleanup at event_time + delay_seconds. Duplicates are ignored.
+
+    Returns True if a new job was stored.
+    """
+    due_at = event_time + delay_seconds
+    with _store.connection() as conn:
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO delayed_cleanups (s3_path, cleanup_type, event_time, due_at)
+            VALUES (?, ?, ?, ?)
+        """, (s3_path, cleanup_type, event_time, due_at))
+        conn.commit()
+        created = cur.rowcount > 0
+    if created:
+        _wakeup.set()
+    return created
+
+
+def claim_due(limit: int, now: float = None):
+    """Mark up to `limit` due jobs as running and return them, earliest first."""
+    now = time.time() if now is None else now
+    with _store.connection() as conn:
+        rows = conn.execute("""
+            SELECT * FROM delayed_cleanups
+            WHERE status = 'pending' AND due_at <= ?
+            ORDER BY due_at
+            LIMIT ?
+        """, (now, limit)).fetchall()
+        if rows:
+            conn.executemany(
+                "UPDATE delayed_cleanups SET status = 'running' WHERE id = ?",
+                [(r["id"],) for r in rows],
+            )
+            conn.commit()
+        return [dict(r) for r in rows]
+
+
+def complete(job_id: int):
+    """Remove a finished job."""
+    with _store.connection() as conn:
+        conn.execute("DELETE FROM delayed_cleanups WHERE id = ?", (job_id,))
+        conn.commit()
+
+
+def retry(job_id: int, attempts: int, due_at: float):
+    """Put a failed job back to 'pending' for another attempt at due_at."""
+    with _store.connection() as conn:
+        conn.execute(
+            "UPDATE delayed_cleanups SET status = 'pending', attempts = ?, due_at = ? WHERE id = ?",
+            (attempts, due_at, job_id),
+        )
+        conn.commit()
+    _wakeup.set()
+
+
+def _finish(future, job: dict):
+    """Remove a job whose cleanup succeeded; retry a failed one with backoff, or drop it past DELAY_RETRY_MAX."""
+    if not future.cancelled() and future.exception() is None:
+        complete(job["id"])
+        return
+    name = f"{job['cleanup_type']} {os.path.basename(job['s3_path'])}"
+    attempts = job["attempts"] + 1
+    if attempts > DELAY_RETRY_MAX:
+        logger.error(f"[DELAYED] {name} failed {attempts} times; dropping it (TTL is fallback)")
+        complete(job["id"])
+        return
+    delay = DELAY_RETRY_BACKOFF * 2 ** (attempts - 1)
+    logger.warning(f"[DELAYED] {name} failed (attempt {attempts}/{DELAY_RETRY_MAX}); retrying in {delay:.0f}s")
+    retry(job["id"], attempts, time.time() + delay)
+
+
+def release(job_id: int):
+    """Put a claimed job back to 'pending' so it is fired again."""
+    with _store.connection() as conn:
+        conn.execute("UPDATE delayed_cleanups SET status = 'pending' WHERE id = ?", (job_id,))
+        conn.commit()
+
+
+def requeue_running():
+    """Return jobs left 'running' by a previous process to 'pending'."""
+    with _store.connection() as conn:
+        cur = conn.execute("UPDATE delayed_cleanups SET status = 'pending' WHERE status = 'running'")
+        conn.commit()
+        return cur.rowcount
+
+
+def next_due_at():
+    """Due time of the earliest pending job, or None."""
+    with _store.connection() as conn:
+        row = conn.execute(
+            "SELECT MIN(due_at) FROM delayed_cleanups WHERE status = 'pending'"
+        ).fetchone()
+        return row[0]
+
+
+def summary():
+    """Return job counts by status for logging."""
+    with _store.connection() as conn:
+        rows = conn.execute(
+            "SELECT status, COUNT(*) AS cnt FROM delayed_cleanups GROUP BY status"
+        ).fetchall()
+        return {r["status"]: r["cnt"] for r in rows}
+
+
+def wait_for_next(max_wait: float, min_wait: float = 0):
+    """Sleep until the earliest pending job is due, a new job is scheduled or max_wait passes."""
+    _wakeup.clear()
+    due = next_due_at()
+    timeout = max_wait if due is None else max(min_wait, min(max_wait, due - time.time()))
+    if timeout > 0:
+        _wakeup.wait(timeout)
+
+
+def run(submit, batch_size: int, max_wait: float = 30):
+    """Fire due jobs forever through submit(s3_path, cleanup_type, event_time) -> Future."""
+    requeued = requeue_running()
+    logger.info(f"[DELAYED] Scheduler started | jobs: {summary()} | requeued after restart: {requeued}")
+    while True:
+        try:
+            jobs = claim_due(batch_size)
+        except Exception as e:
+            logger.error(f"[DELAYED] Scheduler error: {e}")
+            jobs = []
+        failed = False
+        for job in jobs:
+            late = time.time() - job["due_at"]
+            logger.info(
+                f"[DELAYED] Firing {job['cleanup_type']} {os.path.basename(job['s3_path'])} "
+                f"({late:.0f}s after due)"
+            )
+            try:
+                future = submit(job["s3_path"], job["cleanup_type"], job["event_time"])
+                future.add_done_callback(lambda f, job=job: _finish(f, job))
+            except Exception as e:
+                logger.error(f"[DELAYED] Could not submit job {job['id']}: {e}")
+                release(job["id"])
+                failed = True
+        wait_for_next(max_wait, min_wait=5 if failed else 0)
@@ -0,0 +1,131 @@
+"""SQLite store of S3 expire-file events already handled.
+
+SQS delivers at least once and S3 can notify twice for the same object,
+so the same expire file may arrive several times. Each delivery is claimed
+here by (object key, ETag): only the first runs the immediate cleanup and
+schedules the delayed ones; repeats are acknowledged and skipped.
+
+An event is 'processing' until its cleanup finishes and 'done' after; a
+failed cleanup releases it so a later delivery of the same event runs.
+'processing' rows left by a process that died are released on start, so
+the redelivered message runs again. Entries are evicted least recently
+seen first once there are more than S3_EVENT_DEDUP_MAX_ENTRIES.
+"""
+
+import os
+import sqlite3
+import time
+
+from utils.sqlite_store import SQLiteStore
+from utils.utils import get_logger
+
+logger = get_logger()
+
+_DB_PATH = os.getenv("S3_EVENT_DEDUP_DB", "/data/tiler_cache_events.db")
+S3_EVENT_DEDUP_MAX_ENTRIES = int(os.getenv("S3_EVENT_DEDUP_MAX_ENTRIES", "100000"))
+# Evict at most every this many new events
+_EVICT_EVERY = 1000
+
+_inserted = 0
+
+
+def _init_tables(conn):
+    """Create tables and indexes."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS s3_events (
+            object_key  TEXT    NOT NULL,
+            etag        TEXT    NOT NULL,
+            status      TEXT    NOT NULL DEFAULT 'processing',
+            first_seen  REAL    NOT NULL,
+            last_seen   REAL    NOT NULL,
+            deliveries  INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (object_key, etag)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_s3_events_last_seen
+        ON s3_events(last_seen)
+    """)
+    conn.commit()
+
+
+_store = SQLiteStore(_DB_PATH, _init_tables, row_factory=sqlite3.Row)
+
+
+def claim(object_key: str, etag: str, now: float = None) -> bool:
+    """Record a delivery of the event. Returns True for the first one, False for repeats."""
+    global _inserted
+    now = time.time() if now is None else now
+    etag = (etag or "").strip('"')
+    with _store.connection() as conn:
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO s3_events (object_key, etag, first_seen, last_seen)
+            VALUES (?, ?, ?, ?)
+        """, (object_key, etag, now, now))
+        created = cur.rowcount > 0
+        if not created:
+            conn.execute("""
+                UPDATE s3_events SET deliveries = deliveries + 1, last_seen = ?
+                WHERE object_key = ? AND etag = ?
+            """, (now, object_key, etag))
+        conn.commit()
+        if created:
+            _inserted += 1
+            if _inserted % _EVICT_EVERY == 0:
+                _evict(conn)
+    return created
+
+
+def _evict(conn, max_entries: int = None):
+    """Delete the least recently seen events beyond max_entries (caller holds the lock)."""
+    max_entries = S3_EVENT_DEDUP_MAX_ENTRIES if max_entries is None else max_entries
+    cur = conn.execute("""
+        DELETE FROM s3_events WHERE last_seen <= (
+            SELECT last_seen FROM s3_events ORDER BY last_seen DESC LIMIT 1 OFFSET ?
+        )
+    """, (max_entries,))
+    conn.commit()
+    if cur.rowcount > 0:
+        logger.info(f"[DEDUP] Evicted {cur.rowcount} least recently seen events")
+    return cur.rowcount
+
+
+def complete(object_key: str, etag: str):
+    """Mark the event's cleanup as finished."""
+    with _store.connection() as conn:
+        conn.execute(
+            "UPDATE s3_events SET status = 'done' WHERE object_key = ? AND etag = ?",
+            (object_key, (etag or "").strip('"')),
+        )
+        conn.commit()
+
+
+def release(object_key: str, etag: str):
+    """Forget the event after its cleanup failed, so a later delivery runs it again."""
+    with _store.connection() as conn:
+        conn.execute(
+            "DELETE FROM s3_events WHERE object_key = ? AND etag = ?",
+            (object_key, (etag or "").strip('"')),
+        )
+        conn.commit()
+
+
+def release_processing():
+    """Forget events left 'processing' by a previous process so their redelivery runs."""
+    with _store.connection() as conn:
+        cur = conn.execute("DELETE FROM s3_events WHERE status = 'processing'")
+        conn.commit()
+        return cur.rowcount
+
+
+def summary():
+    """Event counts by status and total repeat deliveries, for logging."""
+    with _store.connection() as conn:
+        rows = conn.execute("""
+            SELECT status, COUNT(*) AS cnt, SUM(deliveries - 1) AS repeats
+            FROM s3_events GROUP BY status
+        """).fetchall()
+    return {
+        "events": {r["status"]: r["cnt"] for r in rows},
+        "repeat_deliveries": sum(r["repeats"] or 0 for r in rows),
+    }
@@ -0,0 +1,170 @@
+"""Prometheus metrics for the SQS processor and the API.
+
+sqs_processor.py and main.py run as two processes in one container, so
+prometheus_client runs in multiprocess mode: each process writes its
+samples to files under PROMETHEUS_MULTIPROC_DIR and GET /metrics on the
+API merges them. Import this module before anything else that imports
+prometheus_client, since the directory must be set first.
+
+Gauges only count live processes; files of processes that are gone are
+released when the next process imports this module.
+"""
+import os
+import re
+import time
+from typing import Iterable, Iterator
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/tiler_cache_metrics")
+METRICS_DIR = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+from prometheus_client import (  # noqa: E402
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+_COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+_AGE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 21600)
+
+# SQS
+SQS_RECEIVE_SECONDS = Histogram(
+    "tiler_cache_sqs_receive_seconds",
+    "Duration of SQS receive_message calls, long-poll wait included",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30),
+)
+SQS_MESSAGE_AGE_SECONDS = Histogram(
+    "tiler_cache_sqs_message_age_seconds",
+    "Age of received SQS messages (now - SentTimestamp)",
+    buckets=_AGE_BUCKETS,
+)
+SQS_MESSAGES = Counter(
+    "tiler_cache_sqs_messages_total",
+    "SQS messages handled, by kind (s3_event, duplicate, delayed, other, error)",
+    ["kind"],
+)
+SQS_IN_FLIGHT = Gauge(
+    "tiler_cache_sqs_in_flight_messages",
+    "S3 event messages waiting for their cleanup before deletion",
+    multiprocess_mode="livesum",
+)
+
+# Expire files
+EXPIRE_DOWNLOAD_SECONDS = Histogram(
+    "tiler_cache_expire_download_seconds",
+    "Time spent reading one expire file from S3",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+EXPIRE_FILE_TILES = Histogram(
+    "tiler_cache_expire_file_tiles",
+    "Tile lines per expire file",
+    buckets=_COUNT_BUCKETS,
+)
+EXPIRE_FILE_PREFIXES = Histogram(
+    "tiler_cache_expire_file_prefixes",
+    "Prefixes (xkey: keys) an expire file added to its cleanup's BAN set",
+    buckets=_COUNT_BUCKETS,
+)
+
+# Cleanup jobs
+CLEANUP_QUEUE_DEPTH = Gauge(
+    "tiler_cache_cleanup_queue_depth",
+    "Cleanup jobs waiting for a worker",
+    multiprocess_mode="livesum",
+)
+CLEANUP_RUNNING = Gauge(
+    "tiler_cache_cleanup_running",
+    "Cleanup jobs running",
+    multiprocess_mode="livesum",
+)
+CLEANUP_SECONDS = Histogram(
+    "tiler_cache_cleanup_seconds",
+    "Cleanup job time by stage (wait: queued, run: executing)",
+    ["stage"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+INVALIDATION_LAG_SECONDS = Histogram(
+    "tiler_cache_invalidation_lag_seconds",
+    "Seconds from receiving an S3 event to its immediate BANs finishing (newest event of the batch)",
+    buckets=_AGE_BUCKETS,
+)
+
+# Varnish BANs
+BAN_CHUNKS = Counter(
+    "tiler_cache_ban_chunks_total",
+    "BAN chunks (one regex or xkey header each) built, before fan-out to the nodes",
+)
+BAN_REGEX_BYTES = Counter(
+    "tiler_cache_ban_regex_bytes_total",
+    "Bytes of BAN regexes / xkey headers built",
+)
+BAN_REQUESTS = Counter(
+    "tiler_cache_ban_requests_total",
+    "BAN chunks delivered to a Varnish node, by result (ok, failed)",
+    ["node", "result"],
+)
+BAN_RETRIES = Counter(
+    "tiler_cache_ban_retries_total",
+    "BAN attempts beyond the first, per Varnish node",
+    ["node"],
+)
+BAN_SECONDS = Histogram(
+    "tiler_cache_ban_seconds",
+    "Time to deliver one BAN chunk to one Varnish node, retries included",
+    ["node"],
+)
+
+# BAN audit (utils.ban_audit, BAN_AUDIT=true)
+AUDIT_TILES = Counter(
+    "tiler_cache_audit_tiles_total",
+    "Cached tiles of the audit inventory per zoom: evicted and changed (needed), evicted but unchanged (over), changed but not evicted (missed)",
+    ["zoom", "kind"],
+)
+
+_DB_FILE = re.compile(r"_(\d+)\.db$")
+
+
+def _release_dead_processes():
+    """Drop the live-gauge files of processes that no longer exist."""
+    for name in os.listdir(METRICS_DIR):
+        match = _DB_FILE.search(name)
+        if not match:
+            continue
+        pid = int(match.group(1))
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            multiprocess.mark_process_dead(pid, METRICS_DIR)
+        except PermissionError:
+            pass
+
+
+_release_dead_processes()
+
+
+def timed_lines(lines: Iterable[str], histogram: Histogram = EXPIRE_DOWNLOAD_SECONDS) -> Iterator[str]:
+    """Yield lines unchanged, observing the time spent reading them (not consuming them)."""
+    spent = 0.0
+    iterator = iter(lines)
+    while True:
+        started = time.monotonic()
+        try:
+            line = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            spent += time.monotonic() - started
+        yield line
+    histogram.observe(spent)
+
+
+def render() -> bytes:
+    """Samples of every process, in the Prometheus text format."""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, METRICS_DIR)
+    return generate_latest(registry)
+
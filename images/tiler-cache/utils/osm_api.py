@@ -0,0 +1,87 @@
+"""Shared async client for the OpenHistoricalMap API.
+
+One pooled httpx.AsyncClient serves every request main.py makes to the
+OSM API (changeset metadata, downloads, element lookups), so concurrent
+cleanups reuse connections instead of each opening their own. Closed
+changesets never change: their bboxes are kept in an LRU cache.
+"""
+import os
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from typing import Optional
+
+import httpx
+
+OSM_API_TIMEOUT = float(os.getenv("OSM_API_TIMEOUT", "30"))
+OSM_API_MAX_CONNECTIONS = int(os.getenv("OSM_API_MAX_CONNECTIONS", "32"))
+CHANGESET_CACHE_SIZE = int(os.getenv("CHANGESET_CACHE_SIZE", "10000"))
+
+_BBOX_KEYS = ("min_lon", "min_lat", "max_lon", "max_lat")
+
+_client: Optional[httpx.AsyncClient] = None
+_cache: "OrderedDict[tuple, Optional[dict]]" = OrderedDict()
+
+
+class ChangesetNotFound(ValueError):
+    pass
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared pooled client; created on first use inside the running event loop."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=OSM_API_TIMEOUT,
+            limits=httpx.Limits(max_connections=OSM_API_MAX_CONNECTIONS, max_keepalive_connections=OSM_API_MAX_CONNECTIONS),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_xml(url: str) -> ET.Element:
+    """GET url and parse the XML body; raises httpx.HTTPError or ET.ParseError."""
+    response = await get_client().get(url)
+    response.raise_for_status()
+    return ET.fromstring(response.content)
+
+
+def _cache_get(key: tuple):
+    if key in _cache:
+        _cache.move_to_end(key)
+        return True, _cache[key]
+    return False, None
+
+
+def _cache_put(key: tuple, bbox: Optional[dict]):
+    _cache[key] = bbox
+    _cache.move_to_end(key)
+    while len(_cache) > CHANGESET_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+async def fetch_changeset_bbox(changeset_id: int, api_base_url: str) -> Optional[dict]:
+    """Bbox of a changeset, or None if it has none (no located edits).
+
+    Raises httpx.HTTPError, ET.ParseError or ChangesetNotFound; only closed
+    changesets are cached.
+    """
+    api_base_url = api_base_url.rstrip("/")
+    key = (api_base_url, changeset_id)
+    hit, bbox = _cache_get(key)
+    if hit:
+        return bbox
+    cs = (await get_xml(f"{api_base_url}/api/0.6/changeset/{changeset_id}")).find("changeset")
+    if cs is None:
+        raise ChangesetNotFound(f"Changeset {changeset_id} not found")
+    bbox = None
+    if all(cs.get(k) is not None for k in _BBOX_KEYS):
+        bbox = {k: float(cs.get(k)) for k in _BBOX_KEYS}
+    if cs.get("open") == "false":
+        _cache_put(key, bbox)
+    return bbox
@@ -0,0 +1,280 @@
+"""Tile popularity from Varnish access logs.
+
+Streams varnishncsa lines (default format, from a regular file that is
+followed across rotations, or from a named pipe) and keeps a
+memory-bounded popularity index per z/x/y:
+
+- a count-min sketch (depth x width counters) estimates the hit count of
+  any tile, never under-counting;
+- a top-K table keeps the hottest tiles and their estimates for listing.
+
+Counts decay exponentially with POPULARITY_HALF_LIFE, using forward decay:
+a hit at time t adds 2**((t - t0) / half_life), reads scale by the current
+factor, and everything is renormalised when the factor gets large, so old
+traffic fades without touching every counter on each hit.
+
+Only the SQS processor reads the log (get_tracker(), started at its
+startup), so a named pipe is never split between two readers. It writes
+a snapshot of the sketch to POPULARITY_SNAPSHOT every
+POPULARITY_SNAPSHOT_INTERVAL seconds; main.py serves /popularity from
+that snapshot (get_shared_tracker()), i.e. the counts the cache warmer
+ranks with. Hashes are stable across processes (crc32) so a loaded
+sketch answers the same as the live one.
+"""
+import os
+import re
+import stat
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from utils.utils import get_logger
+
+logger = get_logger()
+
+POPULARITY_LOG = os.getenv("POPULARITY_LOG", "").strip()
+POPULARITY_SKETCH_WIDTH = int(os.getenv("POPULARITY_SKETCH_WIDTH", "65536"))
+POPULARITY_SKETCH_DEPTH = int(os.getenv("POPULARITY_SKETCH_DEPTH", "4"))
+POPULARITY_TOP_K = int(os.getenv("POPULARITY_TOP_K", "5000"))
+POPULARITY_HALF_LIFE = float(os.getenv("POPULARITY_HALF_LIFE", "3600"))
+# Written by the ingesting process, read by the API
+POPULARITY_SNAPSHOT = os.getenv("POPULARITY_SNAPSHOT", "/tmp/tiler_cache_popularity.npz")
+POPULARITY_SNAPSHOT_INTERVAL = float(os.getenv("POPULARITY_SNAPSHOT_INTERVAL", "10"))
+
+# "GET http://host/maps/ohm/14/8514/5843.pbf HTTP/1.1" or a bare path
+_REQUEST_RE = re.compile(r'"(?:GET|HEAD) \S*?/maps/[^/\s]+/(\d+)/(\d+)/(\d+)')
+# Renormalise once the forward-decay factor exceeds 2**_MAX_EXPONENT
+_MAX_EXPONENT = 40
+
+
+class PopularityTracker:
+    """Count-min sketch + top-K of decayed tile hit counts."""
+
+    def __init__(
+        self,
+        width: int = POPULARITY_SKETCH_WIDTH,
+        depth: int = POPULARITY_SKETCH_DEPTH,
+        top_k: int = POPULARITY_TOP_K,
+        half_life: float = POPULARITY_HALF_LIFE,
+    ):
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.half_life = half_life
+        self._counts = np.zeros((depth, width), dtype=np.float64)
+        self._rows = np.arange(depth)
+        self._top: Dict[str, float] = {}
+        self._t0 = time.time()
+        self._lock = threading.Lock()
+        self.lines = 0
+        self.hits = 0
+
+    def _columns(self, key: str) -> np.ndarray:
+        return np.array([zlib.crc32(f"{i}:{key}".encode()) % self.width for i in range(self.depth)])
+
+    def _factor(self, now: float) -> float:
+        return 2.0 ** ((now - self._t0) / self.half_life)
+
+    def _renormalise(self, now: float):
+        scale = 1.0 / self._factor(now)
+        self._counts *= scale
+        for key in self._top:
+            self._top[key] *= scale
+        self._t0 = now
+
+    def record(self, key: str, now: Optional[float] = None):
+        """Count one hit for key ("z/x/y")."""
+        now = time.time() if now is None else now
+        with self._lock:
+            if (now - self._t0) / self.half_life > _MAX_EXPONENT:
+                self._renormalise(now)
+            cols = self._columns(key)
+            self._counts[self._rows, cols] += self._factor(now)
+            estimate = float(self._counts[self._rows, cols].min())
+            self._top[key] = estimate
+            if len(self._top) >= 2 * self.top_k:
+                self._prune()
+            self.hits += 1
+
+    def _prune(self):
+        """Keep the top_k entries; the table grows to 2 * top_k between prunes."""
+        keep = sorted(self._top.items(), key=lambda kv: kv[1], reverse=True)[: self.top_k]
+        self._top = dict(keep)
+
+    def estimate(self, key: str, now: Optional[float] = None) -> float:
+        """Decayed hit count of key (an upper bound, like any count-min estimate)."""
+        now = time.time() if now is None else now
+        with self._lock:
+            raw = float(self._counts[self._rows, self._columns(key)].min())
+            return raw / self._factor(now)
+
+    def score(self, z: int, x: int, y: int) -> float:
+        """Popularity of tile z/x/y; the signature the cache warmer expects."""
+        return self.estimate(f"{z}/{x}/{y}")
+
+    def top(
+        self, limit: int = 100, zoom: Optional[int] = None, now: Optional[float] = None
+    ) -> List[Tuple[str, float]]:
+        """Hottest tiles (optionally of one zoom) with their decayed counts."""
+        now = time.time() if now is None else now
+        with self._lock:
+            factor = self._factor(now)
+            items = self._top.items()
+            if zoom is not None:
+                prefix = f"{zoom}/"
+                items = [kv for kv in items if kv[0].startswith(prefix)]
+            best = sorted(items, key=lambda kv: kv[1], reverse=True)[:limit]
+        return [(key, round(count / factor, 3)) for key, count in best]
+
+    def ingest_line(self, line: str, now: Optional[float] = None) -> bool:
+        """Parse one varnishncsa line and count it if it is a tile request."""
+        self.lines += 1
+        m = _REQUEST_RE.search(line)
+        if not m:
+            return False
+        self.record(f"{int(m.group(1))}/{int(m.group(2))}/{int(m.group(3))}", now)
+        return True
+
+    def save(self, path: str = POPULARITY_SNAPSHOT):
+        """Write the sketch and top-K atomically for other processes."""
+        with self._lock:
+            keys = list(self._top)
+            arrays = {
+                "counts": self._counts.copy(),
+                "top_keys": np.array(keys, dtype=str),
+                "top_counts": np.array([self._top[k] for k in keys], dtype=np.float64),
+                "meta": np.array([self._t0, self.half_life, self.lines, self.hits, self.top_k], dtype=np.float64),
+            }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str = POPULARITY_SNAPSHOT) -> "PopularityTracker":
+        """Tracker holding a snapshot written by save() (read-only use)."""
+        with np.load(path) as data:
+            counts = data["counts"]
+            t0, half_life, lines, hits, top_k = data["meta"].tolist()
+            tracker = cls(width=counts.shape[1], depth=counts.shape[0], top_k=int(top_k), half_life=half_life)
+            tracker._counts = counts
+            tracker._top = dict(zip(data["top_keys"].tolist(), data["top_counts"].tolist()))
+        tracker._t0, tracker.lines, tracker.hits = t0, int(lines), int(hits)
+        return tracker
+
+    def _snapshot_loop(self, path: str, interval: float):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save(path)
+            except Exception as e:
+                logger.error(f"[POPULARITY] Could not write snapshot {path}: {e}")
+
+    def summary(self) -> dict:
+        return {
+            "source": POPULARITY_LOG or None,
+            "lines": self.lines,
+            "tile_hits": self.hits,
+            "top_tracked": len(self._top),
+            "sketch": f"{self.depth}x{self.width}",
+            "memory_bytes": int(self._counts.nbytes),
+            "half_life_s": self.half_life,
+        }
+
+    def follow(self, path: str, poll: float = 1.0):
+        """Ingest path forever: a named pipe is re-opened on EOF, a file is tailed across rotations.
+
+        A file is first read from its end (old traffic is not replayed); after
+        a rotation the new file is read from the start.
+        """
+        from_start = False
+        while True:
+            try:
+                if stat.S_ISFIFO(os.stat(path).st_mode):
+                    with open(path, errors="replace") as pipe:
+                        for line in pipe:
+                            self.ingest_line(line)
+                else:
+                    self._tail(path, poll, from_start)
+                    from_start = True
+            except FileNotFoundError:
+                time.sleep(poll)
+            except Exception as e:
+                logger.error(f"[POPULARITY] Error reading {path}: {e}")
+                time.sleep(poll)
+
+    def _tail(self, path: str, poll: float, from_start: bool):
+        with open(path, errors="replace") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            if not from_start:
+                f.seek(0, os.SEEK_END)
+            while True:
+                line = f.readline()
+                if line:
+                    self.ingest_line(line)
+                    continue
+                time.sleep(poll)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if st.st_ino != inode or st.st_size < f.tell():
+                    logger.info(f"[POPULARITY] {path} rotated; reopening")
+                    return
+
+    def start(self, path: str, snapshot: str = POPULARITY_SNAPSHOT, interval: float = POPULARITY_SNAPSHOT_INTERVAL):
+        threading.Thread(target=self.follow, args=(path,), name="popularity", daemon=True).start()
+        threading.Thread(
+            target=self._snapshot_loop, args=(snapshot, interval), name="popularity-snapshot", daemon=True
+        ).start()
+        logger.info(f"[POPULARITY] Following {path}; snapshots to {snapshot} every {interval:g}s")
+
+
+_tracker: Optional[PopularityTracker] = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker() -> Optional[PopularityTracker]:
+    """Process-wide tracker following POPULARITY_LOG, or None when it is not set.
+
+    Call it in the ingesting process only (the SQS processor); other
+    processes use get_shared_tracker().
+    """
+    global _tracker
+    if not POPULARITY_LOG:
+        return None
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = PopularityTracker()
+            _tracker.start(POPULARITY_LOG)
+    return _tracker
+
+
+_shared: Optional[PopularityTracker] = None
+_shared_mtime: Optional[float] = None
+
+
+def get_shared_tracker() -> Optional[PopularityTracker]:
+    """Latest snapshot of the ingesting process's tracker, reloaded when it changes.
+
+    None when tracking is disabled or no snapshot has been written yet.
+    """
+    global _shared, _shared_mtime
+    if not POPULARITY_LOG:
+        return None
+    with _tracker_lock:
+        try:
+            mtime = os.path.getmtime(POPULARITY_SNAPSHOT)
+        except OSError:
+            return _shared
+        if mtime != _shared_mtime:
+            try:
+                _shared = PopularityTracker.load(POPULARITY_SNAPSHOT)
+                _shared_mtime = mtime
+            except Exception as e:
+                logger.error(f"[POPULARITY] Could not read snapshot {POPULARITY_SNAPSHOT}: {e}")
+    return _shared
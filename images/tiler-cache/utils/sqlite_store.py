@@ -0,0 +1,53 @@
+"""Shared SQLite connection for the local stores (delay scheduler, changed tiles, event dedup).
+
+Each store uses a single connection, opened on first use, behind a
+threading lock to avoid "database is locked" errors from concurrent
+access. WAL mode lets the SQS processor and main.py open the same file,
+each with its own connection.
+"""
+
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Sequence
+
+
+class SQLiteStore:
+    """Lazily opened connection to one SQLite file, used under its lock."""
+
+    def __init__(
+        self,
+        path: str,
+        init_tables: Callable[[sqlite3.Connection], None],
+        pragmas: Sequence[str] = (),
+        row_factory: Optional[Callable] = None,
+    ):
+        self.path = path
+        self.lock = threading.Lock()
+        self._init_tables = init_tables
+        # Run before journal_mode, e.g. auto_vacuum which only applies to a new database
+        self._pragmas = pragmas
+        self._row_factory = row_factory
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return the connection, creating it and the tables on first call (caller holds the lock)."""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            if self._row_factory is not None:
+                conn.row_factory = self._row_factory
+            for pragma in self._pragmas:
+                conn.execute(f"PRAGMA {pragma}")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._init_tables(conn)
+            self._conn = conn
+        return self._conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Hold the lock and yield the shared connection."""
+        with self.lock:
+            yield self._connect()
@@ -0,0 +1,108 @@
+"""Bookkeeping for SQS messages between receive and delete.
+
+A message whose immediate cleanup is still running stays "in flight": a
+background thread keeps extending its visibility timeout so it is not
+redelivered mid-cleanup, and once the cleanup succeeds the message is
+deleted with delete_message_batch together with the others that are done.
+A message whose cleanup failed is left on the queue: its visibility is no
+longer extended, so SQS redelivers it once the timeout expires.
+"""
+import threading
+import time
+
+from utils.utils import get_logger
+
+logger = get_logger()
+
+# SQS batch APIs accept at most 10 entries
+SQS_BATCH_MAX = 10
+
+
+def _batches(items, size=SQS_BATCH_MAX):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class InFlightMessages:
+    """Tracks received messages until they can be deleted."""
+
+    def __init__(self, sqs, queue_url: str, visibility_timeout: int):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self._lock = threading.Lock()
+        self._pending = {}  # MessageId -> ReceiptHandle
+        self._to_delete = []  # (MessageId, ReceiptHandle)
+        threading.Thread(target=self._extend_loop, name="sqs-visibility", daemon=True).start()
+
+    def track(self, message, future):
+        """Delete the message once future succeeds, extending visibility meanwhile."""
+        msg_id, receipt = message["MessageId"], message["ReceiptHandle"]
+        with self._lock:
+            self._pending[msg_id] = receipt
+        future.add_done_callback(lambda f: self._done(msg_id, not f.cancelled() and f.exception() is None))
+
+    def ack(self, message):
+        """Mark the message for deletion on the next flush."""
+        with self._lock:
+            self._to_delete.append((message["MessageId"], message["ReceiptHandle"]))
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _done(self, msg_id, ok: bool = True):
+        with self._lock:
+            receipt = self._pending.pop(msg_id, None)
+            if receipt and ok:
+                self._to_delete.append((msg_id, receipt))
+        if receipt and not ok:
+            logger.warning(f"[SQS] Cleanup of msg:{msg_id[:8]} failed; leaving it for redelivery")
+
+    def flush(self):
+        """Delete every acknowledged message with delete_message_batch."""
+        with self._lock:
+            to_delete, self._to_delete = self._to_delete, []
+        for batch in _batches(to_delete):
+            entries = [{"Id": str(i), "ReceiptHandle": receipt} for i, (_msg_id, receipt) in enumerate(batch)]
+            try:
+                response = self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logger.error(f"[SQS] delete_message_batch failed for {len(batch)} messages: {e}")
+                continue
+            failed = set()
+            for failure in response.get("Failed", []):
+                failed.add(int(failure["Id"]))
+                msg_id = batch[int(failure["Id"])][0]
+                logger.warning(f"[SQS] Could not delete msg:{msg_id[:8]}: {failure.get('Message', failure.get('Code'))}")
+            for i, (msg_id, _receipt) in enumerate(batch):
+                if i not in failed:
+                    logger.info(f"[DONE] msg:{msg_id[:8]}")
+
+    def _extend(self):
+        with self._lock:
+            pending = list(self._pending.items())
+        for batch in _batches(pending):
+            entries = [
+                {"Id": str(i), "ReceiptHandle": receipt, "VisibilityTimeout": self.visibility_timeout}
+                for i, (_msg_id, receipt) in enumerate(batch)
+            ]
+            try:
+                response = self.sqs.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            except Exception as e:
+                logger.warning(f"[SQS] change_message_visibility_batch failed: {e}")
+                continue
+            for failure in response.get("Failed", []):
+                msg_id = batch[int(failure["Id"])][0]
+                logger.warning(f"[SQS] Could not extend visibility of msg:{msg_id[:8]}: {failure.get('Code')}")
+
+    def _extend_loop(self):
+        # Extend well before the timeout runs out
+        interval = max(1, self.visibility_timeout // 3)
+        while True:
+            time.sleep(interval)
+            try:
+                self._extend()
+                self.flush()
+            except Exception as e:
+                logger.error(f"[SQS] Visibility/ack loop error: {e}")
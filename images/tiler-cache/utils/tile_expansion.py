@@ -0,0 +1,203 @@
+"""Vectorized expansion of imposm expire tiles into BAN prefixes.
+
+An expire chunk is parsed into integer arrays once, and the parent, same
+zoom and child x ranges for every target zoom are computed with array
+operations instead of one tile at a time.
+
+The prefix rule is the one the S3 cleaner uses: a tile z/x/y becomes
+z/x_prefix where x_prefix keeps x as-is when it has <= 2 digits, drops the
+last digit when it has 3 and drops the last 2 digits when it has 4+.
+Since y never takes part in the prefix, tiles are deduplicated on (z, x)
+before any expansion.
+
+For the xkey mode the same inputs map to surrogate keys instead; see
+expand_tile_keys.
+"""
+import re
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+_TILE_LINE_RE = re.compile(r"^(\d+)/(\d+)/\d+", re.MULTILINE)
+_TILE_XYZ_RE = re.compile(r"^(\d+)/(\d+)/(\d+)", re.MULTILINE)
+
+# Zooms at which tiler-varnish groups cached tiles under one surrogate key;
+# must match tile_xkey in images/tiler-varnish/default.vcl
+XKEY_ZOOMS = (12, 14)
+
+# Upper bound of x at z <= 30; used to pack (z, x) into one int64 key
+_X_BITS = 31
+
+
+def parse_tile_strings(tile_strings: Iterable[str]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """Parse z/x/y lines into unique (z, x) int64 arrays.
+
+    Returns (z, x, invalid_lines). Lines are matched like the scalar parser
+    did: anything that does not start with z/x/y is reported as invalid.
+    """
+    lines = tile_strings if isinstance(tile_strings, list) else list(tile_strings)
+    if not lines:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, []
+
+    matches = _TILE_LINE_RE.findall("\n".join(lines))
+    invalid: List[str] = []
+    if len(matches) != len(lines):
+        invalid = [ln for ln in lines if not _TILE_LINE_RE.match(ln)]
+    if not matches:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, invalid
+
+    zx = np.array(matches, dtype=np.int64)
+    keys = np.unique((zx[:, 0] << _X_BITS) | zx[:, 1])
+    return keys >> _X_BITS, keys & ((1 << _X_BITS) - 1), invalid
+
+
+def _truncate(x: np.ndarray) -> np.ndarray:
+    """Apply the x_prefix rule to an array of x values."""
+    return np.where(x < 100, x, np.where(x < 1000, x // 10, x // 100))
+
+
+def _expand_ranges(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Concatenate the integer ranges [lo[i], hi[i]] into one array."""
+    keep = lo <= hi
+    lo, hi = lo[keep], hi[keep]
+    if lo.size == 0:
+        return np.empty(0, dtype=np.int64)
+    n = hi - lo + 1
+    starts = np.cumsum(n) - n
+    return np.repeat(lo - starts, n) + np.arange(int(n.sum()), dtype=np.int64)
+
+
+def _truncated_x_ranges(lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """All x_prefix values for x in [lo[i], hi[i]].
+
+    Each range is split at the 2/3 and 3/4 digit boundaries; within a band
+    the truncated values form a contiguous range, so the work scales with
+    the number of prefixes, not the width of the x range. A band the range
+    does not reach comes out empty (its truncated lo exceeds its hi).
+    """
+    return np.concatenate(
+        [
+            _expand_ranges(lo, np.minimum(hi, 99)),
+            _expand_ranges(np.maximum(lo, 100) // 10, np.minimum(hi, 999) // 10),
+            _expand_ranges(np.maximum(lo, 1000) // 100, hi // 100),
+        ]
+    )
+
+
+def expand_prefix_values(z: np.ndarray, x: np.ndarray, zoom_levels: Iterable[int]) -> Dict[int, np.ndarray]:
+    """Return {zoom: sorted unique x_prefix values} for parents + same zoom + children.
+
+    For a target zoom at or above the tile zoom the tile maps to its
+    ancestor x; below it, to the x range covered by its children. Children
+    expansion is bounded by max(zoom_levels).
+    """
+    out: Dict[int, np.ndarray] = {}
+    if z.size == 0:
+        return out
+    for tz in sorted(set(zoom_levels)):
+        parts = []
+        up = z >= tz
+        if up.any():
+            parts.append(_truncate(x[up] >> (z[up] - tz)))
+        down = ~up
+        if down.any():
+            shift = tz - z[down]
+            lo = x[down] << shift
+            hi = ((x[down] + 1) << shift) - 1
+            parts.append(_truncated_x_ranges(lo, hi))
+        values = np.unique(np.concatenate(parts))
+        if values.size:
+            out[tz] = values
+    return out
+
+
+def expand_tile_prefixes(tile_strings: Iterable[str], zoom_levels: Iterable[int]) -> Tuple[Set[str], List[str]]:
+    """Expand expire lines into the set of z/x_prefix strings to BAN.
+
+    Returns (prefixes, invalid_lines).
+    """
+    z, x, invalid = parse_tile_strings(tile_strings)
+    return _format_prefixes(z, x, zoom_levels), invalid
+
+
+def expand_xyz_prefixes(zxy: np.ndarray, zoom_levels: Iterable[int]) -> Set[str]:
+    """expand_tile_prefixes for tiles already parsed by parse_tile_xyz."""
+    if zxy.size == 0:
+        return set()
+    keys = np.unique((zxy[:, 0] << _X_BITS) | zxy[:, 1])
+    return _format_prefixes(keys >> _X_BITS, keys & ((1 << _X_BITS) - 1), zoom_levels)
+
+
+def _format_prefixes(z: np.ndarray, x: np.ndarray, zoom_levels: Iterable[int]) -> Set[str]:
+    prefixes: Set[str] = set()
+    for tz, values in expand_prefix_values(z, x, zoom_levels).items():
+        prefixes.update(f"{tz}/{v}" for v in values.tolist())
+    return prefixes
+
+
+def xkey_zoom(z: int, key_zooms: Tuple[int, ...] = XKEY_ZOOMS) -> int:
+    """Zoom of the surrogate key a cached tile at zoom z carries.
+
+    Tiles below the first key zoom are keyed by themselves; deeper tiles by
+    their ancestor at the largest key zoom <= z.
+    """
+    below = [k for k in key_zooms if k <= z]
+    return max(below) if below else z
+
+
+def parse_tile_xyz(tile_strings: Iterable[str]) -> Tuple[np.ndarray, List[str]]:
+    """Parse z/x/y lines into a unique (n, 3) int64 array. Returns (zxy, invalid_lines)."""
+    lines = tile_strings if isinstance(tile_strings, list) else list(tile_strings)
+    matches = _TILE_XYZ_RE.findall("\n".join(lines)) if lines else []
+    invalid: List[str] = []
+    if len(matches) != len(lines):
+        invalid = [ln for ln in lines if not _TILE_XYZ_RE.match(ln)]
+    if not matches:
+        return np.empty((0, 3), dtype=np.int64), invalid
+    return np.unique(np.array(matches, dtype=np.int64), axis=0), invalid
+
+
+def expand_tile_keys(
+    tile_strings: Iterable[str],
+    zoom_levels: Iterable[int],
+    key_zooms: Tuple[int, ...] = XKEY_ZOOMS,
+) -> Tuple[Set[str], List[str]]:
+    """Expand expire lines into the z/x/y surrogate keys to purge.
+
+    A cached tile at zoom t is keyed at xkey_zoom(t). For each key zoom kz
+    used by zoom_levels, an expire tile at zoom e maps to its ancestor at
+    kz when kz <= e (that key covers every affected tile down the tree),
+    otherwise to all of its descendants at kz.
+
+    Returns (keys, invalid_lines).
+    """
+    zxy, invalid = parse_tile_xyz(tile_strings)
+    return expand_xyz_keys(zxy, zoom_levels, key_zooms), invalid
+
+
+def expand_xyz_keys(
+    zxy: np.ndarray,
+    zoom_levels: Iterable[int],
+    key_zooms: Tuple[int, ...] = XKEY_ZOOMS,
+) -> Set[str]:
+    """expand_tile_keys for tiles already parsed by parse_tile_xyz."""
+    keys: Set[str] = set()
+    if zxy.size == 0:
+        return keys
+    z, x, y = zxy[:, 0], zxy[:, 1], zxy[:, 2]
+    for kz in sorted({xkey_zoom(t, key_zooms) for t in zoom_levels}):
+        up = z >= kz
+        if up.any():
+            shift = z[up] - kz
+            kx, ky = x[up] >> shift, y[up] >> shift
+            keys.update(f"{kz}/{a}/{b}" for a, b in set(zip(kx.tolist(), ky.tolist())))
+        for e in np.unique(z[~up]).tolist():
+            sel = z == e
+            d = kz - e
+            offsets = np.arange(1 << d, dtype=np.int64)
+            kx = ((x[sel] << d)[:, None, None] + offsets[None, :, None]).repeat(1 << d, axis=2)
+            ky = ((y[sel] << d)[:, None, None] + offsets[None, None, :]).repeat(1 << d, axis=1)
+            keys.update(f"{kz}/{a}/{b}" for a, b in zip(kx.ravel().tolist(), ky.ravel().tolist()))
+    return keys
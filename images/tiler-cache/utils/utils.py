@@ -1,29 +1,6 @@
 import sys
 import logging
-import psycopg2
-from psycopg2 import OperationalError
-from config import Config
-
-
-def check_tiler_db_postgres_status():
-    """Check if the PostgreSQL database is running."""
-    logging.info("Checking PostgreSQL database status...")
-
-    try:
-        connection = psycopg2.connect(
-            host=Config.POSTGRES_HOST,
-            port=Config.POSTGRES_PORT,
-            database=Config.POSTGRES_DB,
-            user=Config.POSTGRES_USER,
-            password=Config.POSTGRES_PASSWORD,
-            connect_timeout=5,
-        )
-        connection.close()
-        logging.info("PostgreSQL database is running and reachable.")
-        return True
-    except OperationalError as e:
-        logging.error(f"PostgreSQL database is not reachable: {e}")
-        return False
+import smart_open
 
 
 def get_purge_and_seed_commands(script_path="purge_seed_tiles.sh"):
@@ -72,3 +49,13 @@ def s3_path_to_url(s3_path, region="us-east-1"):
     bucket, key = s3_path.replace("s3://", "").split("/", 1)
     url = f"https://s3.{region}.amazonaws.com/{bucket}/{key}"
     return url
+
+
+def iter_expire_file_lines(url):
+    """
+    Stream an imposm expire file line by line without loading it in memory.
+    Works for the https URLs returned by s3_path_to_url.
+    """
+    with smart_open.open(url, "r", encoding="utf-8") as f:
+        for line in f:
+            yield line
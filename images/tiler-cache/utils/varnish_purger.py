@@ -1,151 +1,595 @@
 """Varnish cache invalidation via BAN requests.
 
 Sends BAN requests to Varnish to invalidate cached tiles when imposm
-expire files arrive.
+expire files arrive. Every BAN is fanned out to all Varnish replicas
+(VARNISH_URL list and/or DNS discovery) concurrently over a shared
+keep-alive connection pool; pass a BanStats to collect per-file and
+per-node latency figures.
+
+In xkey mode the same entry points send PURGE requests carrying exact
+surrogate keys (see utils.tile_expansion.expand_tile_keys) instead of
+regex BANs.
+
+The *_async variants and AsyncPrefixBanStream send the same requests from
+an event loop through a shared httpx.AsyncClient, for the FastAPI service.
 """
+import asyncio
+import heapq
 import os
 import re
-from typing import Iterable, List, Set
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
+import httpx
 import mercantile
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 
+from utils.ban_planner import log_plan, plan_invalidation_xyz, split_units
+from utils.ban_regex import chunk_by_regex_budget
+from utils.metrics import BAN_CHUNKS, BAN_REGEX_BYTES, BAN_REQUESTS, BAN_RETRIES, BAN_SECONDS
+from utils.tile_expansion import expand_xyz_keys, expand_xyz_prefixes, parse_tile_xyz, xkey_zoom
 from utils.utils import get_logger
 
 logger = get_logger()
 
+# One URL or a comma-separated list of Varnish replicas; each BAN goes to all of them
 VARNISH_URL = os.getenv("VARNISH_URL", "http://varnish:6081")
+# Optional "host[:port]": when set, every address the name resolves to is a node
+VARNISH_DISCOVERY_HOST = os.getenv("VARNISH_DISCOVERY_HOST", "").strip()
+VARNISH_DISCOVERY_TTL = int(os.getenv("VARNISH_DISCOVERY_TTL", "60"))
+VARNISH_BAN_RETRIES = int(os.getenv("VARNISH_BAN_RETRIES", "2"))
+VARNISH_BAN_RETRY_BACKOFF = float(os.getenv("VARNISH_BAN_RETRY_BACKOFF", "0.5"))
+VARNISH_NODE_COOLDOWN = int(os.getenv("VARNISH_NODE_COOLDOWN", "30"))
 VARNISH_BAN_TIMEOUT = int(os.getenv("VARNISH_BAN_TIMEOUT", "5"))
 VARNISH_TILE_URL_PREFIX = os.getenv(
     "VARNISH_TILE_URL_PREFIX",
     "/maps/ohm,/maps/ohm_admin,/maps/ohm_other_boundaries",
 )
-VARNISH_MAX_TILES_PER_REQUEST = int(os.getenv("VARNISH_MAX_TILES_PER_REQUEST", "200"))
+# Max bytes of one X-Ban-Regex or xkey-purge header (Varnish http_req_hdr_len defaults to 8k)
+VARNISH_BAN_REGEX_MAX_BYTES = int(os.getenv("VARNISH_BAN_REGEX_MAX_BYTES", "6000"))
+# "url": bans on req.url, tested on every cache hit until the object expires.
+# "obj": bans on obj.http.X-Tile-Url (set by the VCL), which the ban lurker
+# evaluates in the background and drops from the ban list once processed.
+# "xkey": PURGE with the tiles' surrogate keys; a hash lookup, no ban list.
+VARNISH_BAN_MODE = os.getenv("VARNISH_BAN_MODE", "url").strip().lower()
+# Per-zoom granularity planner for url/obj bans (utils.ban_planner): pattern budget
+# per expire batch, and how many evicted tiles one pattern on the ban list is worth
+VARNISH_BAN_PLANNER = os.getenv("VARNISH_BAN_PLANNER", "false").lower() == "true"
+VARNISH_PLAN_MAX_PATTERNS = int(os.getenv("VARNISH_PLAN_MAX_PATTERNS", "2000"))
+VARNISH_PLAN_TILES_PER_PATTERN = float(os.getenv("VARNISH_PLAN_TILES_PER_PATTERN", "256"))
+# Default for soft invalidation (xkey mode only): TTL 0 but grace kept, so clients
+# get the stale tile while one background fetch refreshes it. Overridable per call.
+VARNISH_SOFT_PURGE = os.getenv("VARNISH_SOFT_PURGE", "false").lower() == "true"
+VARNISH_BAN_CONCURRENCY = max(1, int(os.getenv("VARNISH_BAN_CONCURRENCY", "8")))
+# Streaming: pending new prefixes that trigger a flush, and expire lines expanded per batch
+VARNISH_STREAM_FLUSH_PREFIXES = int(os.getenv("VARNISH_STREAM_FLUSH_PREFIXES", "2000"))
+EXPIRE_BATCH_LINES = int(os.getenv("EXPIRE_BATCH_LINES", "10000"))
+
+# Public: ban_audit and the benchmarks build tile URLs from these
+TILE_URL_PREFIXES = [p.strip() for p in VARNISH_TILE_URL_PREFIX.split(",") if p.strip()]
+_TILE_URL_PREFIX_GROUP = "(?:" + "|".join(re.escape(p) for p in TILE_URL_PREFIXES) + ")"
+# Layer names the VCL puts in front of surrogate keys (/maps/<layer>/z/x/y)
+_TILE_LAYERS = [p.rstrip("/").rsplit("/", 1)[-1] for p in TILE_URL_PREFIXES]
+
+if VARNISH_BAN_MODE not in ("url", "obj", "xkey"):
+    logger.warning(f"Unknown VARNISH_BAN_MODE={VARNISH_BAN_MODE!r}; using 'url'")
+    VARNISH_BAN_MODE = "url"
+
+_VARNISH_URLS = [u.strip().rstrip("/") for u in VARNISH_URL.split(",") if u.strip()]
+
+_session = None
+_executor = None
+_init_lock = threading.Lock()
+_async_client: Optional[httpx.AsyncClient] = None
+_async_semaphore: Optional[asyncio.Semaphore] = None
+
+_nodes_lock = threading.Lock()
+_discovered_nodes: List[str] = []
+_discovered_at = 0.0
+_node_down_until: Dict[str, float] = {}
+
+
+def _get_session() -> requests.Session:
+    """Return the shared keep-alive session, creating it on first call.
+
+    Each node gets a connection pool sized to the dispatcher concurrency so
+    parallel BANs reuse open connections instead of opening one per request.
+    """
+    global _session
+    with _init_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=VARNISH_BAN_CONCURRENCY)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """Return the shared BAN dispatcher pool, creating it on first call.
+
+    Shared across callers so concurrent cleanups together never exceed
+    VARNISH_BAN_CONCURRENCY in-flight BANs.
+    """
+    global _executor
+    with _init_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=VARNISH_BAN_CONCURRENCY, thread_name_prefix="varnish-ban"
+            )
+    return _executor
 
-_TILE_URL_PREFIXES = [p.strip() for p in VARNISH_TILE_URL_PREFIX.split(",") if p.strip()]
-_TILE_URL_PREFIX_GROUP = "(?:" + "|".join(re.escape(p) for p in _TILE_URL_PREFIXES) + ")"
 
-_TILE_RE = re.compile(r"^(\d+)/(\d+)/(\d+)")
+def _get_async_client() -> httpx.AsyncClient:
+    """Return the shared async client, creating it (and the BAN semaphore) in the running loop.
 
+    Like the thread pool, the semaphore caps in-flight BANs of all callers
+    at VARNISH_BAN_CONCURRENCY.
+    """
+    global _async_client, _async_semaphore
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            timeout=VARNISH_BAN_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=VARNISH_BAN_CONCURRENCY, max_keepalive_connections=VARNISH_BAN_CONCURRENCY
+            ),
+        )
+        _async_semaphore = asyncio.Semaphore(VARNISH_BAN_CONCURRENCY)
+    return _async_client
 
-def _chunks(items, size):
-    for i in range(0, len(items), size):
-        yield items[i : i + size]
 
+async def close_async_client():
+    global _async_client, _async_semaphore
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = _async_semaphore = None
 
-def _tile_to_prefix(z: int, x: int) -> str:
-    """Return a z/x_prefix truncated like the S3 cleaner does.
 
-    x_str <= 2 chars: keep as-is ; 3 chars: drop last ; 4+ chars: drop last 2.
-    """
-    x_str = str(x)
-    if len(x_str) <= 2:
-        return f"{z}/{x_str}"
-    if len(x_str) == 3:
-        return f"{z}/{x_str[:-1]}"
-    return f"{z}/{x_str[:-2]}"
+def _discover_nodes() -> List[str]:
+    """Resolve VARNISH_DISCOVERY_HOST to one base URL per address."""
+    host, _, port = VARNISH_DISCOVERY_HOST.partition(":")
+    port = int(port or 6081)
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addrs = sorted({info[4][0] for info in infos})
+    return [f"http://[{a}]:{port}" if ":" in a else f"http://{a}:{port}" for a in addrs]
 
 
-def _prefixes_for_x_range(z: int, x_lo: int, x_hi: int) -> Set[str]:
-    """Unique z/x_prefix strings for x in [x_lo, x_hi].
+def get_varnish_nodes() -> List[str]:
+    """Return the Varnish base URLs every BAN must reach.
 
-    Walks x by jumping to the next x that would change the truncated prefix,
-    so the work scales with the number of prefixes, not the width of the range.
+    The VARNISH_URL entries, or, when VARNISH_DISCOVERY_HOST is set, the
+    addresses it resolves to (re-resolved every VARNISH_DISCOVERY_TTL seconds;
+    the last good answer is kept if DNS fails, VARNISH_URL is used until the
+    first successful lookup).
     """
-    out: Set[str] = set()
-    x = x_lo
-    while x <= x_hi:
-        out.add(_tile_to_prefix(z, x))
-        s = str(x)
-        if len(s) <= 2:
-            x += 1
-        elif len(s) == 3:
-            x = (x // 10 + 1) * 10
+    global _discovered_nodes, _discovered_at
+    if not VARNISH_DISCOVERY_HOST:
+        return list(_VARNISH_URLS)
+    with _nodes_lock:
+        if time.monotonic() - _discovered_at >= VARNISH_DISCOVERY_TTL or not _discovered_at:
+            try:
+                nodes = _discover_nodes()
+                if nodes != _discovered_nodes:
+                    logger.info(f"Varnish nodes discovered via {VARNISH_DISCOVERY_HOST}: {nodes}")
+                _discovered_nodes = nodes
+            except OSError as e:
+                logger.warning(f"Varnish discovery failed for {VARNISH_DISCOVERY_HOST}: {e}")
+            _discovered_at = time.monotonic()
+        discovered = list(_discovered_nodes)
+    return discovered or list(_VARNISH_URLS)
+
+
+def _node_in_cooldown(node: str) -> bool:
+    with _nodes_lock:
+        return _node_down_until.get(node, 0.0) > time.monotonic()
+
+
+def _mark_node(node: str, healthy: bool):
+    with _nodes_lock:
+        if healthy:
+            _node_down_until.pop(node, None)
         else:
-            x = (x // 100 + 1) * 100
-    return out
+            _node_down_until[node] = time.monotonic() + VARNISH_NODE_COOLDOWN
 
 
-def _expand_tile_prefixes(z: int, x: int, zoom_levels: Iterable[int]) -> Set[str]:
-    """Expand a tile to z/x_prefix strings for parents + same zoom + children.
+class BanStats:
+    """Aggregate counters and latencies for the BANs sent for one expire file.
 
-    Children expansion is bounded by max(zoom_levels) — the caller-supplied
-    list is the authoritative range. Prefixes at each child zoom are generated
-    directly from the x-range instead of iterating every child tile.
+    Every (chunk, node) delivery is recorded, so per-node success and
+    latency can be compared across the Varnish replicas.
     """
-    zooms = set(zoom_levels)
-    if not zooms:
-        return set()
-    zmin, zmax = min(zooms), max(zooms)
-    out: Set[str] = set()
 
-    if z in zooms:
-        out.add(_tile_to_prefix(z, x))
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._nodes: Dict[str, dict] = {}
+        self.patterns = 0
+        self.chunks = 0
+        self.regex_bytes = 0
+
+    def record_chunk(self, n_patterns: int, regex_bytes: int = 0):
+        with self._lock:
+            self.chunks += 1
+            self.patterns += n_patterns
+            self.regex_bytes += regex_bytes
+
+    def record(self, node: str, ok: bool, latency: float, attempts: int = 1):
+        with self._lock:
+            entry = self._nodes.setdefault(
+                node, {"ok": 0, "failed": 0, "retries": 0, "latencies": []}
+            )
+            entry["ok" if ok else "failed"] += 1
+            entry["retries"] += attempts - 1
+            entry["latencies"].append(latency)
+
+    @staticmethod
+    def _latency_summary(latencies: List[float]) -> dict:
+        latencies = sorted(latencies)
+
+        def pct(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            "latency_p50_ms": round(pct(0.50) * 1000, 1),
+            "latency_p95_ms": round(pct(0.95) * 1000, 1),
+            "latency_max_ms": round((latencies[-1] if latencies else 0.0) * 1000, 1),
+        }
+
+    def summary(self) -> dict:
+        with self._lock:
+            nodes = {n: dict(e, latencies=list(e["latencies"])) for n, e in self._nodes.items()}
+            chunks, patterns, regex_bytes = self.chunks, self.patterns, self.regex_bytes
+
+        per_node = {}
+        all_latencies: List[float] = []
+        for node, e in sorted(nodes.items()):
+            all_latencies.extend(e["latencies"])
+            per_node[node] = {
+                "bans": e["ok"] + e["failed"],
+                "ok": e["ok"],
+                "failed": e["failed"],
+                "retries": e["retries"],
+                **self._latency_summary(e["latencies"]),
+            }
+        return {
+            "chunks": chunks,
+            "patterns": patterns,
+            "regex_bytes": regex_bytes,
+            "bans": sum(n["bans"] for n in per_node.values()),
+            "ok": sum(n["ok"] for n in per_node.values()),
+            "failed": sum(n["failed"] for n in per_node.values()),
+            **self._latency_summary(all_latencies),
+            "elapsed_s": round(time.monotonic() - self._started, 2),
+            "nodes": per_node,
+        }
+
+    def log_summary(self, label: str):
+        s = self.summary()
+        logger.info(
+            f"{label} Varnish BAN summary: {s['chunks']} chunks, {s['patterns']} patterns "
+            f"({s['regex_bytes']} regex bytes), "
+            f"{s['ok']}/{s['bans']} node BANs ok | p50={s['latency_p50_ms']}ms "
+            f"p95={s['latency_p95_ms']}ms max={s['latency_max_ms']}ms | {s['elapsed_s']}s"
+        )
+        for node, n in s["nodes"].items():
+            if n["failed"] or n["retries"]:
+                logger.warning(
+                    f"{label} Varnish node {node}: {n['failed']} failed, {n['retries']} retries, "
+                    f"p95={n['latency_p95_ms']}ms"
+                )
+
 
-    px = x
-    for pz in range(z - 1, zmin - 1, -1):
-        px //= 2
-        if pz in zooms:
-            out.add(_tile_to_prefix(pz, px))
+_soft_warned = False
+
+
+def _resolve_soft(soft: Optional[bool]) -> bool:
+    """Per-call soft flag, defaulting to VARNISH_SOFT_PURGE; only xkey mode can soft-purge."""
+    global _soft_warned
+    soft = VARNISH_SOFT_PURGE if soft is None else soft
+    if soft and VARNISH_BAN_MODE != "xkey":
+        if not _soft_warned:
+            logger.warning(f"Soft purge needs VARNISH_BAN_MODE=xkey; sending hard {VARNISH_BAN_MODE} bans")
+            _soft_warned = True
+        return False
+    return soft
 
-    for cz in range(z + 1, zmax + 1):
-        if cz not in zooms:
-            continue
-        factor = 2 ** (cz - z)
-        x_lo = x * factor
-        x_hi = x_lo + factor - 1
-        out.update(_prefixes_for_x_range(cz, x_lo, x_hi))
 
-    return out
+def _ban_request(payload: str, soft: bool = False) -> Tuple[str, Dict[str, str]]:
+    """Method and headers of one invalidation; the VCL builds the ban expression from them."""
+    if VARNISH_BAN_MODE == "xkey":
+        return "PURGE", {"xkey-softpurge" if soft else "xkey-purge": payload}
+    headers = {"X-Ban-Regex": payload}
+    if VARNISH_BAN_MODE == "obj":
+        headers["X-Ban-Target"] = "obj"
+    return "BAN", headers
 
 
-def _send_ban(regex: str, n_patterns: int) -> bool:
+def _ban_once(node: str, regex: str, soft: bool = False) -> Tuple[bool, str]:
+    method, headers = _ban_request(regex, soft)
     try:
-        r = requests.request(
-            "BAN",
-            f"{VARNISH_URL}/",
-            headers={"X-Ban-Regex": regex},
+        r = _get_session().request(
+            method,
+            f"{node}/",
+            headers=headers,
             timeout=VARNISH_BAN_TIMEOUT,
         )
         if r.status_code == 200:
-            logger.info(f"Varnish BAN ok: {n_patterns} patterns")
-            return True
-        logger.warning(f"Varnish BAN status={r.status_code}: {r.text[:200]}")
-        return False
+            return True, ""
+        return False, f"status={r.status_code}: {r.text[:200]}"
     except Exception as e:
-        logger.warning(f"Varnish BAN failed (TTL is fallback): {e}")
-        return False
+        return False, str(e)
 
 
-def ban_tiles(tiles: List[mercantile.Tile]) -> bool:
-    """Send BAN request(s) to Varnish for the exact tiles given (no zoom expansion)."""
-    if not tiles:
+async def _ban_once_async(node: str, regex: str, soft: bool = False) -> Tuple[bool, str]:
+    method, headers = _ban_request(regex, soft)
+    try:
+        r = await _get_async_client().request(method, f"{node}/", headers=headers)
+        if r.status_code == 200:
+            return True, ""
+        return False, f"status={r.status_code}: {r.text[:200]}"
+    except httpx.HTTPError as e:
+        return False, str(e) or type(e).__name__
+
+
+def _ban_attempts(node: str) -> int:
+    return 1 if _node_in_cooldown(node) else 1 + VARNISH_BAN_RETRIES
+
+
+def _record_ban(
+    node: str, ok: bool, error: str, attempts: int, started: float, n_patterns: int, stats: Optional[BanStats]
+) -> bool:
+    latency = time.monotonic() - started
+    if ok:
+        _mark_node(node, healthy=True)
+        logger.info(f"Varnish BAN ok: {node} {n_patterns} patterns ({latency * 1000:.0f}ms)")
+    else:
+        _mark_node(node, healthy=False)
+        logger.warning(f"Varnish BAN failed on {node} after {attempts} attempt(s) (TTL is fallback): {error}")
+    BAN_REQUESTS.labels(node, "ok" if ok else "failed").inc()
+    BAN_SECONDS.labels(node).observe(latency)
+    if attempts > 1:
+        BAN_RETRIES.labels(node).inc(attempts - 1)
+    if stats is not None:
+        stats.record(node, ok, latency, attempts)
+    return ok
+
+
+def _send_ban(
+    node: str, regex: str, n_patterns: int, stats: Optional[BanStats] = None, soft: bool = False
+) -> bool:
+    """Send one BAN to one node, retrying with backoff while the node is healthy.
+
+    A node that exhausted its retries is put in cooldown: until it expires the
+    node gets a single attempt per BAN, so a dead replica cannot hold the
+    dispatcher pool for timeout * retries on every chunk.
+    """
+    started = time.monotonic()
+    ok, error = False, ""
+    for attempt in range(_ban_attempts(node)):
+        if attempt:
+            time.sleep(VARNISH_BAN_RETRY_BACKOFF * 2 ** (attempt - 1))
+        ok, error = _ban_once(node, regex, soft)
+        if ok:
+            break
+    return _record_ban(node, ok, error, attempt + 1, started, n_patterns, stats)
+
+
+async def _send_ban_async(
+    node: str, regex: str, n_patterns: int, stats: Optional[BanStats] = None, soft: bool = False
+) -> bool:
+    """_send_ban on the event loop; holds a slot of the shared BAN semaphore while sending."""
+    _get_async_client()
+    async with _async_semaphore:
+        started = time.monotonic()
+        ok, error = False, ""
+        for attempt in range(_ban_attempts(node)):
+            if attempt:
+                await asyncio.sleep(VARNISH_BAN_RETRY_BACKOFF * 2 ** (attempt - 1))
+            ok, error = await _ban_once_async(node, regex, soft)
+            if ok:
+                break
+    return _record_ban(node, ok, error, attempt + 1, started, n_patterns, stats)
+
+
+def _ban_targets(bans: List[Tuple[str, int]], stats: Optional[BanStats]) -> Optional[List[str]]:
+    """Nodes the BANs go to (None when there are none) after recording the chunks in stats."""
+    nodes = get_varnish_nodes()
+    if bans and not nodes:
+        logger.warning("No Varnish nodes configured or discovered; skipping BAN (TTL is fallback)")
+        return None
+    for regex, n in bans:
+        BAN_CHUNKS.inc()
+        BAN_REGEX_BYTES.inc(len(regex))
+        if stats is not None:
+            stats.record_chunk(n, len(regex))
+    return nodes
+
+
+def _submit_bans(
+    bans: List[Tuple[str, int]], stats: Optional[BanStats] = None, soft: bool = False
+) -> List[Future]:
+    """Queue (regex, n_patterns) BANs for every Varnish node on the shared pool.
+
+    Returns one future per (BAN, node) resolving to True on success.
+    """
+    nodes = _ban_targets(bans, stats)
+    if nodes is None:
+        failed: Future = Future()
+        failed.set_result(False)
+        return [failed]
+    executor = _get_executor()
+    return [
+        executor.submit(_send_ban, node, regex, n, stats, soft)
+        for regex, n in bans
+        for node in nodes
+    ]
+
+
+def _dispatch_bans(
+    bans: List[Tuple[str, int]], stats: Optional[BanStats] = None, soft: bool = False
+) -> bool:
+    """Fan BANs out to every Varnish node concurrently and wait for them.
+
+    Returns True only if every node accepted every BAN.
+    """
+    if not bans:
         return True
-    all_ok = True
-    for chunk in _chunks(list(tiles), VARNISH_MAX_TILES_PER_REQUEST):
-        patterns = "|".join(f"{t.z}/{t.x}/{t.y}" for t in chunk)
-        regex = f"^{_TILE_URL_PREFIX_GROUP}/({patterns})(\\.pbf)?$"
-        if not _send_ban(regex, len(chunk)):
-            all_ok = False
-    return all_ok
+    return all([f.result() for f in _submit_bans(bans, stats, soft)])
+
+
+async def _dispatch_bans_async(
+    bans: List[Tuple[str, int]], stats: Optional[BanStats] = None, soft: bool = False
+) -> bool:
+    """_dispatch_bans on the event loop; cancelling it cancels the BANs still in flight."""
+    if not bans:
+        return True
+    nodes = _ban_targets(bans, stats)
+    if nodes is None:
+        return False
+    results = await asyncio.gather(
+        *(_send_ban_async(node, regex, n, stats, soft) for regex, n in bans for node in nodes)
+    )
+    return all(results)
+
+
+def _prefix_bans(units: Iterable[str]) -> List[Tuple[str, int]]:
+    """Regex BANs for planned units: z/x_prefix, plus z/x/ columns and exact z/x/y tiles."""
+    groups = split_units(units)
+    bans = list(
+        chunk_by_regex_budget(
+            groups["prefix"],
+            VARNISH_BAN_REGEX_MAX_BYTES,
+            lambda body: f"^{_TILE_URL_PREFIX_GROUP}/{body}[0-9]*/[0-9]+(\\.pbf)?$",
+            absorb_extensions=True,
+        )
+    )
+    bans += chunk_by_regex_budget(
+        groups["column"],
+        VARNISH_BAN_REGEX_MAX_BYTES,
+        lambda body: f"^{_TILE_URL_PREFIX_GROUP}/{body}/[0-9]+(\\.pbf)?$",
+    )
+    bans += chunk_by_regex_budget(
+        groups["exact"],
+        VARNISH_BAN_REGEX_MAX_BYTES,
+        lambda body: f"^{_TILE_URL_PREFIX_GROUP}/{body}(\\.pbf)?$",
+    )
+    return bans
+
+
+def _xkey_purges(keys: Iterable[str]) -> List[Tuple[str, int]]:
+    """Cut layer-qualified keys into space-separated xkey-purge headers within the byte budget."""
+    purges: List[Tuple[str, int]] = []
+    chunk: List[str] = []
+    size = 0
+    for key in sorted(keys):
+        for layer in _TILE_LAYERS:
+            token = f"{layer}/{key}"
+            if chunk and size + 1 + len(token) > VARNISH_BAN_REGEX_MAX_BYTES:
+                purges.append((" ".join(chunk), len(chunk)))
+                chunk, size = [], 0
+            size += len(token) + (1 if chunk else 0)
+            chunk.append(token)
+    if chunk:
+        purges.append((" ".join(chunk), len(chunk)))
+    return purges
+
+
+def expand_invalidations(
+    tile_strings: Iterable[str], zoom_levels: Iterable[int]
+) -> Tuple[Set[str], List[str]]:
+    """Expire lines -> (units to invalidate, invalid lines).
+
+    Units are surrogate keys in xkey mode, else planned or rule prefixes.
+    """
+    zxy, invalid = parse_tile_xyz(tile_strings)
+    return expand_invalidations_xyz(zxy, zoom_levels), invalid
+
+
+def expand_invalidations_xyz(zxy: np.ndarray, zoom_levels: Iterable[int]) -> Set[str]:
+    """expand_invalidations for tiles already parsed by parse_tile_xyz."""
+    if VARNISH_BAN_MODE == "xkey":
+        return expand_xyz_keys(zxy, zoom_levels)
+    if VARNISH_BAN_PLANNER:
+        units, report = plan_invalidation_xyz(
+            zxy, zoom_levels, VARNISH_PLAN_MAX_PATTERNS, VARNISH_PLAN_TILES_PER_PATTERN
+        )
+        log_plan(report)
+        return units
+    return expand_xyz_prefixes(zxy, zoom_levels)
+
+
+def build_invalidations(units: Iterable[str]) -> List[Tuple[str, int]]:
+    """Units -> (BAN regex or xkey header, units in it) chunks, as sent to every node."""
+    if VARNISH_BAN_MODE == "xkey":
+        return _xkey_purges(units)
+    return _prefix_bans(units)
+
+
+def ban_tiles(
+    tiles: List[mercantile.Tile], stats: Optional[BanStats] = None, soft: Optional[bool] = None
+) -> bool:
+    """Send BAN request(s) to Varnish for the exact tiles given (no zoom expansion).
+
+    In xkey mode tiles at z12 and deeper are purged through their z12/z14
+    ancestor key, which also drops the other tiles sharing that key.
+    soft (default VARNISH_SOFT_PURGE) keeps grace copies; xkey mode only.
+    """
+    return _dispatch_bans(_tile_bans(tiles), stats, _resolve_soft(soft))
+
+
+async def ban_tiles_async(
+    tiles: List[mercantile.Tile], stats: Optional[BanStats] = None, soft: Optional[bool] = None
+) -> bool:
+    """ban_tiles on the event loop."""
+    return await _dispatch_bans_async(_tile_bans(tiles), stats, _resolve_soft(soft))
+
+
+def _tile_bans(tiles: List[mercantile.Tile]) -> List[Tuple[str, int]]:
+    """Exact-tile regex BANs, or in xkey mode PURGEs of the keys the tiles carry."""
+    if VARNISH_BAN_MODE == "xkey":
+        keys = set()
+        for t in tiles:
+            shift = t.z - xkey_zoom(t.z)
+            keys.add(f"{t.z - shift}/{t.x >> shift}/{t.y >> shift}")
+        return _xkey_purges(keys)
+    patterns = {f"{t.z}/{t.x}/{t.y}" for t in tiles}
+    return list(
+        chunk_by_regex_budget(
+            patterns,
+            VARNISH_BAN_REGEX_MAX_BYTES,
+            lambda body: f"^{_TILE_URL_PREFIX_GROUP}/{body}(\\.pbf)?$",
+        )
+    )
 
 
-def ban_tile_strings(tile_strings: Iterable[str], zoom_levels: Iterable[int]) -> bool:
+def ban_tile_strings(
+    tile_strings: Iterable[str],
+    zoom_levels: Iterable[int],
+    stats: Optional[BanStats] = None,
+    soft: Optional[bool] = None,
+) -> bool:
     """Send BAN request(s) to Varnish for tiles from an imposm expire file.
 
     Uses prefix-based regex matching (same strategy as the S3 cleaner):
     each tile z/x/y becomes z/x_prefix where x_prefix drops the last 1-2 digits.
-    Parents + same zoom + children are expanded and deduplicated.
-    This over-invalidates a bit but the regex stays compact.
+    Parents + same zoom + children are expanded and deduplicated with the
+    vectorized engine in utils.tile_expansion.
+    This over-invalidates a bit but the regex stays compact: prefixes are
+    compiled into a trie-shaped regex and cut into BANs by byte budget.
+    utils.ban_audit measures by how much against a cache inventory.
+    In xkey mode exact surrogate keys are purged instead.
     """
-    prefixes: Set[str] = set()
-    for tile_str in tile_strings:
-        m = _TILE_RE.match(tile_str)
-        if not m:
-            logger.warning(f"Skipping invalid tile format: {tile_str}")
-            continue
-        z, x, _y = (int(g) for g in m.groups())
-        prefixes.update(_expand_tile_prefixes(z, x, zoom_levels))
+    prefixes, invalid = expand_invalidations(tile_strings, zoom_levels)
+    if invalid:
+        logger.warning(f"Skipping {len(invalid)} invalid tile line(s), e.g. {invalid[:3]}")
 
     if not prefixes:
         return True
@@ -155,10 +599,225 @@ def ban_tile_strings(tile_strings: Iterable[str], zoom_levels: Iterable[int]) ->
         f"{min(zoom_levels)}-{max(zoom_levels)}"
     )
 
-    all_ok = True
-    sorted_prefixes = sorted(prefixes)
-    for chunk in _chunks(sorted_prefixes, VARNISH_MAX_TILES_PER_REQUEST):
-        regex = f"^{_TILE_URL_PREFIX_GROUP}/({'|'.join(chunk)})[0-9]*/[0-9]+(\\.pbf)?$"
-        if not _send_ban(regex, len(chunk)):
-            all_ok = False
-    return all_ok
+    return _dispatch_bans(build_invalidations(prefixes), stats, _resolve_soft(soft))
+
+
+class BanLedger:
+    """Latest expire-event time each prefix was banned for, bounded in age and size.
+
+    An immediate pass records its prefixes here. A delayed pass for an
+    event at time T can drop prefixes recorded for a later event: that
+    event schedules its own delayed passes, which run after this one and
+    cover the same late-render window.
+
+    Coalesced passes can record event times out of order, so entries are
+    evicted oldest event time first through a heap; heap entries that an
+    update superseded are skipped when they surface.
+    """
+
+    def __init__(self, max_age: float, max_size: int):
+        self.max_age = max_age
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._events: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+
+    def record(self, prefixes: Iterable[str], event_time: float):
+        with self._lock:
+            for p in prefixes:
+                if self._events.get(p, 0.0) < event_time:
+                    self._events[p] = event_time
+                    heapq.heappush(self._heap, (event_time, p))
+            cutoff = time.time() - self.max_age
+            while self._heap and (len(self._events) > self.max_size or self._heap[0][0] < cutoff):
+                t, p = heapq.heappop(self._heap)
+                if self._events.get(p) == t:
+                    del self._events[p]
+            if len(self._heap) > 2 * len(self._events) + 1024:
+                self._heap = [(t, p) for p, t in self._events.items()]
+                heapq.heapify(self._heap)
+
+    def banned_after(self, prefixes: Iterable[str], event_time: float) -> Set[str]:
+        """Subset of prefixes already banned for an event newer than event_time."""
+        with self._lock:
+            return {p for p in prefixes if self._events.get(p, 0.0) > event_time}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._events)
+
+
+class PrefixBanStream:
+    """Incremental prefix BANs for expire files read line by line.
+
+    Prefixes (surrogate keys in xkey mode) are deduplicated across
+    everything fed to the stream (one or several expire files). New ones
+    accumulate until flush_prefixes are pending, then go out as BANs without
+    waiting for the rest of the input; close() flushes the remainder and
+    waits for every BAN in flight.
+
+    With a ledger, an immediate pass records its prefixes under event_time
+    and a delayed pass (delayed=True) skips prefixes banned for a later
+    event. Both are per file: feed(..., event_time=) sets the event time of
+    the file fed, so a coalesced batch records and checks every file under
+    its own time. soft (default VARNISH_SOFT_PURGE) keeps grace copies; xkey mode only.
+
+    A warm_plan (utils.cache_warmer.WarmPlan) gets every batch as the
+    parsed tile array the prefixes are expanded from.
+    """
+
+    def __init__(
+        self,
+        zoom_levels: Iterable[int],
+        stats: Optional[BanStats] = None,
+        flush_prefixes: int = VARNISH_STREAM_FLUSH_PREFIXES,
+        ledger: Optional[BanLedger] = None,
+        event_time: Optional[float] = None,
+        delayed: bool = False,
+        soft: Optional[bool] = None,
+        warm_plan=None,
+    ):
+        self.zoom_levels = list(zoom_levels)
+        self.stats = stats
+        self.flush_prefixes = flush_prefixes
+        self.ledger = ledger
+        self.event_time = time.time() if event_time is None else event_time
+        self.delayed = delayed
+        self.soft = _resolve_soft(soft)
+        self.warm_plan = warm_plan
+        self.seen: Set[str] = set()
+        self.lines = 0
+        self.skipped = 0
+        self._pending: List[str] = []
+        self._futures: List[Future] = []
+
+    def add(self, tile_strings: List[str]):
+        self.lines += len(tile_strings)
+        zxy, invalid = parse_tile_xyz(tile_strings)
+        if self.warm_plan is not None:
+            self.warm_plan.add_xyz(zxy)
+        prefixes = expand_invalidations_xyz(zxy, self.zoom_levels)
+        if invalid:
+            logger.warning(f"Skipping {len(invalid)} invalid tile line(s), e.g. {invalid[:3]}")
+        if self.ledger is not None and not self.delayed:
+            # All of the file's prefixes, also those an earlier file of the batch already sent
+            self.ledger.record(prefixes, self.event_time)
+        new = prefixes - self.seen
+        if self.ledger is not None and self.delayed and new:
+            # Skipped prefixes stay out of seen: a later file of the batch may still need them
+            covered = self.ledger.banned_after(new, self.event_time)
+            self.skipped += len(covered)
+            new -= covered
+        self.seen |= new
+        self._pending.extend(new)
+        if len(self._pending) >= self.flush_prefixes:
+            self.flush()
+
+    def feed(self, lines: Iterable[str], batch_lines: int = EXPIRE_BATCH_LINES, event_time: Optional[float] = None):
+        """Add raw expire-file lines, expanding them batch_lines at a time.
+
+        event_time, when given, becomes the stream's event time for these
+        lines and the ones fed after them.
+        """
+        if event_time is not None:
+            self.event_time = event_time
+        batch: List[str] = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            batch.append(line)
+            if len(batch) >= batch_lines:
+                self.add(batch)
+                batch = []
+        if batch:
+            self.add(batch)
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._futures.extend(_submit_bans(build_invalidations(self._pending), self.stats, self.soft))
+        self._pending = []
+
+    def close(self) -> bool:
+        self.flush()
+        ok = all([f.result() for f in self._futures])
+        self._futures = []
+        self._log_close()
+        return ok
+
+    def _log_close(self):
+        if self.seen:
+            skipped = f", {self.skipped} already banned for newer events" if self.skipped else ""
+            unit = "keys" if VARNISH_BAN_MODE == "xkey" else "prefixes"
+            logger.info(
+                f"Varnish BAN: {self.lines} tiles -> {len(self.seen)} {unit} across zooms "
+                f"{min(self.zoom_levels)}-{max(self.zoom_levels)}{skipped}"
+            )
+
+
+class AsyncPrefixBanStream(PrefixBanStream):
+    """PrefixBanStream for the event loop: flushes start asyncio tasks, aclose() awaits them.
+
+    Create it in a coroutine. add() and feed() are synchronous (NumPy
+    expansion), so run large feeds in asyncio.to_thread; flushes from that
+    thread still start their BAN tasks on the stream's loop. Cancel the
+    coroutine awaiting aclose() to abort the BANs in flight.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = asyncio.get_running_loop()
+        self._thread = threading.get_ident()
+        self._tasks: List[asyncio.Future] = []
+        # Flushes from a worker thread; wrapped for the loop in aclose()
+        self._thread_futures: List[Future] = []
+        self._flush_lock = threading.Lock()
+        self._cancelled = False
+
+    def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        with self._flush_lock:
+            if self._cancelled:
+                return
+            coro = _dispatch_bans_async(build_invalidations(pending), self.stats, self.soft)
+            if threading.get_ident() == self._thread:
+                self._tasks.append(asyncio.ensure_future(coro))
+            else:
+                self._thread_futures.append(asyncio.run_coroutine_threadsafe(coro, self._loop))
+
+    def cancel(self):
+        """Cancel the BANs started so far and drop later flushes (e.g. of a feed thread still running)."""
+        with self._flush_lock:
+            self._cancelled = True
+            for f in self._tasks + self._thread_futures:
+                f.cancel()
+
+    async def aclose(self) -> bool:
+        self.flush()
+        self._tasks.extend(asyncio.wrap_future(f) for f in self._thread_futures)
+        self._thread_futures = []
+        # Cancelling the gather cancels every BAN task still running
+        results = await asyncio.gather(*self._tasks)
+        self._tasks = []
+        self._log_close()
+        return all(results)
+
+
+def ban_tile_stream(
+    lines: Iterable[str],
+    zoom_levels: Iterable[int],
+    stats: Optional[BanStats] = None,
+    batch_lines: int = EXPIRE_BATCH_LINES,
+    soft: Optional[bool] = None,
+) -> bool:
+    """BAN the tiles of an expire file streamed line by line.
+
+    Memory stays bounded by batch_lines plus the file's distinct prefixes,
+    and the first BANs are sent while the rest of the file is still read.
+    """
+    stream = PrefixBanStream(zoom_levels, stats, soft=soft)
+    stream.feed(lines, batch_lines)
+    return stream.close()